@@ -0,0 +1,388 @@
+"""
+  @file batch_convert.py
+  @brief Routines to convert many RTCM logs into RINEX files by pool of worker processes
+
+  @author Michal Zygmunt
+
+  @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
+
+  @license See LICENSE file for license details.
+
+  @todo none
+  @bug none
+"""
+
+import argparse
+import concurrent.futures
+import glob
+import os
+import sys
+import tempfile
+import time
+
+import compressed_io
+import conversion_cache
+import nav_merge
+import rtcm2rinex
+import rtcm_scan
+import session_split
+
+#%% Batch jobs
+#   Each job converts one input file by rtcm2rinex.convert, which keeps raw
+#   'convbin' output in its own scratch directory, so jobs can share
+#   destination directory. Output of a job (including 'convbin' messages)
+#   is captured, so failed jobs can be reported after the batch. Inputs may
+#   be pre-scanned by rtcm_scan first; logs without observation messages are
+#   skipped, as they would give empty obs files.
+
+
+# return list of input files for 'patterns': directories are expanded to
+# files they contain, other patterns are matched as globs; patterns which
+# match nothing are kept, so they are reported as failed jobs
+def find_inputs(patterns):
+
+    inputs = []
+
+    for pattern in patterns:
+
+        if os.path.isdir(pattern):
+            names = sorted(os.listdir(pattern))
+            inputs += [os.path.join(pattern, name) for name in names
+                       if name[0] != '.' and os.path.isfile(os.path.join(pattern, name))]
+            continue
+
+        paths = sorted(glob.glob(pattern))
+        if len(paths) == 0:
+            paths = [pattern]
+
+        inputs += [path for path in paths if os.path.isdir(path) == False]
+
+    return inputs
+
+
+# read manifest file with one '<YYYY/MM/DD> <file>' pair per line (comma
+# may be used as separator, lines starting with '#' are skipped); relative
+# file paths are relative to manifest directory; returns list of pairs
+def read_manifest(manifest_path):
+
+    manifest_dir = os.path.dirname(manifest_path)
+    pairs = []
+
+    with open(manifest_path) as manifest_file:
+        for line_number, line in enumerate(manifest_file, 1):
+
+            line = line.strip()
+            if line == "" or line[0] == '#':
+                continue
+
+            items = line.replace(',', ' ').split(None, 1)
+            if len(items) != 2:
+                raise ValueError("Invalid manifest line %d: %s" % (line_number, line))
+
+            date, path = items[0], items[1].strip()
+            pairs.append((date, os.path.join(manifest_dir, path)))
+
+    return pairs
+
+
+# return path of RINEX obs file which is written by convert for input file
+# 'in_file_path_name' saved in 'out_dir_path'; name of compressed input is
+# used without compression extension, as by convert (e.g. 'a.log.gz' and
+# 'a.log' both give 'a.obs')
+def obs_output_path(in_file_path_name, out_dir_path):
+
+    if out_dir_path == None:
+        out_dir_path = os.path.dirname(in_file_path_name)
+
+    in_file_name = compressed_io.split_compression(os.path.basename(in_file_path_name))[0]
+    in_file_name = os.path.splitext(in_file_name)[0]
+
+    return os.path.normcase(os.path.abspath(os.path.join(out_dir_path, in_file_name + '.obs')))
+
+
+# run conversion of one job given as dictionary with convert arguments;
+# returns dictionary with job result, error message and captured output;
+# obs and nav paths of result are lists of files of sessions if job is
+# split into sessions
+def run_job(job):
+
+    result = {"input": job["input"], "status": "OK", "time": 0.0,
+              "obs": "", "nav": "", "error": "", "output": ""}
+
+    start = time.time()
+
+    with tempfile.TemporaryFile(mode='w+', errors='replace') as log_file:
+
+        # redirect output of this process and 'convbin' to log file
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved_fds = os.dup(1), os.dup(2)
+        os.dup2(log_file.fileno(), 1)
+        os.dup2(log_file.fileno(), 2)
+
+        try:
+            if job["prescan"] == True and \
+               rtcm_scan.has_observations(rtcm_scan.scan_file(job["input"], job["date"])) == False:
+                result["status"] = "SKIPPED"
+                result["error"] = "No observation messages"
+            else:
+                result["obs"], result["nav"] = rtcm2rinex.convert(
+                    job["date"], job["input"], out_dir_path=job["dest"], window=job["window"],
+                    decoder=job["decoder"], demux=job["demux"], cache_dir=job["cache"],
+                    crx=job["crx"], compress=job["compress"], track=job["track"],
+                    session=job["session"], qc=job["qc"], nav_workers=job["nav_workers"])
+
+        except Exception as e:
+            # failure of one file must not stop batch
+            result["status"] = "FAILED"
+            result["error"] = str(e) or type(e).__name__
+
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            os.close(saved_fds[0])
+            os.close(saved_fds[1])
+
+        log_file.seek(0)
+        result["output"] = log_file.read()
+
+    result["time"] = time.time() - start
+
+    return result
+
+
+# run 'jobs' by pool of 'workers' processes (in this process, if 'workers'
+# is 1); jobs writing the same output files as previous job fail without
+# running; results are returned in order of jobs
+def convert_batch(jobs, workers=None):
+
+    results = [None] * len(jobs)
+    outputs = set()
+    pending = []
+
+    for index, job in enumerate(jobs):
+
+        out_path = obs_output_path(job["input"], job["dest"])
+
+        if out_path in outputs:
+            results[index] = {"input": job["input"], "status": "FAILED", "time": 0.0,
+                              "obs": "", "nav": "", "output": "",
+                              "error": "Output file is written by other job: " + out_path}
+            continue
+
+        outputs.add(out_path)
+        pending.append(index)
+
+    if workers == 1:
+        for index in pending:
+            results[index] = run_job(jobs[index])
+            print_progress(results[index], results)
+        return results
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+
+        futures = dict((pool.submit(run_job, jobs[index]), index) for index in pending)
+
+        for future in concurrent.futures.as_completed(futures):
+            index = futures[future]
+
+            try:
+                results[index] = future.result()
+            except Exception as e:
+                # worker process died
+                results[index] = {"input": jobs[index]["input"], "status": "FAILED",
+                                  "time": 0.0, "obs": "", "nav": "", "output": "",
+                                  "error": str(e) or type(e).__name__}
+
+            print_progress(results[index], results)
+
+    return results
+
+
+# print line with result of completed job
+def print_progress(result, results):
+    done = len([item for item in results if item != None])
+    print("[%d/%d] %-7s %s" % (done, len(results), result["status"], result["input"]))
+
+
+# return lines of summary table of 'results'
+def summary_lines(results):
+
+    width = max([len(result["input"]) for result in results] + [4])
+
+    lines = ["%4s  %-7s  %9s  %-*s  %s" % ("#", "status", "time [s]", width, "file", "error")]
+
+    for index, result in enumerate(results, 1):
+        lines.append("%4d  %-7s  %9.2f  %-*s  %s" % (index, result["status"], result["time"],
+                                                     width, result["input"], result["error"]))
+
+    converted = len([result for result in results if result["status"] == "OK"])
+    skipped = len([result for result in results if result["status"] == "SKIPPED"])
+    lines.append("")
+    lines.append("Number of converted files: %d" % converted)
+    if skipped > 0:
+        lines.append("Number of skipped files: %d" % skipped)
+    lines.append("Number of failed files: %d" % (len(results) - converted - skipped))
+
+    return lines
+
+
+if __name__ == "__main__":
+
+    start = time.time()
+
+    #%% Read input arguments
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("inputs", type=str, nargs='*',
+                        help="RTCM binary files, directories or glob patterns (e.g. 'logs/*.log') " \
+                            "to process. File paths can be absolute or relative.")
+    parser.add_argument("-t", "--date", type=str,
+                        help="calendar date of beginning of RTCM messages as <YYYY/MM/DD>, " \
+                            "used for all input files.")
+    parser.add_argument("-m", "--manifest", type=str,
+                        help="manifest file with '<YYYY/MM/DD> <file>' pair in each line.")
+    parser.add_argument("-d", "--dest", type=str,
+                        help="destination <directory> to save RINEX files. " \
+                            "If not specified, files are saved to input file directories.")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of worker processes. Number of CPUs is used by default.")
+    parser.add_argument("--nav-jobs", type=int, default=1,
+                        help="number of processes fixing chunks of big nav file in each " \
+                            "job (see convbin_nav_fix). Nav file is fixed by one process " \
+                            "by default.")
+    parser.add_argument("-w", "--window", type=int, default=0,
+                        help="number of recent epochs kept in memory to merge " \
+                            "duplicated obs epochs which are not consecutive.")
+    parser.add_argument("--decoder", type=str, choices=['convbin', 'native'], default='convbin',
+                        help="RTCM decoder used to create RINEX files.")
+    parser.add_argument("--demux", action='store_true',
+                        help="extract valid RTCM frames from capture logs before conversion.")
+    parser.add_argument("--crx", action='store_true',
+                        help="write obs files in Compact RINEX (Hatanaka) format.")
+    parser.add_argument("-z", "--compress", type=str, choices=['gz', 'zst'],
+                        help="compress output files by gzip or zstd.")
+    parser.add_argument("--prescan", action='store_true',
+                        help="scan input files first and skip files without observation " \
+                            "messages (see rtcm_scan).")
+    parser.add_argument("--track", type=str, choices=['csv', 'parquet'],
+                        help="save position track of NMEA GGA sentences of each input " \
+                            "next to its RINEX files (see nmea_track).")
+    parser.add_argument("--session", type=str,
+                        help="split obs and nav files into files of sessions of <SESSION> " \
+                            "length (e.g. '1h', '15m', at most a day); nav records go to obs " \
+                            "session of their time of clock or the nearest one " \
+                            "(see session_split).")
+    parser.add_argument("--qc", action='store_true',
+                        help="save quality statistics of obs files (see obs_qc); " \
+                            "fixing of obs files takes about 3 times longer.")
+    parser.add_argument("-c", "--cache", type=str,
+                        help="cache <directory> with converted files, shared by workers.")
+    parser.add_argument("--merge-nav", type=str,
+                        help="merge nav files of converted inputs into one <file> without " \
+                            "repeated ephemerides (see nav_merge).")
+    parser.add_argument("--nav-policy", type=str, choices=nav_merge.merge_policies,
+                        default='first',
+                        help="copy of repeated ephemeris kept in merged nav file.")
+    parser.add_argument("-s", "--summary", type=str,
+                        help="file to save summary table.")
+    parser.add_argument("-v", "--verbose", action='store_true',
+                        help="print output of failed conversions.")
+    args = parser.parse_args()
+
+    #%% Collect jobs
+
+    pairs = []
+
+    if len(args.inputs) > 0:
+        if args.date == None:
+            print("Date (-t/--date) is required for input files!")
+            print("Exiting!")
+            sys.exit(1)
+        pairs += [(args.date, path) for path in find_inputs(args.inputs)]
+
+    if args.manifest != None:
+        try:
+            pairs += read_manifest(args.manifest)
+        except (ValueError, EnvironmentError) as e:
+            print(e)
+            print("Exiting!")
+            sys.exit(1)
+
+    if len(pairs) == 0:
+        print("Missing input files!")
+        print("Exiting!")
+        sys.exit(1)
+
+    if args.jobs < 1:
+        print("Number of jobs must be positive!")
+        print("Exiting!")
+        sys.exit(1)
+
+    session = None
+    if args.session != None:
+        try:
+            session = session_split.parse_length(args.session)
+        except ValueError as e:
+            print(e)
+            print("Exiting!")
+            sys.exit(1)
+
+    jobs = [{"date": date, "input": path, "dest": args.dest, "window": args.window,
+             "decoder": args.decoder, "demux": args.demux, "cache": args.cache,
+             "crx": args.crx, "compress": args.compress, "prescan": args.prescan,
+             "track": args.track, "session": session, "qc": args.qc,
+             "nav_workers": args.nav_jobs}
+            for date, path in pairs]
+
+    #%% Convert files
+
+    print("Converting %d files by %d workers...\n" % (len(jobs), args.jobs))
+
+    results = convert_batch(jobs, args.jobs)
+
+    #%% Summary
+
+    lines = summary_lines(results)
+    print("\n" + "\n".join(lines))
+
+    if args.summary != None:
+        with open(args.summary, "w") as summary_file:
+            summary_file.write("\n".join(lines) + "\n")
+
+    merge_failed = False
+
+    if args.merge_nav != None:
+        nav_paths = []
+        for result in results:
+            if result["status"] == "OK":
+                nav_paths += result["nav"] if isinstance(result["nav"], list) else [result["nav"]]
+
+        print("\nMerging %d nav files..." % len(nav_paths))
+
+        try:
+            nav_merge.print_stats(nav_merge.merge_nav_files(nav_paths, args.merge_nav,
+                                                            args.nav_policy))
+        except (ValueError, RuntimeError, EnvironmentError) as e:
+            print("Can't merge nav files: " + str(e))
+            merge_failed = True
+
+    if args.cache != None:
+        print("")
+        conversion_cache.print_stats(conversion_cache.cache_stats(args.cache))
+
+    if args.verbose == True:
+        for result in results:
+            if result["status"] == "FAILED" and result["output"] != "":
+                print("\nOutput of " + result["input"] + ":")
+                print(result["output"].rstrip())
+
+    stop = time.time()
+    delta = stop - start
+    print("Processing time: %.2f s\n" % delta)
+
+    if len([result for result in results if result["status"] == "FAILED"]) > 0 or \
+       merge_failed == True:
+        sys.exit(1)
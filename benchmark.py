@@ -0,0 +1,622 @@
+"""
+  @file benchmark.py
+  @brief Routines to measure throughput of conversion stages on synthetic RTCM and RINEX data
+
+  @author Michal Zygmunt
+
+  @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
+
+  @license See LICENSE file for license details.
+
+  @todo none
+  @bug none
+"""
+
+import argparse
+import concurrent.futures
+import filecmp
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import convbin_nav_fix
+import convbin_obs_fix
+import rtcm2rinex
+import rtcm3_decoder
+import run_metrics
+
+#%% Synthetic RINEX obs file, formatted like 'convbin' output
+
+obs_header = (
+    "     3.04           OBSERVATION DATA    M: Mixed            RINEX VERSION / TYPE\n"
+    "CONVBIN 2.4.3                           20211124 141911 UTC PGM / RUN BY / DATE \n"
+    "format: RTCM 3                                              COMMENT             \n"
+    "G    4 C1C L1C S1C C2W                                      SYS / # / OBS TYPES \n"
+    "E    4 C1B L1B S1B C7Q                                      SYS / # / OBS TYPES \n"
+    "C    4 C2I L2I S2I C7I                                      SYS / # / OBS TYPES \n"
+    "                                                            END OF HEADER       \n")
+
+
+# return one observation row of satellite 'sat' with 4 observables
+def obs_row(rnd, sat):
+    return "%s%14.3f  %14.3f%1d %14.3f  %14.3f  \n" % (
+        sat, rnd.uniform(2.0e7, 2.6e7), rnd.uniform(1.0e8, 1.4e8),
+        rnd.randint(0, 9), rnd.uniform(20.0, 50.0), rnd.uniform(2.0e7, 2.6e7))
+
+
+# write synthetic obs file of about 'size' bytes; every epoch is split into
+# one block per constellation, some blocks are repeated as convbin does
+# and some observation rows are duplicated; returns number of epochs
+def write_obs(path, size, rate=10, seed=0):
+
+    rnd = random.Random(seed)
+    systems = [["G%02d" % prn for prn in range(1, 17)],
+               ["E%02d" % prn for prn in range(1, 15)],
+               ["C%02d" % prn for prn in range(1, 13)]]
+
+    with open(path, "w") as out_file:
+        out_file.write(obs_header)
+
+        epoch = 0
+        while out_file.tell() < size:
+
+            sec = float(epoch) / rate
+            epoch_id = "> 2021 11 25 %02d %02d%11.7f" % (
+                int(sec // 3600) % 24, int(sec // 60) % 60, sec % 60)
+
+            for sats in systems:
+                rows = [obs_row(rnd, sat) for sat in sats]
+
+                # duplicated row inside block
+                if rnd.random() < 0.05:
+                    rows.insert(rnd.randint(0, len(rows)), rnd.choice(rows))
+
+                block = "%s  0 %2d\n" % (epoch_id, len(rows)) + "".join(rows)
+
+                out_file.write(block)
+                if rnd.random() < 0.5:
+                    out_file.write(block)
+
+            epoch += 1
+
+    return epoch
+
+
+#%% Synthetic RINEX nav file, formatted like 'convbin' output
+
+nav_header = (
+    "     3.04           N: GNSS NAV DATA    M: Mixed            RINEX VERSION / TYPE\n"
+    "CONVBIN 2.4.3                           20211124 141911 UTC PGM / RUN BY / DATE \n"
+    "format: RTCM 3                                              COMMENT             \n"
+    "                                                            END OF HEADER       \n")
+
+
+# return one 'D' formatted value with mantissa lower than 1, as convbin does
+def nav_value(rnd):
+    if rnd.random() < 0.1:
+        return "  .000000000000D+00"
+    value = "%s.%d%011dD%+03d" % (rnd.choice(["-", ""]), rnd.randint(1, 9),
+                                  rnd.randint(0, 10**11 - 1), rnd.randint(-12, 8))
+    return value.rjust(19)
+
+
+# write synthetic nav file of about 'size' bytes with GPS ephemerides
+def write_nav(path, size, seed=0):
+
+    rnd = random.Random(seed)
+
+    with open(path, "w") as out_file:
+        out_file.write(nav_header)
+
+        record = 0
+        while out_file.tell() < size:
+
+            lines = ["G%02d 2021 12 %02d %02d 00 00" % (record % 32 + 1, record // 384 % 28 + 1,
+                                                      record // 32 % 12 * 2)]
+            lines[0] += "".join([nav_value(rnd) for item in range(3)])
+            for item in range(6):
+                lines.append("    " + "".join([nav_value(rnd) for item in range(4)]))
+            lines.append("    " + "".join([nav_value(rnd) for item in range(2)]))
+
+            out_file.write("\n".join(lines) + "\n")
+            record += 1
+
+
+#%% Synthetic RTCM 3 stream
+#   GPS and Galileo MSM7 messages with ranges changing slowly in time,
+#   with GPS (1019) and Galileo (1046) ephemerides repeated every minute.
+#   Some epochs are sent twice, as receivers retransmit them, so 'convbin'
+#   output contains duplicated epochs.
+
+# date of synthetic data
+bench_date = "2021/11/25"
+
+# system -> (MSM7 message number, satellites, MSM signal ids)
+rtcm_systems = [('G', 1077, range(1, 17), [2, 15]),
+                ('E', 1097, range(1, 15), [2, 15])]
+
+
+# payload of RTCM message built from bit fields
+class BitWriter(object):
+
+    def __init__(self):
+        self.value = 0
+        self.length = 0
+
+    # append field of 'width' bits with 'value' (negative values are
+    # written in two's complement)
+    def add(self, value, width):
+        self.value = (self.value << width) | (value & rtcm3_decoder.bit_masks[width])
+        self.length += width
+
+    # return payload padded with zero bits to full bytes
+    def payload(self):
+        pad = -self.length % 8
+        return (self.value << pad).to_bytes((self.length + pad) // 8, 'big')
+
+
+# return RTCM 3 frame of 'payload'
+def rtcm_frame(payload):
+
+    frame = bytes([0xD3, len(payload) >> 8, len(payload) & 0xFF]) + payload
+    crc = rtcm3_decoder.crc24q(frame)
+
+    return frame + bytes([crc >> 16, (crc >> 8) & 0xFF, crc & 0xFF])
+
+
+# return MSM7 message 'msg' of epoch 'tow' [ms] with ranges [m] of 'sats';
+# 'last' is False if more messages of this epoch follow
+def msm7_payload(msg, tow, sats, ranges, sigs, lock, last):
+
+    bits = BitWriter()
+
+    # header: message, station, epoch, multiple message bit, IODS,
+    # reserved, clock steering, external clock, smoothing and interval
+    for value, width in [(msg, 12), (0, 12), (tow, 30), (0 if last else 1, 1), (0, 3),
+                         (0, 7), (0, 2), (0, 2), (0, 1), (0, 3)]:
+        bits.add(value, width)
+
+    bits.add(sum([1 << (64 - sat) for sat in sats]), 64)
+    bits.add(sum([1 << (32 - sig) for sig in sigs]), 32)
+    bits.add((1 << len(sats) * len(sigs)) - 1, len(sats) * len(sigs))
+
+    rough = [int(value / rtcm3_decoder.range_ms * 1024) for value in ranges]
+
+    # satellite data: integer ms, extended info, modulo 1 ms, rough rate
+    for value in rough:
+        bits.add(value >> 10, 8)
+    for value in rough:
+        bits.add(0, 4)
+    for value in rough:
+        bits.add(value & 0x3FF, 10)
+    for item in range(len(sats)):
+        bits.add(-300 + 40 * item, 14)
+
+    # signal data: fine pseudorange, fine phase range, lock time, half
+    # cycle ambiguity, C/N0 and fine range rate
+    fine = []
+    for item, value in enumerate(ranges):
+        residual = value / rtcm3_decoder.range_ms - rough[item] / 1024.0
+        fine.extend([int(residual / 2.0**-29) - sig for sig in sigs])
+
+    for value in fine:
+        bits.add(value, 20)
+    for value in fine:
+        bits.add(value * 4 + 7, 24)
+    for value in fine:
+        bits.add(lock, 10)
+    for value in fine:
+        bits.add(0, 1)
+    for item in range(len(fine)):
+        bits.add(640 + item % 160, 10)
+    for item in range(len(fine)):
+        bits.add(item * 3, 15)
+
+    return bits.payload()
+
+
+# return ephemeris message 'msg' (1019 or 1046) of satellite 'prn' with
+# time of ephemeris 'toe' [s of week] of GPS week 'week'
+def eph_payload(msg, prn, week, toe, iode):
+
+    bits = BitWriter()
+    bits.add(msg, 12)
+
+    if msg == 1019:
+        table = rtcm3_decoder.table_1019
+        values = {"prn": prn, "week": week % 1024, "iode": iode, "iodc": iode,
+                  "toc": toe // 16, "toe": toe // 16}
+    else:
+        table = rtcm3_decoder.table_1046
+        values = {"prn": prn, "week": (week - 1024) % 4096, "iode": iode, "sva": 107,
+                  "toc": toe // 60, "toe": toe // 60}
+
+    # orbit of 26600 km semi-major axis with small eccentricity
+    values.update({"sqrta": int(5153.7 / 2.0**-19), "e": int(0.01 / 2.0**-33),
+                   "m0": prn * 100000000, "omg0": prn * 50000000, "i0": 300000000,
+                   "af0": prn * 1000, "deln": 10000})
+
+    for name, width, kind, scale in table:
+        bits.add(values.get(name, 0), width)
+
+    return bits.payload()
+
+
+# write synthetic RTCM 3 stream of about 'size' bytes recorded on
+# 'bench_date' with 'rate' epochs per second; returns number of epochs
+def write_rtcm(path, size, rate=10, seed=0):
+
+    rnd = random.Random(seed)
+
+    start = rtcm3_decoder.date_to_gps_ms(bench_date)
+    week = start // rtcm3_decoder.week_ms
+
+    ranges = dict(((sys, sat), rnd.uniform(2.0e7, 2.6e7))
+                  for sys, msg, sats, sigs in rtcm_systems for sat in sats)
+
+    with open(path, "wb") as out_file:
+
+        epoch = 0
+        while out_file.tell() < size:
+
+            time = start + epoch * 1000 // rate
+            tow = time % rtcm3_decoder.week_ms
+
+            # ephemerides every minute, new issue every 2 hours
+            if epoch % (60 * rate) == 0:
+                toe = tow // 1000 // 7200 * 7200
+                iode = time // 7200000 % 256
+                frames = [rtcm_frame(eph_payload(msg, sat, week, toe, iode))
+                          for msg in (1019, 1046) for sat in range(1, 13)]
+                out_file.write(b"".join(frames))
+
+            frames = []
+            for item, (sys, msg, sats, sigs) in enumerate(rtcm_systems):
+                values = [ranges[(sys, sat)] + 2.0e6 * math.sin(sat + epoch / rate / 3600.0)
+                          for sat in sats]
+                lock = min(epoch // rate, 1023)
+                frames.append(rtcm_frame(msm7_payload(msg, tow, sats, values, sigs, lock,
+                                                      item == len(rtcm_systems) - 1)))
+
+            out_file.write(b"".join(frames))
+
+            # retransmitted epoch
+            if rnd.random() < 0.05:
+                out_file.write(b"".join(frames))
+
+            epoch += 1
+
+    return epoch
+
+
+#%% Baseline obs fixer
+#   Original line based algorithm of convbin_obs_fix, before the bytes
+#   engine was introduced; kept only as reference for speed and output of
+#   convbin_obs_fix.fix_obs_file.
+
+# fix RINEX obs content read from text 'lines' and write it to text
+# 'out_file'; returns number of removed duplicated lines
+def fix_obs_baseline(lines, out_file):
+
+    end_of_header = False
+    epoch_is_set = False
+
+    temp_lines = []
+    duplicated_lines = 0
+
+    epoch_current = ""
+    epoch_prev = ""
+
+    for line in lines:
+
+        # preserve original header from RINEX file
+        if line[0] == '>':
+            end_of_header = True
+
+        if end_of_header == False:
+            out_file.write(line)
+            continue
+
+        if line[0] == '>':
+            if epoch_is_set == False:
+                epoch_current = line
+                epoch_is_set = True
+            else:
+                epoch_prev = epoch_current
+                epoch_current = line
+
+            # 2:29 means 'yyyy mm dd hh mm ss.sssssss' of epoch date/time id
+            if epoch_prev[2:29] != epoch_current[2:29]:
+
+                # fix satellite counter for this epoch
+                sats = len(temp_lines)
+
+                if sats > 0:
+
+                    tokens = epoch_prev.split()
+                    out_file.write("> %s %s %s %s %s %s %2d %2d                     \n" %
+                                   (tokens[1], tokens[2], tokens[3], # yyyy mm dd
+                                    tokens[4], tokens[5], tokens[6], # hh mm ss.sssssss
+                                    int(tokens[7]), sats)) # epoch_flag sats
+
+                    for item in range(sats):
+                        out_file.write(temp_lines[item])
+                    temp_lines = []
+
+            else: # date and time is equal
+                duplicated_lines += 1
+
+        # check if read line is not already stored in temp_lines
+        elif line not in temp_lines:
+            temp_lines.append(line)
+        else:
+            duplicated_lines += 1
+
+    # end of file reached; save content of last temp results
+    out_file.write(epoch_current)
+
+    for item in range(0, len(temp_lines)):
+        out_file.write(temp_lines[item])
+
+    return duplicated_lines
+
+
+#%% Timing helpers
+
+# run 'func' and return its processing time in seconds
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+# run baseline obs fixer on text file
+def fix_obs_lines(input_file_path_name, output_file_path_name):
+    with open(input_file_path_name) as lines:
+        with open(output_file_path_name, "w") as out_file:
+            fix_obs_baseline(lines, out_file)
+
+
+# run line based nav fixer on text file
+def fix_nav_lines(input_file_path_name, output_file_path_name):
+    with open(input_file_path_name) as lines:
+        with open(output_file_path_name, "w") as out_file:
+            convbin_nav_fix.fix_nav(lines, out_file)
+
+
+# print throughput of one benchmark
+def report(name, size, delta):
+    print("%-24s %8.2f s %10.2f MB/s" % (name, delta, size / 1e6 / delta))
+
+
+#%% Stages of conversion
+#   Each stage runs in fresh process, so its peak RSS isn't hidden by
+#   memory used by generator or by previous stages.
+
+# run stage 'name' ('convbin', 'nav_fix' or 'obs_fix') on 'in_path' with
+# output written to 'work_dir'; returns metrics of run_metrics.Stage with
+# number of written epochs
+def run_stage(name, in_path, work_dir):
+
+    stats = {}
+
+    with run_metrics.Stage(name, [in_path]) as stage:
+
+        if name == 'convbin':
+            obs_path, nav_path = rtcm2rinex.run_convbin(bench_date, in_path, work_dir)
+            stage.outputs = [obs_path, nav_path]
+
+        elif name == 'nav_fix':
+            stage.outputs = [os.path.join(work_dir, "fixed.nav")]
+            convbin_nav_fix.fix_nav_file(in_path, stage.outputs[0])
+
+        else:
+            stage.outputs = [os.path.join(work_dir, "fixed.obs")]
+            convbin_obs_fix.fix_obs_file(in_path, stage.outputs[0], stats=stats)
+
+    result = stage.result
+
+    if name == 'convbin':
+        with open(obs_path, 'rb') as in_file:
+            result["epochs"] = sum([1 for line in in_file if line[:1] == b'>'])
+    else:
+        result["epochs"] = stats.get("epochs")
+
+    return result
+
+
+# run stage 'name' in new process; returns result of run_stage
+def measure_stage(name, in_path, work_dir):
+
+    context = multiprocessing.get_context('spawn')
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(run_stage, name, in_path, work_dir).result()
+
+
+# return entry of benchmark results for stage 'name' of input of 'size' MB
+def result_entry(name, size, result):
+
+    wall_time = max(result["wall_time"], 1e-9)
+
+    entry = {"stage": name, "size_mb": size, "bytes": result["bytes_in"],
+             "wall_time": result["wall_time"], "cpu_time": result["cpu_time"],
+             "mb_per_s": result["bytes_in"] / 1e6 / wall_time,
+             "epochs": result["epochs"], "epochs_per_s": None,
+             "peak_rss": result["peak_rss"]}
+
+    if result["epochs"] != None:
+        entry["epochs_per_s"] = result["epochs"] / wall_time
+
+    return entry
+
+
+# print one entry of benchmark results
+def print_entry(entry):
+
+    epochs = "%12.0f epochs/s" % entry["epochs_per_s"] if entry["epochs_per_s"] != None else " " * 21
+    rss = "%8.1f MB RSS" % (entry["peak_rss"] / 1e6) if entry["peak_rss"] != None else ""
+
+    print("%-8s %9.1f MB %8.2f s %10.2f MB/s %s %s" % (
+        entry["stage"], entry["bytes"] / 1e6, entry["wall_time"], entry["mb_per_s"], epochs, rss))
+
+
+# run stages of conversion for synthetic inputs of 'sizes' [MB] in
+# directory 'work_dir'; returns list of result entries
+def run_suite(sizes, work_dir, stages):
+
+    entries = []
+
+    for size in sizes:
+
+        print("\nSize of synthetic inputs: %g MB" % size)
+
+        size_dir = os.path.join(work_dir, "%g" % size)
+        os.makedirs(size_dir)
+
+        try:
+            inputs = {}
+
+            if 'convbin' in stages:
+                inputs['convbin'] = os.path.join(size_dir, "bench.rtcm3")
+                write_rtcm(inputs['convbin'], int(size * 1e6))
+
+            if 'nav_fix' in stages:
+                inputs['nav_fix'] = os.path.join(size_dir, "synthetic.nav")
+                write_nav(inputs['nav_fix'], int(size * 1e6))
+
+            if 'obs_fix' in stages:
+                inputs['obs_fix'] = os.path.join(size_dir, "synthetic.obs")
+                write_obs(inputs['obs_fix'], int(size * 1e6))
+
+            for name in stages:
+                entry = result_entry(name, size, measure_stage(name, inputs[name], size_dir))
+                print_entry(entry)
+                entries.append(entry)
+
+        finally:
+            shutil.rmtree(size_dir, ignore_errors=True)
+
+    return entries
+
+
+# compare baseline obs fixer with bytes engine and line based nav fixer
+# with block engine on inputs of 'size' MB; returns False if outputs are
+# different
+def compare_engines(size, work_dir):
+
+    in_ro_path = os.path.join(work_dir, "bench.obs")
+    out_lines_path = os.path.join(work_dir, "bench_lines.obs")
+    out_bytes_path = os.path.join(work_dir, "bench_bytes.obs")
+
+    print("Generating synthetic obs file...")
+    write_obs(in_ro_path, int(size * 1e6))
+    size_ro = os.path.getsize(in_ro_path)
+    print("Size of obs file: %.1f MB\n" % (size_ro / 1e6))
+
+    #%% Obs fixer: baseline vs bytes engine
+
+    report("obs fix (baseline)", size_ro,
+           timed(fix_obs_lines, in_ro_path, out_lines_path))
+    report("obs fix (bytes)", size_ro,
+           timed(convbin_obs_fix.fix_obs_file, in_ro_path, out_bytes_path))
+
+    if not filecmp.cmp(out_lines_path, out_bytes_path, shallow=False):
+        print("ERROR: outputs of obs fix engines are different!")
+        return False
+
+    os.remove(in_ro_path)
+
+    #%% Nav fixer: line based engine vs block engine
+
+    in_rn_path = os.path.join(work_dir, "bench.nav")
+    out_lines_path = os.path.join(work_dir, "bench_lines.nav")
+    out_blocks_path = os.path.join(work_dir, "bench_blocks.nav")
+
+    print("\nGenerating synthetic nav file...")
+    write_nav(in_rn_path, int(size * 1e6))
+    size_rn = os.path.getsize(in_rn_path)
+    print("Size of nav file: %.1f MB\n" % (size_rn / 1e6))
+
+    report("nav fix (lines)", size_rn,
+           timed(fix_nav_lines, in_rn_path, out_lines_path))
+    report("nav fix (blocks)", size_rn,
+           timed(convbin_nav_fix.fix_nav_file, in_rn_path, out_blocks_path))
+
+    if not filecmp.cmp(out_lines_path, out_blocks_path, shallow=False):
+        print("ERROR: outputs of nav fix engines are different!")
+        return False
+
+    return True
+
+
+if __name__ == "__main__":
+
+    #%% Read input arguments
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=str, default="1,10,100",
+                        help="comma separated sizes of synthetic inputs in MB, " \
+                            "e.g. '1,10,100,1000,5000'.")
+    parser.add_argument("--stages", type=str, default="convbin,nav_fix,obs_fix",
+                        help="comma separated stages to measure: convbin, nav_fix, obs_fix.")
+    parser.add_argument("-j", "--json", type=str,
+                        help="save results as JSON <file>, which can be compared " \
+                            "between versions.")
+    parser.add_argument("--engines", action='store_true',
+                        help="compare baseline obs fixer and line based nav fixer " \
+                            "with engines of fixers instead, on inputs of size given by --size.")
+    parser.add_argument("-s", "--size", type=float, default=100,
+                        help="size of synthetic obs and nav files in MB for --engines.")
+    parser.add_argument("-d", "--dest", type=str,
+                        help="<directory> to save temporary files, created if it doesn't " \
+                            "exist. System temporary directory is used by default.")
+    args = parser.parse_args()
+
+    try:
+        sizes = [float(item) for item in args.sizes.split(',')]
+    except ValueError:
+        print("Invalid sizes: " + args.sizes)
+        print("Exiting!")
+        sys.exit(1)
+
+    stages = [item.strip() for item in args.stages.split(',')]
+    for name in stages:
+        if name not in ('convbin', 'nav_fix', 'obs_fix'):
+            print("Unknown stage: " + name)
+            print("Exiting!")
+            sys.exit(1)
+
+    try:
+        if args.dest != None:
+            os.makedirs(args.dest, exist_ok=True)
+        work_dir = tempfile.mkdtemp(prefix="rtcm2rinex_bench_", dir=args.dest)
+    except EnvironmentError as e:
+        print("Can't create directory of temporary files: " + str(e))
+        print("Exiting!")
+        sys.exit(1)
+
+    try:
+        if args.engines == True:
+            if compare_engines(args.size, work_dir) == False:
+                sys.exit(1)
+
+        else:
+            entries = run_suite(sizes, work_dir, stages)
+
+            if args.json != None:
+                results = {"version": 1, "created": time.time(),
+                           "python": platform.python_version(), "platform": platform.platform(),
+                           "results": entries}
+                with open(args.json, 'w') as out_file:
+                    json.dump(results, out_file, indent=2)
+
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,375 @@
+"""
+  @file compressed_io.py
+  @brief Routines to read compressed RTCM logs and write compressed or Hatanaka compacted RINEX files
+
+  @author Michal Zygmunt
+
+  @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
+
+  @license See LICENSE file for license details.
+
+  @todo none
+  @bug none
+"""
+
+import datetime
+import gzip
+import io
+import os
+import shutil
+
+# zstd support is optional
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#%% Compressed streams
+#   Input format is found by magic bytes, output format by file extension:
+#   '.gz' (gzip) and '.zst' (zstd, needs 'zstandard' package). Obs files
+#   with '.crx' extension (e.g. 'name.crx.gz') are written in Compact
+#   RINEX 3.0 format by CrxWriter. All formats are written as streams, so
+#   fixers write compressed files in the same pass.
+
+gzip_magic = b'\x1f\x8b'
+zstd_magic = b'\x28\xb5\x2f\xfd'
+
+# extensions of compressed files
+compressed_extensions = ('.gz', '.zst')
+
+# gzip compression level; higher levels are much slower for RINEX files
+gzip_level = 6
+
+# size of blocks copied at once
+block_size = 1024 * 1024
+
+
+# return compression of file 'path' found by magic bytes: 'gz', 'zst' or
+# None for uncompressed file
+def file_compression(path):
+
+    with open(path, 'rb') as in_file:
+        magic = in_file.read(4)
+
+    if magic[:2] == gzip_magic:
+        return 'gz'
+
+    if magic == zstd_magic:
+        return 'zst'
+
+    return None
+
+
+# raise error if 'zstandard' package isn't available
+def check_zstd():
+    if zstandard == None:
+        raise RuntimeError("Python package 'zstandard' is required for zstd files!")
+
+
+# open file 'path' for binary reading; compressed file is decompressed
+# while it's read
+def open_input(path):
+
+    compression = file_compression(path)
+
+    if compression == 'gz':
+        return gzip.open(path, 'rb')
+
+    if compression == 'zst':
+        check_zstd()
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+
+    return open(path, 'rb')
+
+
+# decompress file 'path' into 'out_path'
+def decompress_file(path, out_path):
+
+    with open_input(path) as in_file:
+        with open(out_path, 'wb') as out_file:
+            shutil.copyfileobj(in_file, out_file, block_size)
+
+
+# return 'path' without compression extension and the extension
+def split_compression(path):
+
+    base, ext = os.path.splitext(path)
+
+    if ext in compressed_extensions:
+        return base, ext
+
+    return path, ""
+
+
+# open file 'path' for writing, compressed according to its extension;
+# binary stream is returned, unless 'text' is True; RINEX obs file with
+# '.crx' extension is written in Compact RINEX format; data is appended to
+# existing file if 'append' is True (compressed data as new gzip member or
+# zstd frame, which are read as one stream)
+def open_output(path, text=False, append=False):
+
+    base, ext = split_compression(path)
+    mode = 'ab' if append == True else 'wb'
+
+    # differences of Compact RINEX can't continue in new stream
+    if append == True and os.path.splitext(base)[1] == '.crx':
+        raise ValueError("Compact RINEX file can't be appended: " + path)
+
+    if ext == '.gz':
+        out_file = gzip.open(path, mode, compresslevel=gzip_level)
+    elif ext == '.zst':
+        check_zstd()
+        out_file = zstandard.ZstdCompressor().stream_writer(open(path, mode), closefd=True)
+    else:
+        out_file = open(path, mode)
+
+    if os.path.splitext(base)[1] == '.crx':
+        out_file = CrxWriter(out_file)
+
+    if text == True:
+        return io.TextIOWrapper(out_file)
+
+    return out_file
+
+
+#%% Compact RINEX
+#   Compact RINEX 3.0 (Hatanaka) format: epoch line is written as text
+#   difference from previous one, with satellites listed from column 42;
+#   each observable is written as integer of its value in thousandths,
+#   first as '3&<value>' and then as differences up to 3rd order until
+#   the value is missing; LLI and signal strength flags are written as text
+#   difference from flags of the same satellite in previous epoch. Output
+#   can be checked by 'crx2rnx' of optional 'hatanaka' package (see
+#   requirements-dev.txt).
+
+crx_version = "3.0"
+
+# order of differences of observables
+crx_order = 3
+
+
+# return text difference of 'new' line from 'old' line: unchanged chars
+# are written as spaces and chars changed to spaces as '&'
+def text_diff(old, new):
+
+    diff = []
+
+    for item, char in enumerate(new):
+        if item >= len(old):
+            diff.append(char)
+        elif char == old[item]:
+            diff.append(' ')
+        elif char == ' ':
+            diff.append('&')
+        else:
+            diff.append(char)
+
+    for char in old[len(new):]:
+        diff.append('&' if char != ' ' else ' ')
+
+    return "".join(diff).rstrip(' ')
+
+
+# return integer of RINEX F14.3 value given as text
+def value_to_int(text):
+
+    whole, dot, fraction = text.partition('.')
+
+    if len(fraction) == 3 and fraction.isdigit():
+        return int(whole + fraction)
+
+    return int(round(float(text) * 1000))
+
+
+# file-like object converting RINEX 3 obs content written to it into
+# Compact RINEX 3.0 written to binary 'out_file'
+class CrxWriter(object):
+
+    def __init__(self, out_file):
+
+        self.out_file = out_file
+        self.rest = b''
+
+        self.header = True
+        self.started = False
+        self.types = {}
+        self.last_sys = None
+
+        # current epoch: epoch line and data lines
+        self.epoch = None
+        self.lines = []
+
+        # previous epoch line, differences and flags of satellites
+        self.epoch_line = None
+        self.sats = {}
+
+    # write bytes 'data' of RINEX obs file
+    def write(self, data):
+
+        lines = (self.rest + data).split(b'\n')
+        self.rest = lines.pop()
+
+        out = []
+        for line in lines:
+            self.add_line(line.rstrip(b'\r').decode('ascii', 'replace'), out)
+
+        if out:
+            self.out_file.write("".join(out).encode('ascii', 'replace'))
+
+        return len(data)
+
+    def flush(self):
+        self.out_file.flush()
+
+    # write the last epoch and close output
+    def close(self):
+
+        out = []
+
+        if self.rest:
+            self.add_line(self.rest.rstrip(b'\r').decode('ascii', 'replace'), out)
+            self.rest = b''
+
+        if self.epoch != None:
+            self.write_epoch(out)
+
+        if out:
+            self.out_file.write("".join(out).encode('ascii', 'replace'))
+
+        self.out_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # process one RINEX line 'line'; output lines are appended to 'out'
+    def add_line(self, line, out):
+
+        if self.header == True:
+            self.add_header_line(line, out)
+            return
+
+        if line[:1] == '>':
+            if self.epoch != None:
+                self.write_epoch(out)
+            self.epoch = line
+            self.lines = []
+
+        elif self.epoch != None:
+            self.lines.append(line)
+
+    # process RINEX header line; CRINEX lines are written before it
+    def add_header_line(self, line, out):
+
+        if self.started == False:
+            now = datetime.datetime.utcnow()
+            out.append("%-20s%-40s%-20s\n" % (crx_version, "COMPACT RINEX FORMAT",
+                                              "CRINEX VERS   / TYPE"))
+            out.append("%-40s%-20s%-20s\n" % ("RTCM2RINEX", now.strftime("%d-%b-%y %H:%M"),
+                                              "CRINEX PROG / DATE"))
+            self.started = True
+
+        label = line[60:].rstrip()
+
+        if label == "SYS / # / OBS TYPES":
+            if line[0] != ' ':
+                self.last_sys = line[0]
+                self.types[self.last_sys] = int(line[3:6])
+
+        out.append(line + "\n")
+
+        if label == "END OF HEADER":
+            self.header = False
+
+    # write current epoch to 'out'
+    def write_epoch(self, out):
+
+        line = self.epoch
+        lines = self.lines
+        self.epoch = None
+        self.lines = []
+
+        flag = line[31:32]
+
+        # special events are written as they are and next epoch line is
+        # written in full
+        if flag not in (' ', '0', '1'):
+            out.append(line + "\n")
+            out.extend([item + "\n" for item in lines])
+            self.epoch_line = None
+            return
+
+        if line[41:56].strip() != "":
+            raise ValueError("Receiver clock offsets are not supported in Compact RINEX output!")
+
+        # satellite counter is set to number of data lines
+        sats = [item[:3] for item in lines]
+        epoch_line = "%-32.32s%3d%6s" % (line, len(sats), "") + "".join(sats)
+
+        if self.epoch_line == None:
+            out.append(epoch_line + "\n")
+        else:
+            out.append(text_diff(self.epoch_line, epoch_line) + "\n")
+
+        self.epoch_line = epoch_line
+
+        # receiver clock offset line
+        out.append("\n")
+
+        states = {}
+
+        for item in lines:
+            sat = item[:3]
+            ntypes = self.types.get(sat[0], max(len(item) - 3 + 15, 0) // 16)
+            item = item.ljust(3 + 16 * ntypes)
+
+            diffs, flags_prev = self.sats.get(sat, (None, None))
+            if diffs == None or len(diffs) != ntypes:
+                diffs, flags_prev = [None] * ntypes, None
+
+            fields = []
+            flags = []
+            new_diffs = []
+
+            for index in range(ntypes):
+                field = item[3 + 16 * index:3 + 16 * (index + 1)]
+                text = field[:14].strip()
+                flags.append(field[14:16])
+
+                if text == "":
+                    # missing value ends arc
+                    fields.append("")
+                    new_diffs.append(None)
+                    continue
+
+                value = value_to_int(text)
+                prev = diffs[index]
+
+                if prev == None:
+                    fields.append("%d&%d" % (crx_order, value))
+                    new_diffs.append([value])
+                    continue
+
+                values = [value]
+                for order in range(min(len(prev), crx_order)):
+                    values.append(values[order] - prev[order])
+
+                fields.append("%d" % values[-1])
+                new_diffs.append(values[:crx_order])
+
+            flags = "".join(flags)
+            states[sat] = (new_diffs, flags)
+
+            # flags of new satellite are written in full with spaces as '&'
+            if flags_prev == None:
+                flags_diff = flags.replace(" ", "&")
+            else:
+                flags_diff = text_diff(flags_prev, flags)
+
+            data_line = " ".join(fields) + " " + flags_diff
+            out.append(data_line.rstrip(' ') + "\n")
+
+        # satellites missing in this epoch start new arcs
+        self.sats = states
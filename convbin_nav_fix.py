@@ -1,120 +1,49 @@
 """
   @file convbin_nav_fix.py
   @brief Routines to fix ephemeris values of RINEX navigation file created by convbin
- 
+
   @author Michal Zygmunt
- 
+
   @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
- 
+
   @license See LICENSE file for license details.
- 
+
   @todo none
   @bug none
- 
+
   $Date: 2021-11-24 14:18:22 +0200 (sr., 14 lis 2021) $
   $Revision: 2058 $
   $LastChangedBy: mzygmunt $
 """
 
 import argparse
-import os.path
+import concurrent.futures
+import io
+import mmap
+import multiprocessing
+import os
+import re
 import sys
 import time
 
-start = time.time()
-
-#%% Read input arguments
-
-parser = argparse.ArgumentParser()
-parser.add_argument("input_file", type=str,
-                    help="input RINEX nav file to check for duplicated epochs. " \
-                        "File path can be absolute or relative.")
-parser.add_argument("-o", "--output_file", type=str,
-                    help="output RINEX file to save. " \
-                        "File path can be absolute or relative. " \
-                        "If not specified, output file is written to input directory " \
-                        "with name <input_file>_fix.<input_file_extension>")
-args = parser.parse_args()
-
-input_file_path_name = args.input_file
-output_file_path_name = args.output_file
-
-#%% Sanity check for input parameters    
-
-# check validity of input file
-in_file_path = ""
-in_file_name = ""
-in_file_ext = ""
-
-if input_file_path_name != None:
-    
-    if os.path.exists(input_file_path_name) == True:
-        
-        # return filename.ext
-        file_name_ext = os.path.basename(input_file_path_name)
-        
-        if file_name_ext == '':
-            print("Directory specified instead of file!")
-            print("Exiting!")
-            sys.exit()
-            
-        if os.access(input_file_path_name, os.R_OK) == False:
-            print("User don't have access rights to read specified file!")
-            print("Exiting!")
-            sys.exit()
-            
-        
-        #split filename.ext into filename and ext
-        in_file_name, in_file_ext = os.path.splitext(file_name_ext)
-        
-        # get input file directory path by cutting file name from path string 
-        in_file_path = input_file_path_name[0:-len(file_name_ext)]
-        # normalize path to remove slash from path
-        in_file_path = os.path.normpath(in_file_path)
-        
-        
-    elif input_file_path_name == "":
-         print("Missing input file!")
-         print("Exiting!")
-         sys.exit()
-    
-    else:
-        print("Can't locate file: " + input_file_path_name)
-        print("Exiting!")
-        sys.exit()
-
-# check validity of output file
-output_file_path = ""
-out_file_name = ""
-
-if output_file_path_name == None:
-    output_file_path = in_file_path
-    output_file_path_name = os.path.join(output_file_path, in_file_name + "_fix.nav")
-else:
-    file_name_ext = os.path.basename(output_file_path_name)
-    
-    #split filename.ext into filename and ext
-    out_file_name, out_file_ext = os.path.splitext(file_name_ext)
-    
-    # get output file directory path by cutting file name from path string 
-    output_file_path = output_file_path_name[0:-len(file_name_ext)]
-    # normalize path to remove slash from path
-    output_file_path = os.path.normpath(output_file_path)
-
-if os.path.exists(output_file_path) == False:
-    # try creating output directory
-    try:
-        os.makedirs(output_file_path)
-    except IOError:
-        print(sys.exc_type)
-        sys.exit()
-    
-out_file = open(output_file_path_name, "w")
-    
+import compressed_io
+import session_split
+import stage_profiler
+
 #%% Process RINEX nav file in scope of:
 #   - change 'D' to 'E' exponential identifier
 #   - add leading number (before delimiter) and update exponential power
 
+# start column of ephemeris data in row and its length
+val_start = [4, 23, 42, 61]
+val_length = 19
+
+# header ending text
+header_end = "END OF HEADER"
+
+# size of block of nav data processed at once by fix_nav_blocks
+block_size = 4 * 1024 * 1024
+
 
 # convert string representing exponential number to different format
 def exp_as_string(text):
@@ -126,92 +55,533 @@ def exp_as_string(text):
 
 # update content of one line, formatted with exp_as_string output
 def update_line(line, val_start, val_start_idx, val_updated):
-    
+
     line_out = ""
-    
+
     # check line length to determine number of possible values
     line_length = len(line)
-    
+
     # iterate over starting char of val_start list
     for item in range(val_start_idx, len(val_start)):
-        
+
         if(line_length -1 > val_start[item]):
-            
+
             # extract string containing just one value
             val_string = line[val_start[item]:val_start[item] + val_length]
-                            
+
             # process string value and append to new output
             val_string_updated = exp_as_string(val_string)
             line_out += val_string_updated
-                            
+
             if val_string.strip() != val_string_updated.strip():
-                val_updated += 1    
-            
+                val_updated += 1
+
     return line_out, val_updated
 
 
-# start column of ephemeris data in row and its length
-val_start = [4, 23, 42, 61]
-val_length = 19
+# fix one line of nav data (header excluded) and return it with new line
+# symbol, together with updated counter of updated values
+def update_record(line, val_updated):
+
+    # check if line contains GNSS nav data id
+    if line[0] != ' ':
+
+        # get content of sat id and date of ephemeris
+        line_new = line[0:23]
+
+        # update satellite clock parameters (bias, drift, drift_rate)
+        # 1 to skip initial value from this row at column 4, which
+        # is already stored in line_new variable
+        line_out, val_updated = update_line(line, val_start, 1, val_updated)
+        line_new += line_out
+
+    else:
+        # gather ephemeris data for sat system and convert
+        # to exponential notation all values in that line
+
+        # set empty spaces on beginning of RINEX nav data row
+        line_new = "    "
+
+        # find how many values are in line, based on line length
+        # 0 to scan for all possible values in this line
+        line_out, val_updated = update_line(line, val_start, 0, val_updated)
+        line_new += line_out
+
+    # create new line symbol after each line
+    return line_new + "\n", val_updated
 
-# header ending text
-end_of_header = False
-header_end = "END OF HEADER"
 
-# counter of updated values
-val_updated = 0
+# fix RINEX nav content read from 'lines' (any iterable of text lines, e.g.
+# opened file) and write result to 'out_file' (any object with write());
+# returns number of updated values
+def fix_nav(lines, out_file):
+
+    end_of_header = False
+
+    # counter of updated values
+    val_updated = 0
 
-with open(input_file_path_name) as lines:
     for line in lines:
-        
-        # preserve original header from RINEX file        
+
+        # preserve original header from RINEX file
         if end_of_header == False:
             out_file.write(line)
-        
+
         if header_end in line:
             end_of_header = True
-            continue        
-        
+            continue
+
         # process observables
         if end_of_header == True:
-            
-            # check if line contains GNSS nav data id
-            if line[0] != ' ':
-                
-                # get content of sat id and date of ephemeris                
-                line_new = line[0:23]
-                
-                # update satellite clock parameters (bias, drift, drift_rate)
-                # 1 to skip initial value from this row at column 4, which
-                # is already stored in line_new variable
-                line_out, val_updated = update_line(line, val_start, 1, val_updated)
-                line_new += line_out
-                
-                out_file.write(line_new)
-                
-            else:
-                # gather ephemeris data for sat system and convert
-                # to exponential notation all values in that line
-                
-                # set empty spaces on beginning of RINEX nav data row
-                line_new = "    "
-                
-                # find how many values are in line, based on line length
-                # 0 to scan for all possible values in this line
-                line_out, val_updated = update_line(line, val_start, 0, val_updated)
-                line_new += line_out
-                
-                out_file.write(line_new)
-                
-            # create new line symbol after each write
-            out_file.write("\n")
-
-out_file.close()
-
-#%% statistics informations 
-
-print("Number of updated values: " + str(val_updated))
-
-stop = time.time()
-delta = stop - start
-print("Processing time: %.2f s\n" % delta)
+
+            line_new, val_updated = update_record(line, val_updated)
+            out_file.write(line_new)
+
+    return val_updated
+
+
+#%% Batched processing of nav data
+#   Values written by convbin are 'D' formatted with mantissa lower than 1,
+#   so E formatted value has the same digits moved by one place and
+#   exponent decreased by one. Block of nav data, which lines have exactly
+#   the layout produced by update_record, is split at 'D' exponent marks
+#   and rebuilt at once; values already formatted as by exp_as_string are
+#   left untouched. Other blocks are processed line by line.
+
+# one field of 19 chars: 'D' formatted value to update or value which is
+# already formatted as by exp_as_string
+re_field = (r"(?: [ -]\.\d{12}D[+-]\d\d"
+            r"|[ -][1-9]\.\d{12}E[+-]\d\d"
+            r"|[ -]0\.0{12}E\+00)")
+
+# line with up to 4 values or line with sat id and date of ephemeris
+# followed by up to 3 values
+re_block = re.compile(r"(?:(?:    " + re_field + "{0,4}"
+                      r"|[GRECJIS]\d\d \d{4} \d\d \d\d \d\d \d\d \d\d" + re_field + "{0,3})\n)*")
+
+# exponent of zero value, temporarily marked by 'Z'
+re_zero_exp = re.compile(r"Z[+-]\d\d")
+
+# 'D' exponent -> 'E' exponent of mantissa moved by one place, preceded by
+# trailing zero of mantissa; exponents out of this range give wider values
+# and are handled line by line
+exp_d_to_e = dict(("%+03d" % exp, "0E%+03d" % (exp - 1)) for exp in range(-98, 100))
+
+
+# fix block of complete nav data lines like update_record does for each
+# line; returns fixed block and number of updated values or None if block
+# can't be processed at once
+def update_block(block):
+
+    if re_block.fullmatch(block) == None:
+        return None
+
+    # every 'D' formatted value is updated, other values are
+    # already formatted
+    val_updated = block.count("D")
+    if val_updated == 0:
+        return block, 0
+
+    # mantissa starting with 0 can't be just moved by one place,
+    # unless value is zero
+    zeros = block.count(".000000000000D")
+    if block.count(" .0") + block.count("-.0") != zeros:
+        return None
+
+    # zero values have always zero exponent
+    if zeros > 0:
+        block = block.replace("  .000000000000D", " 0.000000000000Z")
+        block = block.replace(" -.000000000000D", "-0.000000000000Z")
+
+    # each part ends with 15 chars of value: 2 leading chars with sign,
+    # delimiter and mantissa digits, and starts with exponent of previous
+    # value (but first one)
+    parts = block.split("D")
+
+    try:
+        part = parts[0]
+        block_new = [part[:-15], part[-14], part[-12], '.', part[-11:]]
+
+        block_new += [exp_d_to_e[part[:3]] + part[3:-15] + part[-14] + part[-12] + '.' + part[-11:]
+                      for part in parts[1:-1]]
+
+        part = parts[-1]
+        block_new += [exp_d_to_e[part[:3]], part[3:]]
+
+    except KeyError:
+        return None
+
+    block = "".join(block_new)
+
+    if zeros > 0:
+        block = re_zero_exp.sub("E+00", block)
+
+    return block, val_updated
+
+
+# fix block of complete nav data lines at once by update_block or line by
+# line by update_record; returns fixed block and number of updated values
+def fix_block(block):
+
+    block_new = update_block(block)
+    if block_new != None:
+        return block_new
+
+    val_updated = 0
+    lines_new = []
+    for line in io.StringIO(block):
+        line_new, val_updated = update_record(line, val_updated)
+        lines_new.append(line_new)
+
+    return "".join(lines_new), val_updated
+
+
+# fix RINEX nav content read from text file 'in_file' like fix_nav, but nav
+# data is read and converted in big blocks; output is the same as from
+# fix_nav; lines of each block are counted by 'meter' (LineMeter, see
+# stage_profiler) if it's given; header and fixed blocks are written also
+# to files of sessions by 'sessions' (session_split.NavSessions) if it's
+# given; returns number of updated values
+def fix_nav_blocks(in_file, out_file, meter=None, sessions=None):
+
+    # preserve original header from RINEX file
+    header = []
+    while True:
+        line = in_file.readline()
+        out_file.write(line)
+        header.append(line)
+        if line == "" or header_end in line:
+            break
+
+    if sessions != None:
+        sessions.add_header(header)
+
+    return fix_nav_data(in_file, out_file, meter, sessions)
+
+
+# fix nav data (without header) read from text file 'in_file' in blocks and
+# write it to 'out_file'; 'meter' and 'sessions' are used as by
+# fix_nav_blocks; returns number of updated values
+def fix_nav_data(in_file, out_file, meter=None, sessions=None):
+
+    # counter of updated values
+    val_updated = 0
+
+    while True:
+        # read block of complete lines
+        block = in_file.read(block_size)
+        if block == "":
+            break
+        if block[-1] != "\n":
+            block += in_file.readline()
+
+        if meter != None:
+            meter.add(block.count("\n"))
+
+        block, updated = fix_block(block)
+        val_updated += updated
+
+        out_file.write(block)
+
+        if sessions != None:
+            sessions.add(block)
+
+    return val_updated
+
+
+#%% Parallel processing of nav data
+#   Big nav files (e.g. merged files of many days and systems) are mapped
+#   into memory and nav data is cut into chunks at starts of records
+#   (lines with non-blank first column). Chunks are fixed by fix_nav_data
+#   in process pool; each worker maps the file and reads its chunk itself,
+#   so only fixed text is passed between processes. Value may get wider
+#   when it's fixed (exponents out of 2 digits), so offsets of chunks in
+#   output are known only when all previous chunks are fixed and chunks
+#   are written in order of input as they are returned.
+
+# number of chunks given to each worker, so workers stay busy when chunks
+# take different time
+chunks_per_worker = 4
+
+# start of nav record: line end followed by non-blank char
+re_record_start = re.compile(rb"\n[^ \r\n]")
+
+
+# return list of (start, end) offsets of at most 'chunks' parts of nav data
+# of 'data' between offsets 'start' and 'end'; parts start at starts of
+# records and aren't smaller than 'block_size', unless there is less data
+def find_chunks(data, start, end, chunks):
+
+    chunks = max(1, min(chunks, (end - start) // block_size))
+    points = [start]
+
+    for item in range(1, chunks):
+
+        target = start + (end - start) * item // chunks
+        if target <= points[-1]:
+            continue
+
+        match = re_record_start.search(data, target, end)
+        if match == None:
+            break
+
+        if match.start() + 1 > points[-1]:
+            points.append(match.start() + 1)
+
+    points.append(end)
+
+    return [(points[item], points[item + 1]) for item in range(len(points) - 1)
+            if points[item] < points[item + 1]]
+
+
+# fix nav data between offsets 'start' and 'end' of nav file 'path'; data is
+# decoded and its lines are split as by text file of serial fixer; returns
+# fixed data, number of updated values and number of lines
+def fix_nav_chunk(path, start, end):
+
+    with open(path, 'rb') as in_file:
+        data = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            chunk = data[start:end]
+        finally:
+            data.close()
+
+    out_file = io.StringIO()
+    val_updated = fix_nav_data(io.TextIOWrapper(io.BytesIO(chunk)), out_file)
+
+    return out_file.getvalue(), val_updated, chunk.count(b'\n')
+
+
+# fix RINEX nav file 'path' like fix_nav_blocks by 'workers' processes and
+# write result to text file 'out_file'; output is the same as from
+# fix_nav_blocks; 'meter' and 'sessions' are used as by fix_nav_blocks;
+# returns number of updated values
+def fix_nav_parallel(path, out_file, workers, meter=None, sessions=None):
+
+    with open(path, 'rb') as in_file:
+        data = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            size = len(data)
+
+            # header ends with line of header end label (or with file)
+            header_size = size
+            pos = data.find(header_end.encode())
+            if pos >= 0:
+                header_size = data.find(b'\n', pos) + 1 or size
+
+            header = io.TextIOWrapper(io.BytesIO(data[:header_size])).readlines()
+            chunks = find_chunks(data, header_size, size, workers * chunks_per_worker)
+        finally:
+            data.close()
+
+    out_file.write("".join(header))
+
+    if sessions != None:
+        sessions.add_header(header)
+
+    val_updated = 0
+
+    if len(chunks) == 0:
+        return val_updated
+
+    # fixer may run in thread next to other stages (see stage_scheduler), so
+    # workers are spawned instead of forked with locks held by other threads
+    context = multiprocessing.get_context('spawn')
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(chunks)),
+                                                mp_context=context) as pool:
+        results = pool.map(fix_nav_chunk, [path] * len(chunks),
+                           [start for start, end in chunks], [end for start, end in chunks])
+
+        for block, updated, lines in results:
+
+            if meter != None:
+                meter.add(lines)
+
+            out_file.write(block)
+            val_updated += updated
+
+            if sessions != None:
+                sessions.add(block)
+
+    return val_updated
+
+
+# fix RINEX nav file stored at 'input_file_path_name' and save it
+# as 'output_file_path_name' (compressed by its extension, see
+# compressed_io); processed lines are counted by 'meter' if it's given;
+# input may be also given as binary file object (e.g. stream of pipe),
+# which is read as text and closed; records are added also to 'sessions'
+# (session_split.NavSessions) if it's given, which are written when caller
+# closes them, and nav file isn't written if 'output_file_path_name' is
+# None; nav file (not stream) is fixed by
+# 'workers' processes if it's greater than 1 (see fix_nav_parallel);
+# returns number of updated values
+def fix_nav_file(input_file_path_name, output_file_path_name, meter=None, sessions=None,
+                 workers=1):
+
+    if output_file_path_name == None:
+        if sessions == None:
+            raise ValueError("Output nav file is required without sessions!")
+        output_file_path_name = os.devnull
+
+    streamed = hasattr(input_file_path_name, 'read')
+
+    # empty files can't be mapped
+    parallel = workers > 1 and streamed == False and \
+        os.path.getsize(input_file_path_name) > 0
+
+    if parallel == True:
+        with compressed_io.open_output(output_file_path_name, text=True) as out_file:
+            val_updated = fix_nav_parallel(input_file_path_name, out_file, workers, meter,
+                                           sessions)
+    else:
+        if streamed == True:
+            in_file = io.TextIOWrapper(input_file_path_name)
+        else:
+            in_file = open(input_file_path_name)
+
+        with in_file:
+            with compressed_io.open_output(output_file_path_name, text=True) as out_file:
+                val_updated = fix_nav_blocks(in_file, out_file, meter, sessions)
+
+    return val_updated
+
+
+if __name__ == "__main__":
+
+    start = time.time()
+
+    #%% Read input arguments
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_file", type=str,
+                        help="input RINEX nav file to check for duplicated epochs. " \
+                            "File path can be absolute or relative.")
+    parser.add_argument("-o", "--output_file", type=str,
+                        help="output RINEX file to save. " \
+                            "File path can be absolute or relative. " \
+                            "If not specified, output file is written to input directory " \
+                            "with name <input_file>_fix.<input_file_extension>")
+    parser.add_argument("--profile", action='store_true',
+                        help="profile fixing by cProfile and tracemalloc; reports are saved " \
+                            "in output directory (see stage_profiler).")
+    parser.add_argument("--sample", type=float, default=0,
+                        help="print rate of processed lines every <SAMPLE> seconds.")
+    parser.add_argument("-s", "--session", type=str,
+                        help="split output into files of sessions of <SESSION> length (e.g. " \
+                            "'1h', '15m', at most a day) by time of clock of records, named " \
+                            "<output_file>_<YYYYMMDD>_<HHMM> (see session_split).")
+    parser.add_argument("--max-open", type=int, default=session_split.default_max_open,
+                        help="number of session files kept open.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes fixing chunks of big nav file, " \
+                            "e.g. number of CPU cores. File is fixed by one process " \
+                            "by default.")
+    args = parser.parse_args()
+
+    input_file_path_name = args.input_file
+    output_file_path_name = args.output_file
+
+    #%% Sanity check for input parameters
+
+    # check validity of input file
+    in_file_path = ""
+    in_file_name = ""
+    in_file_ext = ""
+
+    if input_file_path_name != None:
+
+        if os.path.exists(input_file_path_name) == True:
+
+            # return filename.ext
+            file_name_ext = os.path.basename(input_file_path_name)
+
+            if file_name_ext == '':
+                print("Directory specified instead of file!")
+                print("Exiting!")
+                sys.exit()
+
+            if os.access(input_file_path_name, os.R_OK) == False:
+                print("User don't have access rights to read specified file!")
+                print("Exiting!")
+                sys.exit()
+
+
+            #split filename.ext into filename and ext
+            in_file_name, in_file_ext = os.path.splitext(file_name_ext)
+
+            # get input file directory path by cutting file name from path string
+            in_file_path = input_file_path_name[0:-len(file_name_ext)]
+            # normalize path to remove slash from path
+            in_file_path = os.path.normpath(in_file_path)
+
+
+        elif input_file_path_name == "":
+             print("Missing input file!")
+             print("Exiting!")
+             sys.exit()
+
+        else:
+            print("Can't locate file: " + input_file_path_name)
+            print("Exiting!")
+            sys.exit()
+
+    # check validity of output file
+    output_file_path = ""
+    out_file_name = ""
+
+    if output_file_path_name == None:
+        output_file_path = in_file_path
+        output_file_path_name = os.path.join(output_file_path, in_file_name + "_fix.nav")
+    else:
+        file_name_ext = os.path.basename(output_file_path_name)
+
+        #split filename.ext into filename and ext
+        out_file_name, out_file_ext = os.path.splitext(file_name_ext)
+
+        # get output file directory path by cutting file name from path string
+        output_file_path = output_file_path_name[0:-len(file_name_ext)]
+        # normalize path to remove slash from path
+        output_file_path = os.path.normpath(output_file_path)
+
+    if os.path.exists(output_file_path) == False:
+        # try creating output directory
+        try:
+            os.makedirs(output_file_path)
+        except IOError:
+            print(sys.exc_info()[0])
+            sys.exit()
+
+    #%% Process RINEX nav file
+
+    sessions = None
+    if args.session != None:
+        try:
+            sessions = session_split.NavSessions(output_file_path_name,
+                                                 session_split.parse_length(args.session),
+                                                 args.max_open)
+        except ValueError as e:
+            print(e)
+            print("Exiting!")
+            sys.exit(1)
+
+    profiler = stage_profiler.StageProfiler(
+        output_file_path, os.path.splitext(os.path.basename(output_file_path_name))[0],
+        args.profile)
+
+    with profiler.stage("nav_fix"):
+        with stage_profiler.LineMeter("nav_fix", args.sample) as meter:
+            val_updated = fix_nav_file(input_file_path_name,
+                                       None if sessions != None else output_file_path_name,
+                                       meter, sessions, args.jobs)
+            if sessions != None:
+                sessions.close()
+
+    #%% statistics informations
+
+    print("Number of updated values: " + str(val_updated))
+
+    stop = time.time()
+    delta = stop - start
+    print("Processing time: %.2f s\n" % delta)
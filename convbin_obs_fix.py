@@ -1,215 +1,639 @@
 """
   @file convbin_obs_fix.py
   @brief Routines to clean duplicate epochs in rinex observation file created by convbin
- 
+
   @author Michal Zygmunt
- 
+
   @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
- 
+
   @license See LICENSE file for license details.
- 
+
   @todo none
   @bug none
- 
+
   $Date: 2021-11-24 14:19:11 +0200 (sr., 24 lis 2021) $
   $Revision: 2059 $
   $LastChangedBy: mzygmunt $
 """
 
 import argparse
+import heapq
+import itertools
+import mmap
 import os.path
 import sys
 import time
 
-start = time.time()
-
-#%% Read input arguments
-
-parser = argparse.ArgumentParser()
-parser.add_argument("input_file", type=str,
-                    help="input RINEX file to check for duplicated epochs. " \
-                        "File path can be absolute or relative.")
-parser.add_argument("-o", "--output_file", type=str,
-                    help="output RINEX file to save. " \
-                        "File path can be absolute or relative. " \
-                        "If not specified, output file is written to input directory " \
-                        "with name <input_file>_fix.<input_file_extension>")
-args = parser.parse_args()
-
-input_file_path_name = args.input_file
-output_file_path_name = args.output_file
-
-#%% Sanity check for input parameters    
-
-# check validity of input file
-in_file_path = ""
-in_file_name = ""
-in_file_ext = ""
-
-if input_file_path_name != None:
-    
-    if os.path.exists(input_file_path_name) == True:
-        
-        # return filename.ext
-        file_name_ext = os.path.basename(input_file_path_name)
-        
-        if file_name_ext == '':
-            print("Directory specified instead of file!")
-            print("Exiting!")
-            sys.exit()
-            
-        if os.access(input_file_path_name, os.R_OK) == False:
-            print("User don't have access rights to read specified file!")
-            print("Exiting!")
-            sys.exit()
-            
-        
-        #split filename.ext into filename and ext
-        in_file_name, in_file_ext = os.path.splitext(file_name_ext)
-        
-        # get input file directory path by cutting file name from path string 
-        in_file_path = input_file_path_name[0:-len(file_name_ext)]
-        # normalize path to remove slash from path
-        in_file_path = os.path.normpath(in_file_path)
-        
-        
-    elif input_file_path_name == "":
-         print("Missing input file!")
-         print("Exiting!")
-         sys.exit()
-    
-    else:
-        print("Can't locate file: " + input_file_path_name)
-        print("Exiting!")
-        sys.exit()
-
-# check validity of output file
-output_file_path = ""
-out_file_name = ""
-
-if output_file_path_name == None:
-    output_file_path = in_file_path
-    output_file_path_name = os.path.join(output_file_path, in_file_name + "_fix.obs")
-else:
-    file_name_ext = os.path.basename(output_file_path_name)
-    
-    #split filename.ext into filename and ext
-    out_file_name, out_file_ext = os.path.splitext(file_name_ext)
-    
-    # get output file directory path by cutting file name from path string 
-    output_file_path = output_file_path_name[0:-len(file_name_ext)]
-    # normalize path to remove slash from path
-    output_file_path = os.path.normpath(output_file_path)
-
-if os.path.exists(output_file_path) == False:
-    # try creating output directory
-    try:
-        os.makedirs(output_file_path)
-    except IOError:
-        print(sys.exc_type)
-        sys.exit()
-    
-out_file = open(output_file_path_name, "w")
-    
+import compressed_io
+import obs_index
+import obs_qc
+import obs_store
+import session_split
+import stage_profiler
+
 #%% Process RINEX obs file in scope of:
 #   - drop duplicated observations
 #   - removing duplicated epoch identifier
 #   - fixing satellite number stored in epoch row
 
-end_of_header = False
-epoch_is_set = False
+# size of block read from input at once and number of lines buffered
+# before writing them to output
+block_size = 8 * 1024 * 1024
+buffer_lines = 64 * 1024
+
+
+# split bytes-like object (bytes, mmap) or binary file into lines with
+# line ending kept; input is cut into big blocks to avoid per-line reads
+# and CRLF line endings are converted to LF, as text mode reading does;
+# number of lines of each block is added to 'meter' (LineMeter) if it's given
+def iter_lines(source, meter=None):
+
+    if hasattr(source, 'read'):
+        blocks = iter(lambda: source.read(block_size), b'')
+    else:
+        blocks = (source[pos:pos + block_size]
+                  for pos in range(0, len(source), block_size))
+
+    rest = b''
+
+    for block in blocks:
+        block = rest + block
+        if b'\r' in block:
+            block = block.replace(b'\r\n', b'\n')
+
+        lines = block.splitlines(True)
+
+        if meter != None:
+            meter.add(len(lines))
+
+        # last line can be continued in next block
+        rest = b''
+        if lines and not lines[-1].endswith(b'\n'):
+            rest = lines.pop()
+
+        for line in lines:
+            yield line
+
+    if rest:
+        yield rest
+
+
+# return epoch row 'epoch' (bytes) with satellite counter set to 'sats'
+def epoch_row(epoch, sats):
+
+    # extract date / time information from epoch
+    tokens = epoch.split()
+    return (b"> %s %s %s %s %s %s %2d %2d                     \n" %
+            (tokens[1], tokens[2], tokens[3], # yyyy mm dd
+             tokens[4], tokens[5], tokens[6], # hh mm ss.sssssss
+             int(tokens[7]), sats)) # epoch_flag sats
+
+
+# fix RINEX obs content given as bytes-like object (bytes, mmap) or binary
+# file and write result to binary 'out_file'; observation rows are never
+# decoded, duplicates are found by hash set and complete epochs are
+# written in big batches (see benchmark.fix_obs_baseline for original
+# line based algorithm with the same output); written
+# epochs are added to 'index' (obs_index.IndexWriter) if it's given;
+# numbers of written epochs and satellite rows are stored in 'stats'
+# dictionary if it's given; processed lines are counted by 'meter'
+# (stage_profiler.LineMeter) if it's given; header and written epochs are
+# added to 'store' (obs_store.ObsStore), 'sessions'
+# (session_split.ObsSessions) and 'qc' (obs_qc.ObsQc) if they're given;
+# returns number of removed duplicated lines
+def fix_obs_bytes(source, out_file, index=None, stats=None, meter=None, store=None,
+                  sessions=None, qc=None):
+
+    # header and written epochs are passed to all given collectors
+    sinks = [sink for sink in (store, sessions, qc) if sink != None]
+
+    lines = iter_lines(source, meter)
+
+    out_buffer = []
+
+    # preserve original header from RINEX file
+    epoch_current = b""
+
+    for line in lines:
+        if line[:1] == b'>':
+            epoch_current = line
+            break
+        out_buffer.append(line)
+
+    for sink in sinks:
+        sink.add_header(out_buffer)
+
+    # offset of next written line, tracked only for index
+    out_pos = sum(map(len, out_buffer)) if index != None else 0
+
+    epoch_prev = b""
 
-output_lines = []
-temp_lines = []
-duplicated_lines = 0
+    temp_lines = []
+    temp_lines_set = set()
+    duplicated_lines = 0
 
-epoch_current = ""
-epoch_prev = ""
+    epochs = 0
+    satellites = 0
 
-with open(input_file_path_name) as lines:
     for line in lines:
-        
-        # preserve original header from RINEX file
-        if line[0] == '>':
-            end_of_header = True
-        
-        if end_of_header == False:
-            out_file.write(line)
-        
-        # process observables
-        if end_of_header == True:
-            
-            if line[0] == '>':
-                if epoch_is_set == False:
-                    epoch_current = line
-                    epoch_is_set = True
+
+        if line[:1] != b'>':
+            # drop observation rows already stored for this epoch
+            if line in temp_lines_set:
+                duplicated_lines += 1
+            else:
+                temp_lines.append(line)
+                temp_lines_set.add(line)
+            continue
+
+        epoch_prev = epoch_current
+        epoch_current = line
+
+        # 2:29 means 'yyyy mm dd hh mm ss.sssssss' of epoch date/time id
+        if epoch_prev[2:29] != epoch_current[2:29]:
+
+            sats = len(temp_lines)
+
+            if sats > 0:
+
+                # fix satellite counter for previous epoch
+                row = epoch_row(epoch_prev, sats)
+                out_buffer.append(row)
+                out_buffer.extend(temp_lines)
+
+                epochs += 1
+                satellites += sats
+
+                if index != None:
+                    index.add(row, out_pos, sats)
+                    out_pos += len(row) + sum(map(len, temp_lines))
+
+                for sink in sinks:
+                    sink.add(row, temp_lines)
+
+                temp_lines = []
+                temp_lines_set.clear()
+
+                # write whole epochs in batches
+                if len(out_buffer) >= buffer_lines:
+                    out_file.write(b"".join(out_buffer))
+                    out_buffer = []
+
+        else: # date and time of epochs is equal
+
+            duplicated_lines += 1
+
+            # check if flags match and generate warning if they don't;
+            # epoch flag is stored in column 32 of epoch row
+            if epoch_prev[29:32] != epoch_current[29:32]:
+                print("WARNING: flags of duplicated epochs are different!")
+                print(epoch_prev.decode())
+                print(epoch_current.decode())
+
+    # end of file reached; save content of last temp results
+    out_buffer.append(epoch_current)
+    out_buffer.extend(temp_lines)
+    out_file.write(b"".join(out_buffer))
+
+    if index != None and epoch_current != b"":
+        index.add(epoch_current, out_pos, len(temp_lines))
+
+    if epoch_current != b"":
+        for sink in sinks:
+            sink.add(epoch_current, temp_lines)
+
+    if stats != None:
+        if epoch_current != b"":
+            epochs += 1
+            satellites += len(temp_lines)
+        stats["epochs"] = epochs
+        stats["satellites"] = satellites
+
+    return duplicated_lines
+
+
+# fix RINEX obs content like fix_obs_bytes, but keep last 'window' epochs
+# in memory, so also epochs with equal date and time which are not
+# consecutive (e.g. interleaved blocks of different constellations) are
+# merged; epochs are written sorted by time when they leave the window and
+# every epoch, including the last one, gets its satellite counter fixed;
+# written epochs are added to 'index', 'store', 'sessions' and 'qc' and counted
+# in 'stats' and lines in 'meter' as by fix_obs_bytes; returns number of
+# removed duplicated lines and number of merges of epochs which were not
+# consecutive
+def fix_obs_window(source, out_file, window, index=None, stats=None, meter=None, store=None,
+                   sessions=None, qc=None):
+
+    # header and written epochs are passed to all given collectors
+    sinks = [sink for sink in (store, sessions, qc) if sink != None]
+
+    lines = iter_lines(source, meter)
+
+    out_buffer = []
+
+    # preserve original header from RINEX file
+    for line in lines:
+        if line[:1] == b'>':
+            lines = itertools.chain([line], lines)
+            break
+        out_buffer.append(line)
+
+    for sink in sinks:
+        sink.add_header(out_buffer)
+
+    # offset of next written line, tracked only for index
+    out_pos = sum(map(len, out_buffer)) if index != None else 0
+
+    # epochs kept in window: date/time id -> [epoch row, rows, set of rows],
+    # and heap of their date/time ids to find the oldest one
+    epochs = {}
+    epoch_times = []
+
+    epoch_time_last = None
+    epoch_time_written = b""
+
+    temp_lines = []
+    temp_lines_set = set()
+
+    duplicated_lines = 0
+    out_of_order_merges = 0
+    late_epochs = 0
+
+    epochs_written = 0
+    satellites = 0
+
+    for line in lines:
+
+        if line[:1] != b'>':
+            # drop observation rows already stored for this epoch
+            if line in temp_lines_set:
+                duplicated_lines += 1
+            else:
+                temp_lines.append(line)
+                temp_lines_set.add(line)
+            continue
+
+        # 2:29 means 'yyyy mm dd hh mm ss.sssssss' of epoch date/time id;
+        # fixed width of this field keeps ids sortable as strings
+        epoch_time = line[2:29]
+        epoch = epochs.get(epoch_time)
+
+        if epoch != None:
+
+            duplicated_lines += 1
+
+            if epoch_time != epoch_time_last:
+                out_of_order_merges += 1
+
+            # epoch flag is stored in column 32 of epoch row
+            if epoch[0][29:32] != line[29:32]:
+                print("WARNING: flags of duplicated epochs are different!")
+                print(epoch[0].decode())
+                print(line.decode())
+
+        else:
+            # make room for new epoch by writing the oldest one
+            if len(epochs) >= window:
+                epoch_time_oldest = heapq.heappop(epoch_times)
+                epoch_oldest = epochs.pop(epoch_time_oldest)
+
+                # epoch older than already written one arrived too late
+                # to be merged or sorted
+                if epoch_time_oldest < epoch_time_written:
+                    late_epochs += 1
                 else:
-                    epoch_prev = epoch_current
-                    epoch_current = line
-            
-                # check if consecutive epochs have different time
-                # 2:29 means 'yyyy mm dd hh mm ss.sssssss' of epoch date/time id
-                if epoch_prev[2:29] != epoch_current[2:29]:
-                    
-                    # fix satellite counter for this epoch
-                    sats = len(temp_lines)
-                    
-                    if sats > 0:
-                    
-                        # extract date / time information from prev_epoch
-                        tokens = epoch_prev.split()
-                        line = ("> %s %s %s %s %s %s %2d %2d                     \n" %
-                                (tokens[1], tokens[2], tokens[3], # yyyy mm dd
-                                 tokens[4], tokens[5], tokens[6], # hh mm ss.sssssss
-                                 int(tokens[7]), sats)) # epoch_flag sats
-                        
-                        out_file.write(line)
-                        
-                        for item in range(sats):
-                            out_file.write(temp_lines[item])
-                        temp_lines = []
-                
-                else: # epoch_prev[2:29] == epoch_current[2:29] / date and time is equal
-                
-                    # save row of duplicated epoch
-                    duplicated_lines += 1
-                    
-                    # split epoch into values and get epochs flag
-                    tokens_prev = line.split()
-                    tokens_current = line.split()
-                    epoch_flag_prev = tokens_prev[7]
-                    epoch_flag_current = tokens_current[7]
-                    
-                    # check if flags match and generate warning if they don't
-                    if epoch_flag_prev != epoch_flag_current:
-                        print("WARNING: flags of duplicated epochs are different!")
-                        print(epoch_prev)
-                        print(epoch_current)
-            
-            else: # line[0] != '>'
-                
-                # check if read line is not already stored in temp_lines
-                if line not in temp_lines:
-                    # append observations registerred on this epoch
-                    # to temporary list
-                    temp_lines.append(line)
+                    epoch_time_written = epoch_time_oldest
+
+                sats = len(epoch_oldest[1])
+                if sats > 0:
+                    row = epoch_row(epoch_oldest[0], sats)
+                    out_buffer.append(row)
+                    out_buffer.extend(epoch_oldest[1])
+
+                    epochs_written += 1
+                    satellites += sats
+
+                    if index != None:
+                        index.add(row, out_pos, sats)
+                        out_pos += len(row) + sum(map(len, epoch_oldest[1]))
+
+                    for sink in sinks:
+                        sink.add(row, epoch_oldest[1])
+
+                # write whole epochs in batches
+                if len(out_buffer) >= buffer_lines:
+                    out_file.write(b"".join(out_buffer))
+                    out_buffer = []
+
+            epoch = [line, [], set()]
+            epochs[epoch_time] = epoch
+            heapq.heappush(epoch_times, epoch_time)
+
+        epoch_time_last = epoch_time
+        temp_lines = epoch[1]
+        temp_lines_set = epoch[2]
+
+    # end of file reached; save all epochs left in window
+    for epoch_time in sorted(epochs):
+        epoch = epochs[epoch_time]
+
+        if epoch_time < epoch_time_written:
+            late_epochs += 1
+
+        sats = len(epoch[1])
+        if sats > 0:
+            row = epoch_row(epoch[0], sats)
+            out_buffer.append(row)
+            out_buffer.extend(epoch[1])
+
+            epochs_written += 1
+            satellites += sats
+
+            if index != None:
+                index.add(row, out_pos, sats)
+                out_pos += len(row) + sum(map(len, epoch[1]))
+
+            for sink in sinks:
+                sink.add(row, epoch[1])
+
+    out_file.write(b"".join(out_buffer))
+
+    if late_epochs > 0:
+        print("WARNING: %d epochs arrived after window was written and are out of order!" %
+              late_epochs)
+
+    if stats != None:
+        stats["epochs"] = epochs_written
+        stats["satellites"] = satellites
+
+    return duplicated_lines, out_of_order_merges
+
+
+# fix RINEX obs file stored at 'input_file_path_name' and save it
+# as 'output_file_path_name' (compressed or in Compact RINEX format by its
+# extension, see compressed_io); input file is mapped into memory; if 'window'
+# is greater than 0, fix_obs_window is used instead of fix_obs_bytes; epoch
+# index (see obs_index) of uncompressed output is saved as 'index_path' if
+# it's given; numbers of written epochs and satellite rows are stored in
+# 'stats' dictionary if it's given and processed lines by 'meter';
+# observations are added to 'store' (obs_store.ObsStore) and quality
+# statistics are collected by 'qc' (obs_qc.ObsQc) if they're given;
+# epochs are written also to files of sessions by 'sessions'
+# (session_split.ObsSessions) if it's given, which are closed at the end;
+# obs file isn't written if 'output_file_path_name' is None; input may be
+# also given as binary file object (e.g. stream of pipe), which is read in
+# blocks and closed; returns number of removed duplicated lines and number
+# of out of order merges of epochs
+def fix_obs_file(input_file_path_name, output_file_path_name, window=0, index_path=None,
+                 stats=None, meter=None, store=None, sessions=None, qc=None):
+
+    if output_file_path_name == None:
+        if (store == None and sessions == None and qc == None) or index_path != None:
+            raise ValueError("Output obs file is required without store, sessions or QC " \
+                             "or with index!")
+        output_file_path_name = os.devnull
+
+    index = None
+    if index_path != None:
+        if compressed_io.split_compression(output_file_path_name)[1] != "" or \
+           os.path.splitext(output_file_path_name)[1] == '.crx':
+            raise ValueError("Index can be written only for uncompressed obs file!")
+        index = obs_index.IndexWriter(index_path)
+
+    streamed = hasattr(input_file_path_name, 'read')
+
+    try:
+        if streamed == True:
+            in_file = input_file_path_name
+        else:
+            in_file = open(input_file_path_name, "rb")
+
+        with in_file:
+            with compressed_io.open_output(output_file_path_name) as out_file:
+
+                # empty files and streams can't be mapped
+                if streamed == True or os.path.getsize(input_file_path_name) == 0:
+                    data = in_file
                 else:
-                    duplicated_lines += 1
-                
+                    data = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+                try:
+                    if window > 0:
+                        duplicated_lines, out_of_order_merges = \
+                            fix_obs_window(data, out_file, window, index, stats, meter, store,
+                                           sessions, qc)
+                    else:
+                        duplicated_lines = fix_obs_bytes(data, out_file, index, stats, meter,
+                                                         store, sessions, qc)
+                        out_of_order_merges = 0
+                finally:
+                    data.close()
+                    if sessions != None:
+                        sessions.close()
+
+    except BaseException:
+        if index != None:
+            index.discard()
+        raise
+
+    if index != None:
+        index.close(output_file_path_name)
+
+    return duplicated_lines, out_of_order_merges
+
+
+if __name__ == "__main__":
+
+    start = time.time()
+
+    #%% Read input arguments
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_file", type=str,
+                        help="input RINEX file to check for duplicated epochs. " \
+                            "File path can be absolute or relative.")
+    parser.add_argument("-o", "--output_file", type=str,
+                        help="output RINEX file to save. " \
+                            "File path can be absolute or relative. " \
+                            "If not specified, output file is written to input directory " \
+                            "with name <input_file>_fix.<input_file_extension>")
+    parser.add_argument("-w", "--window", type=int, default=0,
+                        help="number of recent epochs kept in memory to merge " \
+                            "duplicated epochs which are not consecutive. " \
+                            "If not specified, only consecutive epochs are merged.")
+    parser.add_argument("-i", "--index", action='store_true',
+                        help="save epoch index of output file as <output_file>.idx " \
+                            "(see obs_index).")
+    parser.add_argument("--profile", action='store_true',
+                        help="profile fixing by cProfile and tracemalloc; reports are saved " \
+                            "in output directory (see stage_profiler).")
+    parser.add_argument("--sample", type=float, default=0,
+                        help="print rate of processed lines every <SAMPLE> seconds.")
+    parser.add_argument("--store", type=str,
+                        help="save observations as NumPy arrays in <STORE>.npz or " \
+                            "<STORE>.parquet file (see obs_store).")
+    parser.add_argument("--store-only", action='store_true',
+                        help="save only observation store, without output RINEX file.")
+    parser.add_argument("-s", "--session", type=str,
+                        help="split output into files of sessions of <SESSION> length (e.g. " \
+                            "'1h', '15m', at most a day) named <output_file>_<YYYYMMDD>_<HHMM> " \
+                            "(see session_split).")
+    parser.add_argument("--max-open", type=int, default=session_split.default_max_open,
+                        help="number of session files kept open.")
+    parser.add_argument("--qc", action='store_true',
+                        help="save quality statistics of satellites and signals as " \
+                            "<output_file>_qc.json and <output_file>_qc.csv (see obs_qc).")
+    args = parser.parse_args()
+
+    input_file_path_name = args.input_file
+    output_file_path_name = args.output_file
 
-# end of file reached; save content of last temp results
-out_file.write(epoch_current)
-                    
-for item in range(0, len(temp_lines)):
-    out_file.write(temp_lines[item])
-del temp_lines
+    #%% Sanity check for input parameters
+
+    # check validity of input file
+    in_file_path = ""
+    in_file_name = ""
+    in_file_ext = ""
+
+    if input_file_path_name != None:
+
+        if os.path.exists(input_file_path_name) == True:
+
+            # return filename.ext
+            file_name_ext = os.path.basename(input_file_path_name)
+
+            if file_name_ext == '':
+                print("Directory specified instead of file!")
+                print("Exiting!")
+                sys.exit()
+
+            if os.access(input_file_path_name, os.R_OK) == False:
+                print("User don't have access rights to read specified file!")
+                print("Exiting!")
+                sys.exit()
+
+
+            #split filename.ext into filename and ext
+            in_file_name, in_file_ext = os.path.splitext(file_name_ext)
+
+            # get input file directory path by cutting file name from path string
+            in_file_path = input_file_path_name[0:-len(file_name_ext)]
+            # normalize path to remove slash from path
+            in_file_path = os.path.normpath(in_file_path)
+
+
+        elif input_file_path_name == "":
+             print("Missing input file!")
+             print("Exiting!")
+             sys.exit()
+
+        else:
+            print("Can't locate file: " + input_file_path_name)
+            print("Exiting!")
+            sys.exit()
+
+    # check validity of output file
+    output_file_path = ""
+    out_file_name = ""
+
+    if output_file_path_name == None:
+        output_file_path = in_file_path
+        output_file_path_name = os.path.join(output_file_path, in_file_name + "_fix.obs")
+    else:
+        file_name_ext = os.path.basename(output_file_path_name)
+
+        #split filename.ext into filename and ext
+        out_file_name, out_file_ext = os.path.splitext(file_name_ext)
+
+        # get output file directory path by cutting file name from path string
+        output_file_path = output_file_path_name[0:-len(file_name_ext)]
+        # normalize path to remove slash from path
+        output_file_path = os.path.normpath(output_file_path)
+
+    if os.path.exists(output_file_path) == False:
+        # try creating output directory
+        try:
+            os.makedirs(output_file_path)
+        except IOError:
+            print(sys.exc_info()[0])
+            sys.exit()
+
+    #%% Process RINEX obs file
+
+    if args.store_only == True and (args.store == None or args.index == True):
+        print("Store file is required and index can't be saved without output RINEX file!")
+        print("Exiting!")
+        sys.exit(1)
+
+    store = None
+    if args.store != None:
+        try:
+            obs_store.check_store(args.store)
+            store = obs_store.ObsStore()
+        except (ValueError, RuntimeError) as e:
+            print(e)
+            print("Exiting!")
+            sys.exit(1)
+
+    qc = None
+    if args.qc == True:
+        try:
+            qc = obs_qc.ObsQc()
+        except RuntimeError as e:
+            print(e)
+            print("Exiting!")
+            sys.exit(1)
+
+    index_path = None
+    if args.index == True:
+        index_path = output_file_path_name + obs_index.index_extension
+
+    sessions = None
+    if args.session != None:
+        if args.index == True or args.store_only == True:
+            print("Index and store only can't be used with sessions!")
+            print("Exiting!")
+            sys.exit(1)
+        try:
+            sessions = session_split.ObsSessions(output_file_path_name,
+                                                 session_split.parse_length(args.session),
+                                                 args.max_open)
+        except ValueError as e:
+            print(e)
+            print("Exiting!")
+            sys.exit(1)
+
+    profiler = stage_profiler.StageProfiler(
+        output_file_path, os.path.splitext(os.path.basename(output_file_path_name))[0],
+        args.profile)
+
+    with profiler.stage("obs_fix"):
+        with stage_profiler.LineMeter("obs_fix", args.sample) as meter:
+            duplicated_lines, out_of_order_merges = \
+                fix_obs_file(input_file_path_name,
+                             None if args.store_only == True or sessions != None
+                             else output_file_path_name,
+                             args.window, index_path, meter=meter, store=store,
+                             sessions=sessions, qc=qc)
+
+    if qc != None:
+        obs_qc.print_summary(qc.save(*obs_qc.qc_paths(output_file_path_name)))
+
+    if store != None:
+        try:
+            store.save(args.store)
+        except (ValueError, RuntimeError) as e:
+            print(e)
+            print("Exiting!")
+            sys.exit(1)
 
-out_file.close()
+    #%% statistics informations
 
-#%% statistics informations 
+    print("Number of duplicated lines removed: " + str(duplicated_lines))
 
-print("Number of duplicated lines removed: " + str(duplicated_lines))
+    if args.window > 0:
+        print("Number of out of order merges: " + str(out_of_order_merges))
 
-stop = time.time()
-delta = stop - start
-print("Processing time: %.2f s\n" % delta)
+    stop = time.time()
+    delta = stop - start
+    print("Processing time: %.2f s\n" % delta)
@@ -0,0 +1,322 @@
+"""
+  @file conversion_cache.py
+  @brief Routines to store converted RINEX files in cache addressed by content of inputs
+
+  @author Michal Zygmunt
+
+  @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
+
+  @license See LICENSE file for license details.
+
+  @todo none
+  @bug none
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import compressed_io
+
+#%% Cache of conversions
+#   Entry key is SHA-256 digest of input file content, conversion arguments
+#   and content of files of conversion pipeline ('convbin' binary, fixers,
+#   native decoder), so any change of them makes new entries. Entry is
+#   directory with fixed obs and nav files, prepared in temporary directory
+#   and published by rename, so other processes never see incomplete entry.
+#   Modification time of entry directory is time of its last use, which is
+#   used by LRU eviction. Hits and misses are appended to stats file.
+
+# directories and files of cache
+entries_dir = "entries"
+temp_dir = "tmp"
+stats_file = "stats.log"
+
+# default limits of cache applied after each stored entry
+default_max_size = 10 * 1024 * 1024 * 1024
+default_max_age = 90 * 24 * 3600
+
+# size of blocks of hashed files
+block_size = 1024 * 1024
+
+# digests of pipeline files computed by this process
+code_digests = {}
+
+
+#%% Keys
+
+# return SHA-256 digest of file 'path'
+def file_digest(path):
+
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as in_file:
+        while True:
+            block = in_file.read(block_size)
+            if not block:
+                break
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+# return key of conversion of 'in_file_path_name' with arguments 'params'
+# (dictionary) by pipeline made of files 'code_paths'
+def cache_key(in_file_path_name, params, code_paths):
+
+    code = []
+    for path in code_paths:
+        if path not in code_digests:
+            code_digests[path] = file_digest(path)
+        code.append([os.path.basename(path), code_digests[path]])
+
+    content = {"input": file_digest(in_file_path_name), "params": params, "code": code}
+
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+# return path of entry 'key' in cache 'cache_dir'
+def entry_path(cache_dir, key):
+    return os.path.join(cache_dir, entries_dir, key)
+
+
+#%% Entries
+
+# append 'event' (hit or miss) to stats file of cache 'cache_dir'; line is
+# written by single append, so concurrent processes don't mix lines
+def record(cache_dir, event):
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(os.path.join(cache_dir, stats_file), 'a') as out_file:
+            out_file.write("%d %s\n" % (int(time.time()), event))
+    except EnvironmentError:
+        pass
+
+
+# copy RINEX file 'src_path' to 'dst_path'; 'log: ' comment of header is
+# replaced by 'log_name', as entry may be created for other file (header of
+# compressed files is copied as it is)
+def copy_rinex(src_path, dst_path, log_name):
+
+    if os.path.splitext(dst_path)[1] in compressed_io.compressed_extensions:
+        shutil.copyfile(src_path, dst_path)
+        return
+
+    with open(src_path, newline='') as src_file, open(dst_path, 'w', newline='') as dst_file:
+
+        for line in src_file:
+            if line.startswith("log: ") and line[60:].startswith("COMMENT"):
+                line = "%-60.60s%-20s%s" % ("log: " + log_name, "COMMENT",
+                                            line[len(line.rstrip('\r\n')):])
+            dst_file.write(line)
+            if line[60:].startswith("END OF HEADER"):
+                break
+
+        shutil.copyfileobj(src_file, dst_file, block_size)
+
+
+# copy files of entry 'key' to 'obs_path' and 'nav_path'; returns False if
+# there is no such entry; files are copied to temporary directory next to
+# 'obs_path' and replace destination files only when both are copied, so
+# failed fetch leaves no partial files
+def fetch(cache_dir, key, obs_path, nav_path, log_name):
+
+    path = entry_path(cache_dir, key)
+    temp_path = None
+
+    try:
+        temp_path = tempfile.mkdtemp(prefix='.cache_', dir=os.path.dirname(obs_path) or '.')
+        temp_paths = [os.path.join(temp_path, os.path.basename(out_path))
+                      for out_path in (obs_path, nav_path)]
+
+        copy_rinex(os.path.join(path, "obs"), temp_paths[0], log_name)
+        copy_rinex(os.path.join(path, "nav"), temp_paths[1], log_name)
+
+        os.replace(temp_paths[0], obs_path)
+        os.replace(temp_paths[1], nav_path)
+        os.utime(path, None)
+
+    except EnvironmentError:
+        # missing entry or entry evicted during copy
+        record(cache_dir, "miss")
+        return False
+
+    finally:
+        if temp_path != None:
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+    record(cache_dir, "hit")
+    return True
+
+
+# store files 'obs_path' and 'nav_path' as entry 'key'; entry which is
+# already published by other process is kept
+def store(cache_dir, key, obs_path, nav_path):
+
+    for name in [entries_dir, temp_dir]:
+        os.makedirs(os.path.join(cache_dir, name), exist_ok=True)
+
+    temp_path = tempfile.mkdtemp(prefix=key[:16] + "_", dir=os.path.join(cache_dir, temp_dir))
+
+    try:
+        shutil.copyfile(obs_path, os.path.join(temp_path, "obs"))
+        shutil.copyfile(nav_path, os.path.join(temp_path, "nav"))
+
+        with open(os.path.join(temp_path, "meta.json"), 'w') as meta_file:
+            json.dump({"key": key, "created": time.time(),
+                       "obs": os.path.basename(obs_path), "nav": os.path.basename(nav_path)},
+                      meta_file)
+
+        os.rename(temp_path, entry_path(cache_dir, key))
+
+    except OSError:
+        if os.path.isdir(entry_path(cache_dir, key)) == False:
+            raise
+
+    finally:
+        shutil.rmtree(temp_path, ignore_errors=True)
+
+
+# remove entry directory 'path'; entry is renamed first, so it disappears
+# from cache at once
+def remove_entry(cache_dir, path):
+
+    temp_path = os.path.join(cache_dir, temp_dir, os.path.basename(path) + "_evicted")
+
+    try:
+        os.rename(path, temp_path)
+    except OSError:
+        return False
+
+    shutil.rmtree(temp_path, ignore_errors=True)
+    return True
+
+
+# return list of entries of cache 'cache_dir' as (last use time, size,
+# path), sorted from least recently used
+def list_entries(cache_dir):
+
+    entries = []
+    root = os.path.join(cache_dir, entries_dir)
+
+    if os.path.isdir(root) == False:
+        return entries
+
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        try:
+            size = sum([os.path.getsize(os.path.join(path, item)) for item in os.listdir(path)])
+            entries.append((os.path.getmtime(path), size, path))
+        except OSError:
+            continue
+
+    return sorted(entries)
+
+
+# remove entries not used for 'max_age' seconds, then least recently used
+# entries until cache size is not bigger than 'max_size' bytes; returns
+# number of removed entries and number of freed bytes
+def evict(cache_dir, max_size=default_max_size, max_age=default_max_age):
+
+    entries = list_entries(cache_dir)
+    total_size = sum([entry[1] for entry in entries])
+    now = time.time()
+
+    removed = 0
+    freed = 0
+
+    for mtime, size, path in entries:
+
+        if (max_age == None or now - mtime <= max_age) and \
+           (max_size == None or total_size <= max_size):
+            continue
+
+        if remove_entry(cache_dir, path):
+            removed += 1
+            freed += size
+            total_size -= size
+
+    return removed, freed
+
+
+# return statistics of cache 'cache_dir' as dictionary
+def cache_stats(cache_dir):
+
+    stats = {"hits": 0, "misses": 0, "entries": 0, "size": 0}
+
+    try:
+        with open(os.path.join(cache_dir, stats_file)) as in_file:
+            for line in in_file:
+                event = line.split()[-1:]
+                if event == ["hit"]:
+                    stats["hits"] += 1
+                elif event == ["miss"]:
+                    stats["misses"] += 1
+    except EnvironmentError:
+        pass
+
+    entries = list_entries(cache_dir)
+    stats["entries"] = len(entries)
+    stats["size"] = sum([entry[1] for entry in entries])
+
+    return stats
+
+
+# print statistics returned by cache_stats
+def print_stats(stats):
+
+    lookups = stats["hits"] + stats["misses"]
+    ratio = 100.0 * stats["hits"] / lookups if lookups > 0 else 0.0
+
+    print("Number of cache hits: " + str(stats["hits"]))
+    print("Number of cache misses: " + str(stats["misses"]))
+    print("Hit ratio: %.1f %%" % ratio)
+    print("Number of entries: " + str(stats["entries"]))
+    print("Size of entries: %.1f MB" % (stats["size"] / (1024.0 * 1024.0)))
+
+
+if __name__ == "__main__":
+
+    start = time.time()
+
+    #%% Read input arguments
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cache_dir", type=str,
+                        help="cache <directory> given to rtcm2rinex.py or batch_convert.py.")
+    parser.add_argument("command", type=str, choices=['stats', 'evict', 'clear'],
+                        help="print statistics, evict old entries or remove all entries.")
+    parser.add_argument("--max-size", type=float, default=default_max_size / (1024.0 * 1024.0),
+                        help="maximum size of cache in MB kept by 'evict'.")
+    parser.add_argument("--max-age", type=float, default=default_max_age / (24.0 * 3600.0),
+                        help="maximum number of days since last use kept by 'evict'.")
+    args = parser.parse_args()
+
+    if os.path.isdir(args.cache_dir) == False:
+        print("Can't locate cache directory: " + args.cache_dir)
+        print("Exiting!")
+        sys.exit(1)
+
+    #%% Run command
+
+    if args.command == 'evict':
+        removed, freed = evict(args.cache_dir, args.max_size * 1024 * 1024,
+                               args.max_age * 24 * 3600)
+        print("Number of removed entries: %d (%.1f MB)" % (removed, freed / (1024.0 * 1024.0)))
+
+    elif args.command == 'clear':
+        removed, freed = evict(args.cache_dir, 0, 0)
+        print("Number of removed entries: %d (%.1f MB)" % (removed, freed / (1024.0 * 1024.0)))
+
+    else:
+        print_stats(cache_stats(args.cache_dir))
+
+    stop = time.time()
+    delta = stop - start
+    print("Processing time: %.2f s\n" % delta)
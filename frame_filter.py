@@ -0,0 +1,294 @@
+"""
+  @file frame_filter.py
+  @brief Routines to select RTCM 3 frames by time window, constellation and message type
+
+  @author Michal Zygmunt
+
+  @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
+
+  @license See LICENSE file for license details.
+
+  @todo none
+  @bug none
+"""
+
+import argparse
+import mmap
+import os.path
+import sys
+import time
+
+import obs_index
+import rtcm3_decoder
+
+#%% Frame filter
+#   Frames are selected before conversion, so decoder and fixers never see
+#   skipped data. Message type is read from the first 12 bits of payload
+#   and epoch time of observation messages from their header, without
+#   decoding the rest of message. Observation frames are kept if their
+#   epoch is inside time window [start, stop); ephemeris frames are kept
+#   from 'nav_margin' before start to stop, so ephemerides valid at start
+#   of window are converted too; other frames (station position, antenna
+#   descriptors) are kept in whole log.
+
+# legacy observation and ephemeris message number -> system
+message_systems = {1001: 'G', 1002: 'G', 1003: 'G', 1004: 'G',
+                   1009: 'R', 1010: 'R', 1011: 'R', 1012: 'R',
+                   1019: 'G', 1020: 'R', 1041: 'I', 1042: 'C', 1044: 'J',
+                   1045: 'E', 1046: 'E'}
+
+# ephemeris messages
+nav_messages = (1019, 1020, 1041, 1042, 1044, 1045, 1046)
+
+# time before start of window in which ephemerides are kept [ms]; GPS
+# ephemerides are broadcast every 2 hours and valid for 4 hours
+nav_margin = 2 * 3600 * 1000
+
+# number of bytes of output collected before writing
+write_size = 1024 * 1024
+
+
+# return system of RTCM message 'msg' or None for messages not related to
+# one system
+def message_system(msg):
+
+    if msg // 10 in rtcm3_decoder.msm_systems:
+        return rtcm3_decoder.msm_systems[msg // 10]
+
+    return message_systems.get(msg)
+
+
+# return epoch time field of observation message 'msg' (MSM or legacy
+# GPS/GLONASS) given as 'payload' or None for other messages
+def epoch_field(payload, msg):
+
+    if len(payload) < 7:
+        return None
+
+    # 30 bits (MSM, GPS) or 27 bits (GLONASS) starting at bit 24
+    if msg // 10 in rtcm3_decoder.msm_systems or 1001 <= msg <= 1004:
+        return (int.from_bytes(bytes(payload[3:7]), 'big') >> 2) & 0x3FFFFFFF
+
+    if 1009 <= msg <= 1012:
+        return (int.from_bytes(bytes(payload[3:7]), 'big') >> 5) & 0x7FFFFFF
+
+    return None
+
+
+# return new dictionary with counters updated by FrameFilter
+def filter_stats():
+    return {"frames": 0, "kept_frames": 0, "kept_bytes": 0,
+            "skipped_time": 0, "skipped_system": 0, "skipped_type": 0}
+
+
+# selection of frames of log recorded on 'date' (<YYYY/MM/DD>); 'start' and
+# 'stop' are GPS times [ms] of time window (None for open window),
+# 'systems' is string of RINEX system letters (e.g. "GE") and 'allow' and
+# 'deny' are lists of message numbers; None disables each condition
+class FrameFilter(object):
+
+    def __init__(self, date, start=None, stop=None, systems=None, allow=None, deny=None):
+
+        self.start = start
+        self.stop = stop
+        self.systems = set(systems) if systems != None else None
+        self.allow = set(allow) if allow != None else None
+        self.deny = set(deny) if deny != None else set()
+
+        # decoder resolves full time of epoch time fields
+        self.decoder = rtcm3_decoder.Rtcm3Decoder(date)
+        self.time = None
+
+        self.stats = filter_stats()
+
+    # check if frame with 'payload' is kept
+    def keep(self, payload):
+
+        stats = self.stats
+        stats["frames"] += 1
+
+        msg = rtcm3_decoder.message_type(payload)
+
+        if msg in self.deny or (self.allow != None and msg not in self.allow):
+            stats["skipped_type"] += 1
+            return False
+
+        sys = message_system(msg)
+
+        if self.systems != None and sys != None and sys not in self.systems:
+            stats["skipped_system"] += 1
+            return False
+
+        if self.start != None or self.stop != None:
+
+            epoch = epoch_field(payload, msg)
+
+            if epoch != None:
+                self.time = self.decoder.msm_time(sys, epoch)
+                self.decoder.time = self.time
+                margin = 0
+            elif msg in nav_messages:
+                margin = nav_margin
+            else:
+                margin = None
+
+            # frames preceding the first epoch are kept, as their time is
+            # not known
+            if margin != None and self.time != None and \
+               ((self.start != None and self.time < self.start - margin) or
+                (self.stop != None and self.time >= self.stop)):
+                stats["skipped_time"] += 1
+                return False
+
+        stats["kept_frames"] += 1
+        stats["kept_bytes"] += len(payload) + 6
+
+        return True
+
+
+# write frames of RTCM 3 log 'in_file_path_name' selected by 'frame_filter'
+# (FrameFilter) to 'out_file_path_name'; frames are validated by CRC-24Q and
+# data which is not part of valid frame is dropped; returns stats of filter
+def filter_file(in_file_path_name, out_file_path_name, frame_filter):
+
+    with open(in_file_path_name, 'rb') as in_file:
+
+        if os.fstat(in_file.fileno()).st_size == 0:
+            data = b''
+        else:
+            data = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            with open(out_file_path_name, 'wb') as out_file:
+
+                parts = []
+                size = 0
+
+                for offset, payload in rtcm3_decoder.iter_frames(data):
+                    if frame_filter.keep(payload):
+                        # frame is copied with its header and CRC
+                        parts.append(data[offset:offset + len(payload) + 6])
+                        size += len(payload) + 6
+                        if size >= write_size:
+                            out_file.write(b''.join(parts))
+                            parts = []
+                            size = 0
+
+                out_file.write(b''.join(parts))
+
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+    return frame_filter.stats
+
+
+# return list of message numbers given as comma separated 'text' or None
+def parse_messages(text):
+
+    if text == None:
+        return None
+
+    return [int(item) for item in text.split(',') if item.strip() != ""]
+
+
+# return FrameFilter for log recorded on 'date' from options given as text:
+# 'start' and 'stop' as <YYYY/MM/DD HH:MM[:SS[.S]]> or <HH:MM[:SS[.S]]> of 'date',
+# 'systems' as RINEX system letters and 'allow', 'deny' as comma separated
+# message numbers; raises ValueError for invalid options
+def make_filter(date, start=None, stop=None, systems=None, allow=None, deny=None):
+
+    reference = rtcm3_decoder.date_to_gps_ms(date)
+
+    if start != None:
+        start = obs_index.parse_time(start, reference)
+    if stop != None:
+        stop = obs_index.parse_time(stop, reference)
+
+    if start != None and stop != None and stop <= start:
+        raise ValueError("End of time window must be later than its start!")
+
+    if systems != None:
+        systems = systems.upper()
+        for sys in systems:
+            if sys not in rtcm3_decoder.system_order + 'I':
+                raise ValueError("Unknown constellation: " + sys)
+
+    return FrameFilter(date, start, stop, systems, parse_messages(allow), parse_messages(deny))
+
+
+# print statistics returned by filter_file
+def print_stats(stats):
+    print("Number of RTCM frames: " + str(stats["frames"]))
+    print("Number of kept frames: %d (%d bytes)" % (stats["kept_frames"], stats["kept_bytes"]))
+    print("Number of frames skipped by time: " + str(stats["skipped_time"]))
+    print("Number of frames skipped by constellation: " + str(stats["skipped_system"]))
+    print("Number of frames skipped by message type: " + str(stats["skipped_type"]))
+
+
+# add filter options to argparse 'parser'
+def add_arguments(parser):
+    parser.add_argument("--start", type=str,
+                        help="start of time window as <YYYY/MM/DD HH:MM[:SS[.S]]> or " \
+                            "<HH:MM[:SS[.S]]> of date of log (GPS time).")
+    parser.add_argument("--end", type=str,
+                        help="end of time window (exclusive), in format of start.")
+    parser.add_argument("--systems", type=str,
+                        help="constellations to convert as RINEX system letters, e.g. 'GE'.")
+    parser.add_argument("--allow", type=str,
+                        help="comma separated RTCM message numbers to convert; " \
+                            "other messages are skipped.")
+    parser.add_argument("--deny", type=str,
+                        help="comma separated RTCM message numbers to skip.")
+
+
+# return dictionary of filter options of parsed 'args' or None if no
+# filter is given (see make_filter)
+def filter_options(args):
+
+    options = {"start": args.start, "stop": args.end, "systems": args.systems,
+               "allow": args.allow, "deny": args.deny}
+
+    if all([value == None for value in options.values()]):
+        return None
+
+    return options
+
+
+if __name__ == "__main__":
+
+    start = time.time()
+
+    #%% Read input arguments
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("date", type=str,
+                        help="calendar date of beginning of RTCM messages as <YYYY/MM/DD>.")
+    parser.add_argument("input_file", type=str,
+                        help="input RTCM 3 file. File path can be absolute or relative.")
+    parser.add_argument("output_file", type=str,
+                        help="output RTCM 3 file with selected frames.")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    if os.path.isfile(args.input_file) == False:
+        print("Can't locate file: " + args.input_file)
+        print("Exiting!")
+        sys.exit(1)
+
+    #%% Filter frames
+
+    try:
+        options = filter_options(args) or {}
+        frame_filter = make_filter(args.date, **options)
+        stats = filter_file(args.input_file, args.output_file, frame_filter)
+    except (ValueError, EnvironmentError) as e:
+        print(e)
+        print("Exiting!")
+        sys.exit(1)
+
+    print_stats(stats)
+
+    stop = time.time()
+    delta = stop - start
+    print("Processing time: %.2f s\n" % delta)
@@ -0,0 +1,292 @@
+"""
+  @file incremental_convert.py
+  @brief Routines to convert growing RTCM logs into RINEX files incrementally by checkpoints
+
+  @author Michal Zygmunt
+
+  @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
+
+  @license See LICENSE file for license details.
+
+  @todo none
+  @bug none
+"""
+
+import hashlib
+import json
+import os
+
+import rinex_writer
+import rtcm3_decoder
+
+#%% Incremental conversion
+#   Logs written by receivers are appended all day long. Checkpoint saved
+#   next to RINEX files stores offset of data following the last complete
+#   RTCM frame, decoder state, the last written epoch and ephemerides
+#   already written; next run decodes only new data by native decoder and
+#   appends it to existing files. The last epoch is rewritten when new
+#   data contains more blocks of it, so duplicated epochs are merged across
+#   runs as by obs fixer. Obs types are taken from data available at first
+#   run and TIME OF LAST OBS header line is updated in place.
+
+checkpoint_version = 1
+
+# number of bytes at the beginning of log used to detect replaced logs
+head_size = 4096
+
+
+#%% Checkpoint
+
+# return SHA-1 digest of the first 'size' bytes of binary 'in_file'
+def head_digest(in_file, size):
+    in_file.seek(0)
+    return hashlib.sha1(in_file.read(size)).hexdigest()
+
+
+# return checkpoint stored at 'checkpoint_path' or None if there is no
+# valid checkpoint
+def read_checkpoint(checkpoint_path):
+
+    if os.path.exists(checkpoint_path) == False:
+        return None
+
+    try:
+        with open(checkpoint_path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+    except ValueError:
+        return None
+
+    if checkpoint.get("version") != checkpoint_version:
+        return None
+
+    return checkpoint
+
+
+# save 'checkpoint' at 'checkpoint_path'; file is replaced atomically, so
+# interrupted run leaves previous checkpoint
+def write_checkpoint(checkpoint_path, checkpoint):
+
+    temp_path = checkpoint_path + ".tmp"
+
+    with open(temp_path, "w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+
+    os.replace(temp_path, checkpoint_path)
+
+
+# check if 'checkpoint' can be continued for 'date', input file 'in_file'
+# of 'size' bytes and output files
+def checkpoint_matches(checkpoint, date, in_file, size, obs_path, nav_path):
+
+    if checkpoint["date"] != date or size < checkpoint["offset"]:
+        return False
+
+    if head_digest(in_file, checkpoint["head_size"]) != checkpoint["head"]:
+        return False
+
+    for path, out_size in [(obs_path, checkpoint["obs_size"]), (nav_path, checkpoint["nav_size"])]:
+        if os.path.exists(path) == False or os.path.getsize(path) < out_size:
+            return False
+
+    return True
+
+
+# return state of 'decoder' (Rtcm3Decoder) needed to continue decoding
+def decoder_state(decoder):
+    return {"time": decoder.time, "glonass_fcn": decoder.glonass_fcn,
+            "position": decoder.position,
+            "lock": [[sat, code, lock] for (sat, code), lock in decoder.lock.items()]}
+
+
+# restore state of 'decoder' saved by decoder_state
+def restore_decoder(decoder, state):
+
+    decoder.time = state["time"]
+    decoder.glonass_fcn = state["glonass_fcn"]
+    decoder.lock = dict(((sat, code), lock) for sat, code, lock in state["lock"])
+
+    if state["position"] != None:
+        decoder.position = tuple(state["position"])
+
+
+#%% RINEX files
+
+# write header of obs file 'obs_file' (binary) for data of 'info' and
+# header of nav file 'nav_file'; returns offset of TIME OF LAST OBS line
+def write_headers(obs_file, nav_file, info, types, log_name):
+
+    last_line = None
+
+    for line in rinex_writer.obs_header(info, types, log_name):
+        if line[60:].rstrip() == "TIME OF LAST OBS":
+            last_line = obs_file.tell()
+        obs_file.write(line.encode())
+
+    for line in rinex_writer.nav_header(log_name):
+        nav_file.write(line.encode())
+
+    return last_line
+
+
+# write 'epoch' to obs file 'obs_file' (binary); offset of epoch in file
+# is stored in epoch, so it can be rewritten by next run
+def write_epoch(obs_file, types, epoch):
+
+    epoch["offset"] = obs_file.tell()
+
+    for line in rinex_writer.epoch_lines(epoch["time"], epoch["observations"], types):
+        obs_file.write(line.encode())
+
+
+# merge epoch 'time' with 'observations' into 'pending' epoch of the same
+# time, otherwise write 'pending' epoch; returns new pending epoch
+def add_epoch(obs_file, types, pending, time, observations, counters):
+
+    if pending != None and pending["time"] == time:
+        for sat, signals in observations.items():
+            pending["observations"].setdefault(sat, {}).update(signals)
+        counters["merged_epochs"] += 1
+        return pending
+
+    if pending != None:
+        write_epoch(obs_file, types, pending)
+        counters["epochs"] += 1
+
+    return {"time": time, "offset": None, "observations": observations}
+
+
+#%% Conversion
+
+# convert data of RTCM log 'in_file_path_name' recorded on 'date' which
+# follows checkpoint 'checkpoint_path' and append it to RINEX obs and nav
+# files 'obs_path' and 'nav_path'; whole log is converted if checkpoint
+# doesn't exist or doesn't match input or output files; returns counters
+def convert_incremental(date, in_file_path_name, obs_path, nav_path, checkpoint_path):
+
+    log_name = os.path.basename(in_file_path_name)
+    counters = {"bytes": 0, "epochs": 0, "merged_epochs": 0, "ephemerides": 0}
+
+    checkpoint = read_checkpoint(checkpoint_path)
+    decoder = rtcm3_decoder.Rtcm3Decoder(date)
+    stats = rtcm3_decoder.frame_stats()
+
+    with open(in_file_path_name, 'rb') as in_file:
+
+        size = os.fstat(in_file.fileno()).st_size
+
+        if checkpoint != None and \
+           checkpoint_matches(checkpoint, date, in_file, size, obs_path, nav_path) == False:
+            print("Checkpoint doesn't match input or output files, converting whole file...")
+            checkpoint = None
+
+        if checkpoint == None:
+            # first run: obs types are found by scan of available data
+            in_file.seek(0)
+            info = rtcm3_decoder.Rtcm3Decoder(date).scan(
+                rtcm3_decoder.read_frames(in_file, final=False))
+
+            if info["first"] == None:
+                raise RuntimeError("Input file doesn't contain RTCM observations!")
+
+            types = rinex_writer.obs_types(info)
+
+            with open(obs_path, 'wb') as obs_file, open(nav_path, 'wb') as nav_file:
+                last_line = write_headers(obs_file, nav_file, info, types, log_name)
+                obs_size, nav_size = obs_file.tell(), nav_file.tell()
+
+            checkpoint = {"version": checkpoint_version, "date": date,
+                          "head_size": 0, "head": "",
+                          "offset": 0, "types": types, "last": info["last"],
+                          "last_line": last_line, "obs_size": obs_size, "nav_size": nav_size,
+                          "epoch": None, "nav_keys": [], "decoder": None}
+
+        else:
+            restore_decoder(decoder, checkpoint["decoder"])
+
+        types = checkpoint["types"]
+        nav_keys = set(tuple(key) for key in checkpoint["nav_keys"])
+        pending = checkpoint["epoch"]
+
+        with open(obs_path, 'r+b') as obs_file, open(nav_path, 'r+b') as nav_file:
+
+            # data appended after checkpoint was saved (interrupted run) and
+            # the last epoch are written again
+            obs_file.truncate(pending["offset"] if pending != None else checkpoint["obs_size"])
+            nav_file.truncate(checkpoint["nav_size"])
+            obs_file.seek(0, os.SEEK_END)
+            nav_file.seek(0, os.SEEK_END)
+
+            in_file.seek(checkpoint["offset"])
+
+            for offset, payload in rtcm3_decoder.read_frames(in_file, stats, final=False):
+
+                event = decoder.decode_payload(payload)
+                if event == None:
+                    continue
+
+                if event[0] == "obs":
+                    pending = add_epoch(obs_file, types, pending,
+                                        event[1][0], event[1][1], counters)
+
+                else:
+                    eph = event[1]
+                    key = (eph["sat"], eph["time"], eph["iode"])
+                    if key not in nav_keys:
+                        nav_keys.add(key)
+                        nav_file.writelines([line.encode() for line in
+                                             rinex_writer.nav_record_lines(eph)])
+                        counters["ephemerides"] += 1
+
+            # epoch which may be continued by next data is kept in checkpoint
+            epoch = decoder.flush()
+            if epoch != None:
+                pending = add_epoch(obs_file, types, pending, epoch[0], epoch[1], counters)
+
+            if pending != None:
+                write_epoch(obs_file, types, pending)
+                counters["epochs"] += 1
+
+            obs_size, nav_size = obs_file.tell(), nav_file.tell()
+
+            if pending != None and checkpoint["last_line"] != None and \
+               (checkpoint["last"] == None or pending["time"] > checkpoint["last"]):
+                checkpoint["last"] = pending["time"]
+                line = rinex_writer.header_line(rinex_writer.header_time(pending["time"]),
+                                                "TIME OF LAST OBS")
+                obs_file.seek(checkpoint["last_line"])
+                obs_file.write(line[:-1].encode())
+
+            for out_file in [obs_file, nav_file]:
+                out_file.flush()
+                os.fsync(out_file.fileno())
+
+        counters["bytes"] = stats["offset"]
+        counters["frames"] = stats["frames"]
+        counters["crc_errors"] = stats["crc_errors"]
+
+        # prefix of log, which can't change in append-only log
+        checkpoint["offset"] += stats["offset"]
+        checkpoint["head_size"] = min(checkpoint["offset"], head_size)
+        checkpoint["head"] = head_digest(in_file, checkpoint["head_size"])
+
+    checkpoint["obs_size"] = obs_size
+    checkpoint["nav_size"] = nav_size
+    checkpoint["epoch"] = pending
+    checkpoint["nav_keys"] = sorted(nav_keys)
+    checkpoint["decoder"] = decoder_state(decoder)
+
+    write_checkpoint(checkpoint_path, checkpoint)
+
+    return counters
+
+
+# print counters returned by convert_incremental
+def print_counters(counters):
+    print("Number of new bytes: " + str(counters["bytes"]))
+    print("Number of RTCM messages: %d (CRC errors: %d)" % (counters["frames"],
+                                                           counters["crc_errors"]))
+    print("Number of epochs written: " + str(counters["epochs"]))
+    print("Number of merged epochs: " + str(counters["merged_epochs"]))
+    print("Number of new ephemerides: " + str(counters["ephemerides"]))
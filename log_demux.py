@@ -0,0 +1,294 @@
+"""
+  @file log_demux.py
+  @brief Routines to split receiver capture logs into RTCM 3 and NMEA streams
+
+  @author Michal Zygmunt
+
+  @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
+
+  @license See LICENSE file for license details.
+
+  @todo none
+  @bug none
+"""
+
+import argparse
+import mmap
+import os.path
+import sys
+import time
+
+import rtcm3_decoder
+
+#%% Demultiplexing of capture logs
+#   Logs captured by terminal programs (e.g. PuTTY) contain text banner,
+#   RTCM 3 frames and NMEA sentences. Log is scanned once: next candidate
+#   for RTCM 3 frame (0xD3 preamble) and NMEA sentence ('$') is found by
+#   bytes.find, frames are validated by CRC-24Q and sentences by checksum;
+#   all other bytes are counted as junk.
+
+nmea_start = b'$'
+
+# maximum length of NMEA sentence with '$' and <CR><LF>; some receivers
+# exceed 82 chars of standard, so longer sentences are accepted
+nmea_max_length = 256
+
+# number of bytes of output collected before writing
+write_size = 1024 * 1024
+
+
+# return new dictionary with counters updated by demux
+def demux_stats():
+    return {"frames": 0, "frame_bytes": 0, "crc_errors": 0,
+            "sentences": 0, "sentence_bytes": 0, "checksum_errors": 0,
+            "junk_bytes": 0}
+
+
+# check checksum of NMEA sentence 'sentence' given as bytes from '$' to '*'
+# followed by 2 hex digits
+def nmea_checksum_ok(sentence):
+
+    try:
+        checksum = int(sentence[-2:], 16)
+    except ValueError:
+        return False
+
+    value = 0
+    for byte in bytearray(sentence[1:-3]):
+        value ^= byte
+
+    return value == checksum
+
+
+# return end offset of RTCM 3 frame starting at 'sync' in 'data', -1 if
+# there is no complete frame or 0 if frame has invalid CRC
+def check_frame(data, sync, end):
+
+    if sync + 6 > end or data[sync + 1] & 0xFC:
+        return -1
+
+    frame_end = sync + (((data[sync + 1] & 0x03) << 8) | data[sync + 2]) + 6
+
+    if frame_end > end:
+        return -1
+
+    frame = data[sync:frame_end]
+
+    if rtcm3_decoder.crc24q(frame[:-3]) != (frame[-3] << 16) | (frame[-2] << 8) | frame[-1]:
+        return 0
+
+    return frame_end
+
+
+# return end offset of NMEA sentence starting at 'start' in 'data'
+# (<CR><LF> or <LF> included), -1 if there is no complete sentence or 0
+# if sentence has invalid checksum
+def check_sentence(data, start, end):
+
+    line_end = data.find(b'\n', start, min(start + nmea_max_length, end))
+
+    if line_end == -1:
+        return -1
+
+    sentence = data[start:line_end].rstrip(b'\r')
+
+    if len(sentence) < 4 or sentence[-3:-2] != b'*':
+        return -1
+
+    if nmea_checksum_ok(sentence) == False:
+        return 0
+
+    return line_end + 1
+
+
+# split bytes-like object 'data' (bytes, mmap) into RTCM 3 frames written to
+# binary 'rtcm_out' and NMEA sentences written to binary 'nmea_out' (both
+# are optional); returns stats dictionary (see demux_stats)
+def demux(data, rtcm_out=None, nmea_out=None, stats=None):
+
+    if stats == None:
+        stats = demux_stats()
+
+    end = len(data)
+    view = memoryview(data)
+
+    rtcm_parts = []
+    rtcm_size = 0
+    nmea_parts = []
+
+    pos = 0
+    next_frame = data.find(rtcm3_decoder.preamble, pos)
+    next_sentence = data.find(nmea_start, pos)
+
+    try:
+        while True:
+
+            if next_frame != -1 and next_frame < pos:
+                next_frame = data.find(rtcm3_decoder.preamble, pos)
+            if next_sentence != -1 and next_sentence < pos:
+                next_sentence = data.find(nmea_start, pos)
+
+            if next_frame == -1 and next_sentence == -1:
+                stats["junk_bytes"] += end - pos
+                break
+
+            if next_sentence == -1 or (next_frame != -1 and next_frame < next_sentence):
+
+                stats["junk_bytes"] += next_frame - pos
+                pos = next_frame
+                frame_end = check_frame(data, pos, end)
+
+                if frame_end <= 0:
+                    if frame_end == 0:
+                        stats["crc_errors"] += 1
+                    stats["junk_bytes"] += 1
+                    pos += 1
+                    continue
+
+                stats["frames"] += 1
+                stats["frame_bytes"] += frame_end - pos
+
+                if rtcm_out != None:
+                    rtcm_parts.append(view[pos:frame_end])
+                    rtcm_size += frame_end - pos
+                    if rtcm_size >= write_size:
+                        rtcm_out.write(b''.join(rtcm_parts))
+                        rtcm_parts = []
+                        rtcm_size = 0
+
+            else:
+                stats["junk_bytes"] += next_sentence - pos
+                pos = next_sentence
+                frame_end = check_sentence(data, pos, end)
+
+                if frame_end <= 0:
+                    if frame_end == 0:
+                        stats["checksum_errors"] += 1
+                    stats["junk_bytes"] += 1
+                    pos += 1
+                    continue
+
+                stats["sentences"] += 1
+                stats["sentence_bytes"] += frame_end - pos
+
+                if nmea_out != None:
+                    # sentences are written with <CR><LF> line ending
+                    nmea_parts.append(data[pos:frame_end].rstrip(b'\r\n') + b'\r\n')
+
+            pos = frame_end
+
+        if rtcm_out != None:
+            rtcm_out.write(b''.join(rtcm_parts))
+        if nmea_out != None:
+            nmea_out.write(b''.join(nmea_parts))
+
+    finally:
+        rtcm_parts = []
+        view.release()
+
+    return stats
+
+
+# split capture log stored at 'input_file_path_name' into RTCM 3 stream
+# saved as 'rtcm_file_path_name' and NMEA sentences saved as
+# 'nmea_file_path_name' (both are optional); returns stats dictionary
+def demux_file(input_file_path_name, rtcm_file_path_name=None, nmea_file_path_name=None):
+
+    rtcm_out = None
+    nmea_out = None
+
+    with open(input_file_path_name, 'rb') as in_file:
+
+        if os.fstat(in_file.fileno()).st_size == 0:
+            data = b''
+        else:
+            data = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            if rtcm_file_path_name != None:
+                rtcm_out = open(rtcm_file_path_name, 'wb')
+            if nmea_file_path_name != None:
+                nmea_out = open(nmea_file_path_name, 'wb')
+
+            stats = demux(data, rtcm_out, nmea_out)
+
+        finally:
+            for out_file in [rtcm_out, nmea_out]:
+                if out_file != None:
+                    out_file.close()
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+    return stats
+
+
+# print statistics returned by demux
+def print_stats(stats):
+    print("Number of RTCM frames: %d (%d bytes)" % (stats["frames"], stats["frame_bytes"]))
+    print("Number of RTCM frames with invalid CRC: " + str(stats["crc_errors"]))
+    print("Number of NMEA sentences: %d (%d bytes)" % (stats["sentences"], stats["sentence_bytes"]))
+    print("Number of NMEA sentences with invalid checksum: " + str(stats["checksum_errors"]))
+    print("Number of junk bytes: " + str(stats["junk_bytes"]))
+
+
+if __name__ == "__main__":
+
+    start = time.time()
+
+    #%% Read input arguments
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_file", type=str,
+                        help="input capture log with RTCM 3 and NMEA data. " \
+                            "File path can be absolute or relative.")
+    parser.add_argument("-o", "--output_file", type=str,
+                        help="output RTCM 3 file to save. " \
+                            "File path can be absolute or relative. " \
+                            "If not specified, output file is written to input directory " \
+                            "with name <input_file>_rtcm.rtcm3")
+    parser.add_argument("-n", "--nmea_file", type=str,
+                        help="output NMEA file to save. " \
+                            "If not specified, output file is written to input directory " \
+                            "with name <input_file>.nmea")
+    args = parser.parse_args()
+
+    input_file_path_name = args.input_file
+
+    #%% Sanity check for input parameters
+
+    if os.path.isfile(input_file_path_name) == False:
+        print("Can't locate file: " + input_file_path_name)
+        print("Exiting!")
+        sys.exit()
+
+    if os.access(input_file_path_name, os.R_OK) == False:
+        print("User don't have access rights to read specified file!")
+        print("Exiting!")
+        sys.exit()
+
+    in_file_path_name = os.path.splitext(input_file_path_name)[0]
+
+    rtcm_file_path_name = args.output_file
+    if rtcm_file_path_name == None:
+        rtcm_file_path_name = in_file_path_name + "_rtcm.rtcm3"
+
+    nmea_file_path_name = args.nmea_file
+    if nmea_file_path_name == None:
+        nmea_file_path_name = in_file_path_name + ".nmea"
+
+    for path in [rtcm_file_path_name, nmea_file_path_name]:
+        out_dir_path = os.path.dirname(path)
+        if out_dir_path != "" and os.path.exists(out_dir_path) == False:
+            os.makedirs(out_dir_path)
+
+    #%% Split log
+
+    stats = demux_file(input_file_path_name, rtcm_file_path_name, nmea_file_path_name)
+
+    #%% statistics informations
+
+    print_stats(stats)
+
+    stop = time.time()
+    delta = stop - start
+    print("Processing time: %.2f s\n" % delta)
@@ -0,0 +1,279 @@
+"""
+  @file nav_merge.py
+  @brief Routines to merge RINEX nav files into one file without repeated ephemerides
+
+  @author Michal Zygmunt
+
+  @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
+
+  @license See LICENSE file for license details.
+
+  @todo none
+  @bug none
+"""
+
+import argparse
+import io
+import os.path
+import sys
+import time
+
+import compressed_io
+import convbin_nav_fix
+import rinex_writer
+
+#%% Merge of nav files
+#   Nav files are read one by one, record by record, and each ephemeris is
+#   identified by its satellite, time of clock and issue of data (IODE of
+#   GPS/QZSS/IRNSS, IODnav of Galileo, AODE of BeiDou; GLONASS and SBAS
+#   records are identified by time of clock only). Only one copy of each
+#   ephemeris is kept in memory: the first one read or the latest one,
+#   depending on policy. Kept records are written sorted by system,
+#   satellite and time and formatted as by convbin_nav_fix, so nav files
+#   of 'convbin' can be merged before they are fixed.
+
+merge_policies = ('first', 'latest')
+
+# header labels copied from input files to merged header; one line is kept
+# for each type of correction given in its first 'key' chars
+merged_labels = [("IONOSPHERIC CORR", 5), ("TIME SYSTEM CORR", 5), ("LEAP SECONDS", 0)]
+
+
+# return new dictionary with counters of merge
+def merge_stats():
+    return {"files": 0, "records": 0, "unique": 0, "duplicates": 0, "invalid": 0}
+
+
+# return key (satellite, time of clock, issue of data) of nav record given
+# as list of its lines or None if record is invalid
+def record_key(record):
+
+    line = record[0]
+
+    if len(line) < 23 or line[0] == ' ':
+        return None
+
+    # GLONASS and SBAS records don't contain issue of data
+    if line[0] in "RS":
+        return (line[:3], line[4:23], "")
+
+    if len(record) < 2:
+        return None
+
+    # first value of the first orbit line; values are compared as
+    # formatted by nav fixer, so 'D' and 'E' formatted files are merged
+    try:
+        iod = convbin_nav_fix.exp_as_string(record[1][4:23])
+    except ValueError:
+        return None
+
+    return (line[:3], line[4:23], iod)
+
+
+# return sort key of nav record 'key': system, satellite, time of clock and
+# issue of data
+def record_sort_key(key):
+    return (rinex_writer.sat_sort_key(key[0]), key[1], key[2])
+
+
+# yield nav records of text file 'in_file' as lists of lines; file is read
+# from position after its header
+def iter_records(in_file):
+
+    record = []
+
+    for line in in_file:
+
+        if line.strip() == "":
+            continue
+
+        # each record starts with satellite id
+        if line[0] != ' ' and len(record) > 0:
+            yield record
+            record = []
+
+        record.append(line)
+
+    if len(record) > 0:
+        yield record
+
+
+# merger of nav files; files are added by add_file and merged file is
+# written by write; 'policy' selects copy of repeated ephemeris: 'first' or
+# 'latest'
+class NavMerger(object):
+
+    def __init__(self, policy='first'):
+
+        if policy not in merge_policies:
+            raise ValueError("Unknown merge policy: " + policy)
+
+        self.policy = policy
+
+        # key of record -> lines of record
+        self.records = {}
+
+        # version line and merged header lines, label -> {type -> line}
+        self.version = None
+        self.header = dict((label, {}) for label, _ in merged_labels)
+
+        self.stats = merge_stats()
+
+    # add header lines 'lines' of one nav file
+    def add_header(self, lines):
+
+        for line in lines:
+            label = line[60:].strip()
+
+            if label == "RINEX VERSION / TYPE":
+                # files with different systems give mixed file
+                if self.version == None:
+                    self.version = line
+                elif self.version[40:41] != line[40:41]:
+                    self.version = rinex_writer.header_line(
+                        "%9s%11s%-20s%-20s" % (self.version[:9].strip(), "",
+                                               "N: GNSS NAV DATA", "M: Mixed"),
+                        "RINEX VERSION / TYPE")
+
+            for merged_label, key in merged_labels:
+                if label == merged_label:
+                    kept = self.header[label]
+                    if self.policy == 'latest' or line[:key] not in kept:
+                        kept[line[:key]] = line
+
+    # add nav records of text file 'in_file'
+    def add_records(self, in_file):
+
+        records = self.records
+        stats = self.stats
+        latest = self.policy == 'latest'
+
+        for record in iter_records(in_file):
+
+            stats["records"] += 1
+
+            key = record_key(record)
+
+            if key == None:
+                stats["invalid"] += 1
+            elif key not in records:
+                records[key] = record
+            else:
+                stats["duplicates"] += 1
+                if latest == True:
+                    records[key] = record
+
+    # add nav file 'path' (may be compressed, see compressed_io)
+    def add_file(self, path):
+
+        with io.TextIOWrapper(compressed_io.open_input(path)) as in_file:
+
+            header = []
+            for line in in_file:
+                header.append(line)
+                if convbin_nav_fix.header_end in line:
+                    break
+
+            self.add_header(header)
+            self.add_records(in_file)
+
+        self.stats["files"] += 1
+
+    # return lines of merged header
+    def header_lines(self):
+
+        version = self.version
+        if version == None:
+            version = rinex_writer.nav_header()[0]
+
+        lines = [version.rstrip('\r\n') + "\n", rinex_writer.program_line(),
+                 rinex_writer.header_line("merged from %d nav files" % self.stats["files"],
+                                          "COMMENT")]
+
+        for label, _ in merged_labels:
+            header = self.header[label]
+            lines += [header[key].rstrip('\r\n') + "\n" for key in sorted(header)]
+
+        lines.append(rinex_writer.header_line("", "END OF HEADER"))
+
+        return lines
+
+    # write merged nav file 'path' (compressed by its extension, see
+    # compressed_io); returns stats of merge
+    def write(self, path):
+
+        records = self.records
+        self.stats["unique"] = len(records)
+
+        with compressed_io.open_output(path, text=True) as out_file:
+
+            out_file.write("".join(self.header_lines()))
+
+            for key in sorted(records, key=record_sort_key):
+                lines = []
+                for line in records[key]:
+                    line_new, _ = convbin_nav_fix.update_record(line.rstrip('\r\n') + "\n", 0)
+                    lines.append(line_new)
+                out_file.write("".join(lines))
+
+        return self.stats
+
+
+# merge nav files 'in_paths' into 'out_path' keeping copy of repeated
+# ephemerides selected by 'policy' (see NavMerger); returns stats of merge
+def merge_nav_files(in_paths, out_path, policy='first'):
+
+    merger = NavMerger(policy)
+
+    for path in in_paths:
+        merger.add_file(path)
+
+    return merger.write(out_path)
+
+
+# print statistics returned by merge_nav_files
+def print_stats(stats):
+    print("Number of merged nav files: " + str(stats["files"]))
+    print("Number of nav records: " + str(stats["records"]))
+    print("Number of unique ephemerides: " + str(stats["unique"]))
+    print("Number of repeated ephemerides removed: " + str(stats["duplicates"]))
+    print("Number of invalid records skipped: " + str(stats["invalid"]))
+
+
+if __name__ == "__main__":
+
+    start = time.time()
+
+    #%% Read input arguments
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_files", type=str, nargs='+',
+                        help="input RINEX nav files (may be compressed by gzip or zstd).")
+    parser.add_argument("-o", "--output_file", type=str, required=True,
+                        help="output merged RINEX nav file (compressed by .gz or .zst " \
+                            "extension).")
+    parser.add_argument("-p", "--policy", type=str, choices=merge_policies, default='first',
+                        help="copy of repeated ephemeris which is kept: the first or the " \
+                            "latest one read.")
+    args = parser.parse_args()
+
+    for path in args.input_files:
+        if os.path.isfile(path) == False:
+            print("Can't locate file: " + path)
+            print("Exiting!")
+            sys.exit(1)
+
+    #%% Merge nav files
+
+    try:
+        stats = merge_nav_files(args.input_files, args.output_file, args.policy)
+    except (ValueError, RuntimeError, EnvironmentError) as e:
+        print(e)
+        print("Exiting!")
+        sys.exit(1)
+
+    print_stats(stats)
+
+    stop = time.time()
+    delta = stop - start
+    print("Processing time: %.2f s\n" % delta)
@@ -0,0 +1,387 @@
+"""
+  @file nmea_track.py
+  @brief Routines to extract position track from NMEA GGA sentences of capture logs
+
+  @author Michal Zygmunt
+
+  @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
+
+  @license See LICENSE file for license details.
+
+  @todo none
+  @bug none
+"""
+
+import argparse
+import datetime
+import mmap
+import os.path
+import sys
+import time
+
+import compressed_io
+import log_demux
+
+# NumPy is needed by track extraction and pyarrow by Parquet files only
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+#%% Extraction of GGA track
+#   Capture logs contain NMEA sentences between RTCM 3 frames. Log is mapped
+#   into memory and processed in chunks by NumPy: all '$' and <LF> bytes are
+#   found at once, each '$' is paired with the next <LF>, candidates of GGA
+#   sentences (any talker, e.g. $GPGGA, $GNGGA) are selected by their type
+#   and checksum of all of them is computed from prefix XOR of chunk. Bodies
+#   of valid sentences are gathered into one text, which is split into
+#   fields by one bytes.split and converted column by column as in
+#   obs_store. Each sentence is one record of track with UTC time of day
+#   [s], latitude and longitude [deg], height above mean sea level and geoid
+#   separation [m], fix quality, HDOP and number of satellites.
+
+# size of chunk of log processed at once; chunks overlap by maximum length
+# of sentence, so sentences crossing chunk end are found
+chunk_size = 64 * 1024 * 1024
+
+# number of fields of GGA sentence, from sentence type to station id
+gga_fields = 15
+
+track_formats = ('csv', 'parquet')
+
+# track columns written to CSV files and their formats
+csv_columns = [("time", "%.3f"), ("lat", "%.9f"), ("lon", "%.9f"), ("height", "%.3f"),
+               ("geoid", "%.3f"), ("quality", "%d"), ("hdop", "%.2f"), ("sats", "%d")]
+
+
+# raise error if NumPy isn't available
+def check_numpy():
+    if numpy == None:
+        raise RuntimeError("Python package 'numpy' is required for NMEA track!")
+
+
+# raise error if pyarrow isn't available
+def check_pyarrow():
+    if pyarrow == None:
+        raise RuntimeError("Python package 'pyarrow' is required for Parquet files!")
+
+
+# return dtype of track records
+def track_dtype():
+    return numpy.dtype([("time", numpy.float64), ("lat", numpy.float64), ("lon", numpy.float64),
+                        ("height", numpy.float64), ("geoid", numpy.float32),
+                        ("quality", numpy.uint8), ("hdop", numpy.float32), ("sats", numpy.uint8)])
+
+
+# return format of track file 'path' by its extension: 'csv' or 'parquet'
+def track_format(path):
+
+    ext = os.path.splitext(path)[1].lower()
+
+    if ext == '.csv':
+        return 'csv'
+
+    if ext in ('.parquet', '.pq'):
+        return 'parquet'
+
+    raise ValueError("Unknown format of track file: " + path)
+
+
+# raise error if track can't be saved as file 'path' (unknown format or
+# missing package)
+def check_track(path):
+
+    check_numpy()
+
+    if track_format(path) == 'parquet':
+        check_pyarrow()
+
+
+# return new dictionary with counters updated by extraction
+def track_stats():
+    return {"sentences": 0, "checksum_errors": 0, "invalid": 0, "records": 0}
+
+
+# return array of values of hex digits, -1 for other chars
+def hex_table():
+
+    table = numpy.full(256, -1, dtype=numpy.int16)
+    for digit in b"0123456789ABCDEFabcdef":
+        table[digit] = int(chr(digit), 16)
+
+    return table
+
+
+# return start and end (at '*') offsets of valid GGA sentences of NumPy
+# uint8 array 'buffer' starting before 'limit'; 'stats' are updated
+def find_sentences(buffer, limit, stats):
+
+    dollars = numpy.flatnonzero(buffer[:limit] == ord('$'))
+    newlines = numpy.flatnonzero(buffer == ord('\n'))
+
+    # each sentence ends by the first <LF> after its start
+    index = numpy.searchsorted(newlines, dollars)
+    found = index < len(newlines)
+    starts = dollars[found]
+    ends = newlines[index[found]]
+
+    # the shortest candidate is '$xxGGA*hh'
+    found = (ends - starts < log_demux.nmea_max_length) & (ends - starts >= 9)
+    starts = starts[found]
+    ends = ends[found]
+
+    # <CR> of line ending isn't part of sentence
+    stops = ends - (buffer[ends - 1] == ord('\r'))
+    stars = stops - 3
+
+    found = (buffer[starts + 3] == ord('G')) & (buffer[starts + 4] == ord('G')) & \
+        (buffer[starts + 5] == ord('A')) & (buffer[stars] == ord('*'))
+    starts = starts[found]
+    stars = stars[found]
+
+    # XOR of bytes between '$' and '*' from prefix XOR of buffer
+    prefix = numpy.bitwise_xor.accumulate(buffer[:int(stars.max()) if len(stars) else 0])
+    values = prefix[stars - 1] ^ prefix[starts]
+
+    table = hex_table()
+    high = table[buffer[stars + 1]]
+    low = table[buffer[stars + 2]]
+    valid = (high >= 0) & (low >= 0) & (values == (high << 4) + low)
+
+    stats["sentences"] += int(valid.sum())
+    stats["checksum_errors"] += len(valid) - int(valid.sum())
+
+    return starts[valid], stars[valid]
+
+
+# return fields of sentences of NumPy uint8 array 'buffer' given by 'starts'
+# and 'stars' offsets as 2D array of bytes; sentences with other number of
+# fields than GGA are skipped; 'stats' are updated
+def sentence_fields(buffer, starts, stars, stats):
+
+    # body of each sentence is taken from its type to '*'
+    lengths = stars + 1 - (starts + 1)
+    offsets = numpy.cumsum(lengths) - lengths
+    index = numpy.repeat(starts + 1 - offsets, lengths) + numpy.arange(int(lengths.sum()))
+    body = buffer[index]
+
+    separators = (body == ord(',')) | (body == ord('*'))
+    counts = numpy.add.reduceat(separators.astype(numpy.int32), offsets)
+
+    valid = counts == gga_fields
+    stats["invalid"] += len(valid) - int(valid.sum())
+
+    if valid.all() == False:
+        body = body[numpy.repeat(valid, lengths)]
+
+    # '*' ends the last field of each sentence
+    text = body.tobytes().replace(b'*', b',')
+
+    return numpy.array(text.split(b',')[:-1]).reshape(-1, gga_fields)
+
+
+# return column of fields 'column' as float64 array, NaN if field is empty
+def to_float(column):
+    return numpy.where(column == b'', b'nan', column).astype(numpy.float64)
+
+
+# return degrees of NMEA coordinates 'column' (<d>ddmm.mmmm) with signs by
+# hemisphere column 'signs' ('S' or 'W' for negative values)
+def to_degrees(column, signs, negative):
+
+    value = to_float(column)
+    degrees = numpy.floor(value / 100.0)
+    degrees += (value - degrees * 100.0) / 60.0
+
+    return numpy.where(signs == negative, -degrees, degrees)
+
+
+# return records of track of GGA sentences given as 2D array of 'fields'
+def track_records(fields):
+
+    records = numpy.zeros(len(fields), dtype=track_dtype())
+
+    # UTC time is given as hhmmss.ss
+    value = to_float(fields[:, 1])
+    records["time"] = numpy.floor(value / 10000.0) * 3600.0 + \
+        numpy.floor(value / 100.0 % 100.0) * 60.0 + value % 100.0
+
+    records["lat"] = to_degrees(fields[:, 2], fields[:, 3], b'S')
+    records["lon"] = to_degrees(fields[:, 4], fields[:, 5], b'W')
+    records["height"] = to_float(fields[:, 9])
+    records["geoid"] = to_float(fields[:, 11])
+    records["hdop"] = to_float(fields[:, 8])
+    records["quality"] = numpy.nan_to_num(to_float(fields[:, 6]))
+    records["sats"] = numpy.nan_to_num(to_float(fields[:, 7]))
+
+    # sentences without time can't be placed in track
+    return records[numpy.isnan(records["time"]) == False]
+
+
+# return track of bytes-like object 'data' (bytes, mmap) as structured
+# array (see track_dtype); times are continued after midnight (> 86400 s)
+def extract_track(data, stats=None):
+
+    check_numpy()
+
+    if stats == None:
+        stats = track_stats()
+
+    size = len(data)
+    batches = [numpy.zeros(0, dtype=track_dtype())]
+
+    for pos in range(0, size, chunk_size):
+
+        end = min(pos + chunk_size + log_demux.nmea_max_length, size)
+        buffer = numpy.frombuffer(data, dtype=numpy.uint8, count=end - pos, offset=pos)
+
+        starts, stars = find_sentences(buffer, min(chunk_size, size - pos), stats)
+        if len(starts) > 0:
+            batches.append(track_records(sentence_fields(buffer, starts, stars, stats)))
+
+        # array must be released before memory map is closed
+        del buffer
+
+    records = numpy.concatenate(batches)
+
+    # time going back by more than half of day passed midnight
+    days = numpy.cumsum(numpy.diff(records["time"], prepend=records["time"][:1]) < -43200.0)
+    records["time"] += days * 86400.0
+
+    stats["records"] = len(records)
+
+    return records
+
+
+# return track of log 'path' (may be compressed, see compressed_io); 'stats'
+# are updated if they're given
+def extract_file(path, stats=None):
+
+    check_numpy()
+
+    if compressed_io.file_compression(path) != None:
+        with compressed_io.open_input(path) as in_file:
+            return extract_track(in_file.read(), stats)
+
+    with open(path, 'rb') as in_file:
+
+        if os.fstat(in_file.fileno()).st_size == 0:
+            return extract_track(b'', stats)
+
+        data = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            return extract_track(data, stats)
+        finally:
+            data.close()
+
+
+# return UTC times of 'records' of track of 'date' (<YYYY/MM/DD>) as
+# datetime64 array
+def utc_times(records, date):
+
+    day = numpy.datetime64(datetime.datetime.strptime(date, "%Y/%m/%d").date(), 'ms')
+
+    return day + numpy.round(records["time"] * 1000.0).astype('timedelta64[ms]')
+
+
+# save track 'records' as file 'path' in format given by its extension;
+# UTC date and time is added to each record if 'date' (<YYYY/MM/DD>) of the
+# first sentence is given
+def save_track(records, path, date=None):
+
+    if track_format(path) == 'parquet':
+
+        check_pyarrow()
+
+        columns = {}
+        if date != None:
+            columns["utc"] = utc_times(records, date)
+        for name in records.dtype.names:
+            columns[name] = records[name]
+
+        pyarrow.parquet.write_table(pyarrow.table(columns), path, compression='zstd')
+        return
+
+    names = [name for name, _ in csv_columns]
+    formats = [fmt for _, fmt in csv_columns]
+
+    rows = [records[name] for name in names]
+    if date != None:
+        names.insert(0, "utc")
+        formats.insert(0, "%s")
+        rows.insert(0, numpy.datetime_as_string(utc_times(records, date)))
+
+    with open(path, 'w') as out_file:
+        out_file.write(",".join(names) + "\n")
+        if len(records) > 0:
+            numpy.savetxt(out_file, numpy.rec.fromarrays(rows), fmt=formats, delimiter=",")
+
+
+# extract track of log 'in_path' and save it as 'track_path' (see
+# save_track); returns stats of extraction
+def extract_to_file(in_path, track_path, date=None):
+
+    check_track(track_path)
+
+    stats = track_stats()
+    save_track(extract_file(in_path, stats), track_path, date)
+
+    return stats
+
+
+# print statistics returned by extract_to_file
+def print_stats(stats):
+    print("Number of GGA sentences: " + str(stats["sentences"]))
+    print("Number of GGA sentences with invalid checksum: " + str(stats["checksum_errors"]))
+    print("Number of GGA sentences with invalid fields: " + str(stats["invalid"]))
+    print("Number of track records: " + str(stats["records"]))
+
+
+if __name__ == "__main__":
+
+    start = time.time()
+
+    #%% Read input arguments
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_file", type=str,
+                        help="input capture log with NMEA sentences (may be compressed by " \
+                            "gzip or zstd).")
+    parser.add_argument("-o", "--output_file", type=str,
+                        help="output track file: <name>.csv or <name>.parquet. " \
+                            "If not specified, <input_file>_track.csv is written.")
+    parser.add_argument("-t", "--date", type=str,
+                        help="calendar date of the first sentence as <YYYY/MM/DD>, " \
+                            "which adds UTC date and time column to track.")
+    args = parser.parse_args()
+
+    if os.path.isfile(args.input_file) == False:
+        print("Can't locate file: " + args.input_file)
+        print("Exiting!")
+        sys.exit(1)
+
+    output_file = args.output_file
+    if output_file == None:
+        output_file = os.path.splitext(args.input_file)[0] + "_track.csv"
+
+    #%% Extract track
+
+    try:
+        stats = extract_to_file(args.input_file, output_file, args.date)
+    except (ValueError, RuntimeError, EnvironmentError) as e:
+        print(e)
+        print("Exiting!")
+        sys.exit(1)
+
+    print_stats(stats)
+
+    stop = time.time()
+    delta = stop - start
+    print("Processing time: %.2f s\n" % delta)
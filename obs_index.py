@@ -0,0 +1,339 @@
+"""
+  @file obs_index.py
+  @brief Routines to index epochs of RINEX obs files and extract time windows by the index
+
+  @author Michal Zygmunt
+
+  @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
+
+  @license See LICENSE file for license details.
+
+  @todo none
+  @bug none
+"""
+
+import argparse
+import datetime
+import mmap
+import os.path
+import struct
+import sys
+import time
+
+import rinex_writer
+
+#%% Epoch index
+#   Index is binary sidecar file '<obs file>.idx' written by obs fixer:
+#   header with magic, size of RINEX header, size and modification time [ns]
+#   of indexed obs file and number of epochs, followed by one record per epoch: epoch time [GPS ms],
+#   byte offset of epoch row and number of satellites. Records are sorted
+#   by time, so epochs of time window are found by binary search and copied
+#   from memory mapped obs file.
+
+index_magic = b"RNXIDX2\0"
+index_header = struct.Struct("<8sQQqQ")
+index_record = struct.Struct("<qQI")
+
+index_extension = ".idx"
+
+
+# return GPS time [ms] of epoch row 'epoch' (bytes)
+def epoch_time(epoch):
+
+    date = datetime.datetime(int(epoch[2:6]), int(epoch[7:9]), int(epoch[10:12]),
+                             int(epoch[13:15]), int(epoch[16:18]))
+    delta = date - rinex_writer.gps_epoch
+
+    return (delta.days * 86400 + delta.seconds) * 1000 + int(round(float(epoch[18:29]) * 1000))
+
+
+# writer of index file 'path'; records are added by obs fixer for every
+# epoch it writes
+class IndexWriter(object):
+
+    def __init__(self, path):
+
+        self.path = path
+        self.out_file = open(path, 'wb')
+        self.out_file.write(index_header.pack(index_magic, 0, 0, 0, 0))
+
+        self.header_size = None
+        self.count = 0
+        self.last_time = None
+        self.sorted = True
+
+    # add epoch row 'epoch' (bytes) written at 'offset' with 'sats' satellites
+    def add(self, epoch, offset, sats):
+
+        time = epoch_time(epoch)
+
+        if self.header_size == None:
+            self.header_size = offset
+
+        if self.last_time != None and time < self.last_time:
+            self.sorted = False
+        self.last_time = time
+
+        self.out_file.write(index_record.pack(time, offset, sats))
+        self.count += 1
+
+    # complete index of written obs file 'obs_path'; index of epochs which
+    # are not sorted by time is removed, as it can't be searched
+    def close(self, obs_path):
+
+        stat = os.stat(obs_path)
+
+        if self.header_size == None:
+            self.header_size = stat.st_size
+
+        self.out_file.seek(0)
+        self.out_file.write(index_header.pack(index_magic, self.header_size, stat.st_size,
+                                              stat.st_mtime_ns, self.count))
+        self.out_file.close()
+
+        if self.sorted == False:
+            print("WARNING: epochs are not sorted by time, index is not written!")
+            os.remove(self.path)
+
+    # remove partial index
+    def discard(self):
+        self.out_file.close()
+        os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type != None:
+            self.discard()
+
+
+# build index 'index_path' of existing obs file 'obs_path' by scanning it
+def build_index(obs_path, index_path):
+
+    with open(obs_path, 'rb') as in_file:
+
+        index = IndexWriter(index_path)
+        with index:
+            offset = 0
+            header = True
+
+            for line in in_file:
+                if line[:1] == b'>':
+                    header = False
+                    sats = int(line[32:35])
+                    index.add(line, offset, sats)
+                elif header == True and line[60:73] == b"END OF HEADER":
+                    index.header_size = offset + len(line)
+                offset += len(line)
+
+            index.close(obs_path)
+
+
+#%% Time windows
+
+# memory mapped index of obs file
+class ObsIndex(object):
+
+    # open index 'index_path' of obs file 'obs_path'; raises ValueError if
+    # index is invalid or doesn't match size and modification time of obs file
+    def __init__(self, index_path, obs_path):
+
+        stat = os.stat(obs_path)
+
+        with open(index_path, 'rb') as in_file:
+            if os.fstat(in_file.fileno()).st_size < index_header.size:
+                raise ValueError("Invalid index file: " + index_path)
+            self.data = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.header_size, size, mtime, self.count = index_header.unpack_from(self.data)
+
+        if magic != index_magic or \
+           len(self.data) != index_header.size + self.count * index_record.size:
+            self.data.close()
+            raise ValueError("Invalid index file: " + index_path)
+
+        if size != stat.st_size or mtime != stat.st_mtime_ns:
+            self.data.close()
+            raise ValueError("Index file doesn't match obs file: " + index_path)
+
+        self.file_size = stat.st_size
+
+    def close(self):
+        self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # return record 'item' as (time, offset, satellites)
+    def record(self, item):
+        return index_record.unpack_from(self.data, index_header.size + item * index_record.size)
+
+    # return number of the first epoch with time not earlier than 'time'
+    def find(self, time):
+
+        low, high = 0, self.count
+
+        while low < high:
+            middle = (low + high) // 2
+            if self.record(middle)[0] < time:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    # return offset of epoch 'item' (end of file for item after the last one)
+    def offset(self, item):
+
+        if item >= self.count:
+            return self.file_size
+
+        return self.record(item)[1]
+
+
+# return ObsIndex of obs file 'obs_path'; missing or stale index is built
+def open_index(obs_path):
+
+    index_path = obs_path + index_extension
+
+    try:
+        return ObsIndex(index_path, obs_path)
+    except (ValueError, EnvironmentError):
+        pass
+
+    print("Building index of obs file...")
+    build_index(obs_path, index_path)
+
+    return ObsIndex(index_path, obs_path)
+
+
+# return header 'header' (bytes) with TIME OF FIRST / LAST OBS lines set to
+# 'first' and 'last' times [GPS ms]
+def window_header(header, first, last):
+
+    lines = header.splitlines(True)
+
+    for item, line in enumerate(lines):
+        for label, time in [(b"TIME OF FIRST OBS", first), (b"TIME OF LAST OBS", last)]:
+            if line[60:60 + len(label)] == label and time != None:
+                ending = line[len(line.rstrip(b'\r\n')):]
+                lines[item] = rinex_writer.header_line(
+                    rinex_writer.header_time(time), label.decode())[:-1].encode() + ending
+
+    return b"".join(lines)
+
+
+# copy epochs of obs file 'obs_path' from 'start' (inclusive) to 'stop'
+# (exclusive) times [GPS ms] with header into 'out_path'; returns number
+# of copied epochs
+def extract_window(obs_path, out_path, start, stop):
+
+    with open_index(obs_path) as index:
+        first = index.find(start)
+        last = index.find(stop)
+
+        times = [None, None]
+        if last > first:
+            times = [index.record(first)[0], index.record(last - 1)[0]]
+
+        header_size = index.header_size
+        start_offset, stop_offset = index.offset(first), index.offset(last)
+
+    with open(obs_path, 'rb') as in_file:
+
+        data = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            with open(out_path, 'wb') as out_file:
+                out_file.write(window_header(data[:header_size], times[0], times[1]))
+                out_file.write(data[start_offset:stop_offset])
+
+        finally:
+            data.close()
+
+    return last - first
+
+
+# return GPS time [ms] of 'text' given as <YYYY/MM/DD HH:MM[:SS[.S]]> or
+# <HH:MM[:SS[.S]]>; date of 'reference' time [GPS ms] is used in the last case
+def parse_time(text, reference):
+
+    items = text.split()
+
+    if len(items) == 1:
+        date = rinex_writer.gps_ms_to_datetime(reference).date()
+        day = datetime.datetime(date.year, date.month, date.day)
+    else:
+        day = datetime.datetime.strptime(items[0], "%Y/%m/%d")
+
+    clock = items[-1].split(':')
+    if len(clock) == 2:
+        clock.append("0")
+
+    delta = day + datetime.timedelta(hours=int(clock[0]), minutes=int(clock[1])) - \
+        rinex_writer.gps_epoch
+
+    return (delta.days * 86400 + delta.seconds) * 1000 + int(round(float(clock[2]) * 1000))
+
+
+if __name__ == "__main__":
+
+    start = time.time()
+
+    #%% Read input arguments
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_file", type=str,
+                        help="input RINEX obs file. Index <input_file>.idx is built " \
+                            "if it's missing.")
+    parser.add_argument("-s", "--start", type=str,
+                        help="start of time window as <YYYY/MM/DD HH:MM[:SS[.S]]> or " \
+                            "<HH:MM[:SS[.S]]>, which uses date of the first epoch.")
+    parser.add_argument("-e", "--end", type=str,
+                        help="end of time window (exclusive), in format of start.")
+    parser.add_argument("-o", "--output_file", type=str,
+                        help="output RINEX obs file with epochs of time window.")
+    parser.add_argument("-b", "--build", action='store_true',
+                        help="only build index of input file.")
+    args = parser.parse_args()
+
+    if os.path.isfile(args.input_file) == False:
+        print("Can't locate file: " + args.input_file)
+        print("Exiting!")
+        sys.exit(1)
+
+    #%% Build index or extract window
+
+    try:
+        if args.build == True:
+            build_index(args.input_file, args.input_file + index_extension)
+            with open_index(args.input_file) as index:
+                print("Number of epochs: " + str(index.count))
+
+        else:
+            if args.start == None or args.end == None or args.output_file == None:
+                print("Start, end and output file are required to extract time window!")
+                print("Exiting!")
+                sys.exit(1)
+
+            with open_index(args.input_file) as index:
+                reference = index.record(0)[0] if index.count > 0 else 0
+
+            epochs = extract_window(args.input_file, args.output_file,
+                                    parse_time(args.start, reference),
+                                    parse_time(args.end, reference))
+
+            print("Number of extracted epochs: " + str(epochs))
+
+    except (ValueError, EnvironmentError) as e:
+        print(e)
+        print("Exiting!")
+        sys.exit(1)
+
+    stop = time.time()
+    delta = stop - start
+    print("Processing time: %.2f s\n" % delta)
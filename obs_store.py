@@ -0,0 +1,424 @@
+"""
+  @file obs_store.py
+  @brief Routines to collect RINEX observations into NumPy arrays and export them as NPZ or Parquet
+
+  @author Michal Zygmunt
+
+  @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
+
+  @license See LICENSE file for license details.
+
+  @todo none
+  @bug none
+"""
+
+import argparse
+import itertools
+import os.path
+import sys
+import time
+
+import obs_index
+
+# NumPy is needed by observation store and pyarrow by Parquet files only
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+#%% Observation store
+#   Obs fixer passes every written epoch to ObsStore, so observations are
+#   collected while lines stream through, without parsing RINEX text again.
+#   Rows are kept as bytes until 'batch_lines' of them are collected; then
+#   the batch is joined, split at line ends, cut into fixed-width fields
+#   and converted at once by NumPy, so no Python code runs per row.
+#   Each observation of one signal of one satellite in one epoch is one
+#   record of structured array with indices of epoch, satellite and signal
+#   code (e.g. '1C') and its pseudorange, carrier phase, Doppler and signal
+#   strength (NaN if missing), LLI and signal strength indicator.
+
+# number of rows converted at once
+batch_lines = 64 * 1024
+
+# observable type letter -> record field
+type_fields = {'C': "pr", 'L': "cp", 'D': "dop", 'S': "snr"}
+
+# width of observation field and of value in it
+field_width = 16
+value_width = 14
+
+blank_value = b' ' * value_width
+
+
+# raise error if NumPy isn't available
+def check_numpy():
+    if numpy == None:
+        raise RuntimeError("Python package 'numpy' is required for observation store!")
+
+
+# raise error if pyarrow isn't available
+def check_pyarrow():
+    if pyarrow == None:
+        raise RuntimeError("Python package 'pyarrow' is required for Parquet files!")
+
+
+# return dtype of observation records
+def record_dtype():
+    return numpy.dtype([("epoch", numpy.uint32), ("sat", numpy.uint16), ("code", numpy.uint16),
+                        ("pr", numpy.float64), ("cp", numpy.float64), ("dop", numpy.float32),
+                        ("snr", numpy.float32), ("lli", numpy.uint8), ("ssi", numpy.uint8)])
+
+
+# return format of store file 'path' by its extension: 'npz' or 'parquet'
+def store_format(path):
+
+    ext = os.path.splitext(path)[1].lower()
+
+    if ext == '.npz':
+        return 'npz'
+
+    if ext in ('.parquet', '.pq'):
+        return 'parquet'
+
+    raise ValueError("Unknown format of observation store: " + path)
+
+
+# raise error if store can't be saved as file 'path' (unknown format or
+# missing package)
+def check_store(path):
+
+    check_numpy()
+
+    if store_format(path) == 'parquet':
+        check_pyarrow()
+
+
+# collector of observations of RINEX obs file; epochs are added by obs fixer
+# (or by build_store for existing file) and arrays are saved by save
+class ObsStore(object):
+
+    def __init__(self):
+
+        check_numpy()
+
+        # obs types of each system from header
+        self.types = {}
+
+        # epoch times [GPS ms] and flags
+        self.times = []
+        self.flags = []
+
+        # satellites and signal codes, indexed by records
+        self.sats = []
+        self.sat_index = {}
+        self.codes = []
+        self.code_index = {}
+
+        # record fields converted from obs values
+        self.fields = set(type_fields.values())
+
+        # epochs waiting for conversion as (epoch, rows)
+        self.pending = []
+        self.pending_lines = 0
+
+        # converted batches of records
+        self.batches = []
+
+    # read obs types from header lines 'lines' (bytes)
+    def add_header(self, lines):
+
+        system = None
+
+        for line in lines:
+            if line[60:79] != b"SYS / # / OBS TYPES":
+                continue
+
+            if line[:1] != b' ':
+                system = line[:1].decode()
+                self.types[system] = []
+
+            self.types[system] += line[7:60].decode().split()
+
+    # add epoch of epoch row 'epoch' (bytes) with observation rows 'lines'
+    def add(self, epoch, lines):
+
+        # special events don't contain observations
+        flag = epoch[31:32]
+        if flag not in (b' ', b'0', b'1'):
+            return
+
+        item = len(self.times)
+        self.times.append(obs_index.epoch_time(epoch))
+        self.flags.append(int(flag) if flag != b' ' else 0)
+
+        self.pending.append((item, lines))
+        self.pending_lines += len(lines)
+        if self.pending_lines >= batch_lines:
+            self.convert()
+
+    # return index of satellite 'sat'
+    def sat_id(self, sat):
+
+        if sat not in self.sat_index:
+            self.sat_index[sat] = len(self.sats)
+            self.sats.append(sat)
+
+        return self.sat_index[sat]
+
+    # return index of signal code 'code'
+    def code_id(self, code):
+
+        if code not in self.code_index:
+            self.code_index[code] = len(self.codes)
+            self.codes.append(code)
+
+        return self.code_index[code]
+
+    # convert pending rows into records
+    def convert(self):
+
+        pending = self.pending
+        self.pending = []
+        self.pending_lines = 0
+
+        if not pending:
+            return
+
+        lines = list(itertools.chain.from_iterable([lines for item, lines in pending]))
+        epochs = numpy.repeat(numpy.array([item for item, lines in pending], dtype=numpy.uint32),
+                              [len(lines) for item, lines in pending])
+
+        # rows are found by line ends, so the last line of file must have
+        # one; blanks after the last row let each row be cut at full width
+        width = 3 + field_width * max([len(types) for types in self.types.values()] + [0])
+        data = b"".join(lines)
+        if data.count(b'\n') != len(lines):
+            data = b"".join([line if line[-1:] == b'\n' else line + b'\n' for line in lines])
+        buffer = numpy.frombuffer(data + b' ' * width, dtype=numpy.uint8)
+
+        ends = numpy.flatnonzero(buffer == 10)
+
+        starts = numpy.zeros(len(ends), dtype=numpy.int64)
+        starts[1:] = ends[:-1] + 1
+        lengths = ends - starts
+        lengths -= (lengths > 0) & (buffer[ends - 1] == 13)
+
+        # the first char of row is system
+        systems = buffer[starts]
+
+        for system, types in self.types.items():
+            rows = numpy.flatnonzero(systems == ord(system))
+            if len(rows) == 0 or not types:
+                continue
+
+            # rows cut or padded to the same width form 2D array of chars;
+            # rows are copied from view of buffer at each offset
+            columns = numpy.arange(3 + field_width * len(types))
+            windows = numpy.lib.stride_tricks.sliding_window_view(buffer, len(columns))
+            chars = windows[starts[rows]]
+            chars[columns >= lengths[rows, None]] = 32
+
+            self.convert_rows(types, epochs[rows], chars)
+
+    # convert rows of one system with obs 'types' given as 2D array of
+    # 'chars' into records; 'epochs' are indices of epochs of rows
+    def convert_rows(self, types, epochs, chars):
+
+        # satellites are looked up once for each distinct id
+        keys = (chars[:, 0].astype(numpy.int32) << 16) | \
+            (chars[:, 1].astype(numpy.int32) << 8) | chars[:, 2]
+        keys, first, inverse = numpy.unique(keys, return_index=True, return_inverse=True)
+        ids = numpy.array([self.sat_id(chars[row, :3].tobytes().decode()) for row in first],
+                          dtype=numpy.uint16)
+
+        rows = len(chars)
+        sats = ids[inverse.ravel()]
+        self.add_rows(epochs, sats)
+
+        # columns of each signal code, in order of obs types
+        codes = {}
+        for index, obs_type in enumerate(types):
+            codes.setdefault(obs_type[1:], []).append((obs_type[0], index))
+
+        for code, columns in codes.items():
+
+            records = numpy.zeros(rows, dtype=record_dtype())
+            records["epoch"] = epochs
+            records["sat"] = sats
+            records["code"] = self.code_id(code)
+
+            present = numpy.zeros(rows, dtype=bool)
+
+            for field in ("pr", "cp", "dop", "snr"):
+                records[field] = numpy.nan
+
+            for kind, index in columns:
+
+                start = 3 + field_width * index
+                values = numpy.ascontiguousarray(
+                    chars[:, start:start + value_width]).view('S%d' % value_width).ravel()
+
+                blank = values == blank_value
+                present |= ~blank
+
+                if type_fields.get(kind) in self.fields:
+                    field = type_fields[kind]
+                    records[field] = numpy.where(blank, b'nan', values).astype(numpy.float64)
+
+                # LLI of phase and signal strength indicator of each value
+                flags = chars[:, start + value_width:start + field_width]
+                if kind == 'L':
+                    records["lli"] = numpy.where(flags[:, 0] == 32, 0, flags[:, 0] - 48)
+                ssi = numpy.where(flags[:, 1] == 32, 0, flags[:, 1] - 48)
+                records["ssi"] = numpy.maximum(records["ssi"], ssi)
+
+            self.add_records(records[present])
+
+    # add epoch and satellite indices 'epochs' and 'sats' of converted rows;
+    # used by subclasses collecting only statistics of rows
+    def add_rows(self, epochs, sats):
+        pass
+
+    # add converted 'records' of one signal code of one system
+    def add_records(self, records):
+        self.batches.append(records)
+
+    # return all records as one structured array
+    def records(self):
+
+        self.convert()
+
+        if len(self.batches) != 1:
+            self.batches = [numpy.concatenate(self.batches) if self.batches else
+                            numpy.zeros(0, dtype=record_dtype())]
+
+        return self.batches[0]
+
+    # return arrays of store as dictionary
+    def arrays(self):
+        return {"obs": self.records(),
+                "times": numpy.array(self.times, dtype=numpy.int64),
+                "flags": numpy.array(self.flags, dtype=numpy.uint8),
+                "sats": numpy.array(self.sats, dtype='U3'),
+                "codes": numpy.array(self.codes, dtype='U2')}
+
+    # save store as file 'path' in format given by its extension
+    def save(self, path):
+
+        arrays = self.arrays()
+
+        if store_format(path) == 'npz':
+            # file object keeps name without extra '.npz' added by NumPy
+            with open(path, 'wb') as out_file:
+                numpy.savez_compressed(out_file, **arrays)
+            return
+
+        check_pyarrow()
+
+        obs = arrays["obs"]
+        columns = {"time": arrays["times"][obs["epoch"]],
+                   "flag": arrays["flags"][obs["epoch"]],
+                   "sat": pyarrow.DictionaryArray.from_arrays(obs["sat"].astype(numpy.int32),
+                                                              list(arrays["sats"])),
+                   "code": pyarrow.DictionaryArray.from_arrays(obs["code"].astype(numpy.int32),
+                                                               list(arrays["codes"]))}
+        for field in ("pr", "cp", "dop", "snr", "lli", "ssi"):
+            columns[field] = obs[field]
+
+        pyarrow.parquet.write_table(pyarrow.table(columns), path, compression='zstd')
+
+
+# return arrays of store file 'path' saved by ObsStore.save as dictionary
+# (see ObsStore.arrays); Parquet file is returned as its table columns
+def load_store(path):
+
+    if store_format(path) == 'npz':
+        check_numpy()
+        with numpy.load(path) as data:
+            return dict((name, data[name]) for name in data.files)
+
+    check_pyarrow()
+    table = pyarrow.parquet.read_table(path)
+
+    return dict((name, table.column(name).to_numpy()) for name in table.column_names)
+
+
+# build store of existing obs file 'obs_path' and save it as 'store_path';
+# returns number of records
+def build_store(obs_path, store_path):
+
+    store = ObsStore()
+
+    with open(obs_path, 'rb') as in_file:
+
+        header = []
+        for line in in_file:
+            header.append(line)
+            if line[60:73] == b"END OF HEADER":
+                break
+        store.add_header(header)
+
+        epoch = None
+        lines = []
+
+        for line in in_file:
+            if line[:1] == b'>':
+                if epoch != None:
+                    store.add(epoch, lines)
+                epoch = line
+                lines = []
+            else:
+                lines.append(line)
+
+        if epoch != None:
+            store.add(epoch, lines)
+
+    records = len(store.records())
+    store.save(store_path)
+
+    return records
+
+
+if __name__ == "__main__":
+
+    start = time.time()
+
+    #%% Read input arguments
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_file", type=str,
+                        help="input RINEX obs file (uncompressed).")
+    parser.add_argument("-o", "--output_file", type=str,
+                        help="output store file: <name>.npz or <name>.parquet. " \
+                            "If not specified, <input_file>.npz is written.")
+    args = parser.parse_args()
+
+    if os.path.isfile(args.input_file) == False:
+        print("Can't locate file: " + args.input_file)
+        print("Exiting!")
+        sys.exit(1)
+
+    output_file = args.output_file
+    if output_file == None:
+        output_file = args.input_file + ".npz"
+
+    #%% Build store
+
+    try:
+        records = build_store(args.input_file, output_file)
+    except (ValueError, RuntimeError, EnvironmentError) as e:
+        print(e)
+        print("Exiting!")
+        sys.exit(1)
+
+    print("Number of observation records: " + str(records))
+
+    stop = time.time()
+    delta = stop - start
+    print("Processing time: %.2f s\n" % delta)
@@ -0,0 +1,323 @@
+"""
+  @file rinex_writer.py
+  @brief Routines to format RINEX 3.04 obs and nav files from decoded RTCM 3 data
+
+  @author Michal Zygmunt
+
+  @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
+
+  @license See LICENSE file for license details.
+
+  @todo none
+  @bug none
+"""
+
+import datetime
+
+import rtcm3_decoder
+
+# name of program written to RINEX headers
+program_name = "RTCM2RINEX"
+
+# GPS time epoch
+gps_epoch = datetime.datetime(1980, 1, 6)
+
+
+#%% Helper routines
+
+# return calendar date and time of GPS time 'time' [ms]
+def gps_ms_to_datetime(time):
+    return gps_epoch + datetime.timedelta(milliseconds=time)
+
+
+# return RINEX header line with 'content' and 'label'
+def header_line(content, label):
+    return "%-60s%-20s\n" % (content, label)
+
+
+# return header line with program name and date of file creation
+def program_line():
+    now = datetime.datetime.utcnow()
+    return header_line("%-20s%-20s%-20s" % (program_name, "",
+                                            now.strftime("%Y%m%d %H%M%S UTC")),
+                       "PGM / RUN BY / DATE")
+
+
+# return time formatted for TIME OF FIRST / LAST OBS header lines
+def header_time(time):
+    date = gps_ms_to_datetime(time)
+    return "  %04d    %02d    %02d    %02d    %02d%13.7f     GPS" % (
+        date.year, date.month, date.day, date.hour, date.minute,
+        date.second + date.microsecond * 1e-6)
+
+
+# sort satellites by system order and satellite number
+def sat_sort_key(sat):
+    return (rtcm3_decoder.system_order.find(sat[0]), sat)
+
+
+#%% RINEX obs file
+
+# return observation types of each system ({sys: [types]}) for data found
+# by Rtcm3Decoder.scan; codes are sorted by MSM signal id and for each code
+# observables listed in 'kinds' are written: pseudorange (C), carrier
+# phase (L), Doppler (D, if available) and C/N0 (S); like 'convbin', only
+# pseudorange and carrier phase are written by default
+def obs_types(info, kinds="CL"):
+
+    types = {}
+
+    for sys, codes in info["codes"].items():
+
+        order = rtcm3_decoder.msm_signals[sys]
+        codes = sorted(codes, key=lambda code: [sig for sig in order if order[sig] == code][0])
+
+        types[sys] = []
+        for code in codes:
+            for kind in kinds:
+                if kind != "D" or sys in info["doppler"]:
+                    types[sys].append(kind + code)
+
+    return types
+
+
+# return SYS / # / OBS TYPES header lines of 'types' ({sys: [types]}) for
+# systems listed in 'systems'
+def obs_types_lines(types, systems):
+
+    lines = []
+
+    for sys in systems:
+        sys_types = types[sys]
+        for item in range(0, len(sys_types), 13):
+            content = ("%1s  %3d" % (sys, len(sys_types))) if item == 0 else "      "
+            content += "".join([" %3s" % obs_type for obs_type in sys_types[item:item + 13]])
+            lines.append(header_line(content, "SYS / # / OBS TYPES"))
+
+    return lines
+
+
+# return GLONASS SLOT / FRQ # header lines of frequency channels 'fcn'
+# ({sat: channel})
+def glonass_slot_lines(fcn):
+
+    lines = []
+    fcn = sorted(fcn.items())
+
+    for item in range(0, max(len(fcn), 1), 8):
+        content = ("%3d " % len(fcn)) if item == 0 else "    "
+        content += "".join(["%3s %2d " % (sat, channel) for sat, channel in fcn[item:item + 8]])
+        lines.append(header_line(content, "GLONASS SLOT / FRQ #"))
+
+    return lines
+
+
+# return lines of RINEX obs header for data found by Rtcm3Decoder.scan
+def obs_header(info, types, log_name=""):
+
+    lines = [header_line("     3.04           OBSERVATION DATA    M: Mixed",
+                         "RINEX VERSION / TYPE"),
+             program_line(),
+             header_line("format: RTCM 3", "COMMENT")]
+
+    if log_name != "":
+        lines.append(header_line("log: " + log_name, "COMMENT"))
+
+    lines += [header_line("", "MARKER NAME"),
+              header_line("", "MARKER NUMBER"),
+              header_line("", "MARKER TYPE"),
+              header_line("", "OBSERVER / AGENCY"),
+              header_line("", "REC # / TYPE / VERS"),
+              header_line("", "ANT # / TYPE")]
+
+    position = info["position"] or (0.0, 0.0, 0.0)
+    lines.append(header_line("%14.4f%14.4f%14.4f" % position, "APPROX POSITION XYZ"))
+    lines.append(header_line("%14.4f%14.4f%14.4f" % (0.0, 0.0, 0.0), "ANTENNA: DELTA H/E/N"))
+
+    lines += obs_types_lines(types, sorted(types, key=rtcm3_decoder.system_order.find))
+
+    if info["first"] != None:
+        lines.append(header_line(header_time(info["first"]), "TIME OF FIRST OBS"))
+    if info["last"] != None:
+        lines.append(header_line(header_time(info["last"]), "TIME OF LAST OBS"))
+
+    for sys in sorted(types, key=rtcm3_decoder.system_order.find):
+        for obs_type in types[sys]:
+            if obs_type[0] == "L":
+                lines.append(header_line("%1s %3s" % (sys, obs_type), "SYS / PHASE SHIFT"))
+
+    lines += glonass_slot_lines(info["glonass_fcn"])
+
+    lines.append(header_line(" C1C    0.000 C1P    0.000 C2C    0.000 C2P    0.000",
+                             "GLONASS COD/PHS/BIS"))
+    lines.append(header_line("", "END OF HEADER"))
+
+    return lines
+
+
+# observation kinds in order of values of decoded signals (see
+# Rtcm3Decoder.flush)
+obs_kinds = "CLDS"
+
+# observation field without value
+blank_field = " " * 16
+
+# loss of lock indicator -> text written after carrier phase
+lli_flags = [" "] + ["%1d" % lli for lli in range(1, 10)]
+
+
+# return lines of one epoch 'time' [GPS ms] with 'observations' decoded by
+# Rtcm3Decoder, written as types listed in 'types'
+def epoch_lines(time, observations, types):
+
+    date = gps_ms_to_datetime(time)
+    sats = sorted([sat for sat in observations if sat[0] in types], key=sat_sort_key)
+
+    lines = ["> %04d %02d %02d %02d %02d %010.7f  %d%3d%21s\n" % (
+        date.year, date.month, date.day, date.hour, date.minute,
+        date.second + date.microsecond * 1e-6, 0, len(sats), "")]
+
+    # code and index of value in decoded signal of each observation type
+    columns = dict((sys, [(obs_type[1:], obs_kinds.index(obs_type[0])) for obs_type in sys_types])
+                   for sys, sys_types in types.items())
+
+    for sat in sats:
+
+        signals = observations[sat]
+        fields = [sat]
+
+        for code, kind in columns[sat[0]]:
+
+            signal = signals.get(code)
+            if signal == None:
+                fields.append(blank_field)
+                continue
+
+            value = signal[kind]
+            lli = lli_flags[signal[4]] if kind == 1 else " "
+
+            # loss of lock indicator is written even without phase value
+            if value == None or value == 0.0 or abs(value) >= 1e9:
+                fields.append("              %s " % lli)
+            else:
+                fields.append("%14.3f%s " % (value, lli))
+
+        fields.append("\n")
+        lines.append("".join(fields))
+
+    return lines
+
+
+# return lines of RINEX obs file (header and epochs) for 'events' yielded
+# by Rtcm3Decoder.decode; ephemerides found between observations are
+# stored in 'nav_records' dictionary (see add_nav_record) if it's given;
+# 'kinds' selects observables as in obs_types
+def obs_lines(events, info, nav_records=None, log_name="", kinds="CL"):
+
+    types = obs_types(info, kinds)
+
+    for line in obs_header(info, types, log_name):
+        yield line
+
+    for kind, data in events:
+        if kind == "obs":
+            for line in epoch_lines(data[0], data[1], types):
+                yield line
+        elif kind == "nav" and nav_records != None:
+            add_nav_record(nav_records, data)
+
+
+#%% RINEX nav file
+
+# store ephemeris 'eph' in 'nav_records', unless the same ephemeris
+# (satellite, time of clock and issue of data) is already stored
+def add_nav_record(nav_records, eph):
+    key = (eph["sat"], eph["time"], eph["iode"])
+    if key not in nav_records:
+        nav_records[key] = eph
+
+
+# return lines of RINEX nav header
+def nav_header(log_name=""):
+
+    lines = [header_line("     3.04           N: GNSS NAV DATA    M: Mixed",
+                         "RINEX VERSION / TYPE"),
+             program_line(),
+             header_line("format: RTCM 3", "COMMENT")]
+
+    if log_name != "":
+        lines.append(header_line("log: " + log_name, "COMMENT"))
+
+    lines.append(header_line("", "END OF HEADER"))
+
+    return lines
+
+
+# return value formatted as by convbin_nav_fix.exp_as_string
+def nav_value(value):
+    return "{:19.12E}".format(value)
+
+
+# return lines of one ephemeris record
+def nav_record_lines(eph):
+
+    sys = eph["sys"]
+
+    if sys == 'R':
+        date = gps_ms_to_datetime(eph["toe"])
+        tof = (eph["tof"] % rtcm3_decoder.week_ms) * 0.001
+        rows = [[-eph["taun"], eph["gamn"], tof],
+                [eph["x"], eph["vx"], eph["ax"], eph["svh"]],
+                [eph["y"], eph["vy"], eph["ay"], eph["fcn"]],
+                [eph["z"], eph["vz"], eph["az"], eph["age"]]]
+
+    else:
+        if sys == 'C':
+            # BeiDou records are given in BeiDou time
+            date = gps_ms_to_datetime(eph["time"] + rtcm3_decoder.bdt_offset_ms)
+            week_start = (eph["week"] + 1356) * rtcm3_decoder.week_ms - rtcm3_decoder.bdt_offset_ms
+        else:
+            date = gps_ms_to_datetime(eph["time"])
+            week_start = eph["week"] * rtcm3_decoder.week_ms
+
+        ttr = (eph["ttr"] - week_start) * 0.001
+
+        rows = [[eph["af0"], eph["af1"], eph["af2"]],
+                [eph["iode"], eph["crs"], eph["deln"], eph["m0"]],
+                [eph["cuc"], eph["e"], eph["cus"], eph["sqrta"]],
+                [eph["toe"], eph["cic"], eph["omg0"], eph["cis"]],
+                [eph["i0"], eph["crc"], eph["omg"], eph["omgd"]]]
+
+        if sys == 'G':
+            rows += [[eph["idot"], eph["code"], eph["week"], eph["flag"]],
+                     [eph["sva"], eph["svh"], eph["tgd"], eph["iodc"]],
+                     [ttr, eph["fit"]]]
+        elif sys == 'E':
+            rows += [[eph["idot"], eph["code"], eph["week"], 0.0],
+                     [eph["sva"], eph["svh"], eph["tgd"], eph["tgd2"]],
+                     [ttr]]
+        else:
+            rows += [[eph["idot"], 0.0, eph["week"], 0.0],
+                     [eph["sva"], eph["svh"], eph["tgd"], eph["tgd2"]],
+                     [ttr, eph["iodc"]]]
+
+    line = "%s %04d %02d %02d %02d %02d %02d" % (eph["sat"], date.year, date.month,
+                                                date.day, date.hour, date.minute, date.second)
+    lines = [line + "".join([nav_value(value) for value in rows[0]]) + "\n"]
+
+    for row in rows[1:]:
+        lines.append("    " + "".join([nav_value(value) for value in row]) + "\n")
+
+    return lines
+
+
+# return lines of RINEX nav file with records stored in 'nav_records',
+# sorted by system, satellite and time
+def nav_lines(nav_records, log_name=""):
+
+    for line in nav_header(log_name):
+        yield line
+
+    for key in sorted(nav_records, key=lambda key: (sat_sort_key(key[0]), key[1], key[2])):
+        for line in nav_record_lines(nav_records[key]):
+            yield line
@@ -1,16 +1,16 @@
 """
   @file rtcm2rinex.py
   @brief Routines to automate converting RTCM messages to RINEX obs and nav files
- 
+
   @author Michal Zygmunt
- 
+
   @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
- 
+
   @license See LICENSE file for license details.
- 
+
   @todo none
   @bug none
- 
+
   $Date: 2021-11-24 14:19:11 +0200 (sr., 24 lis 2021) $
   $Revision: 2059 $
   $LastChangedBy: mzygmunt $
@@ -18,215 +18,776 @@
 
 import argparse
 import datetime
+import mmap
 import os
 import platform
+import shutil
 import subprocess
 import sys
+import tempfile
 import time
 
-#%% get platform and python version
+import compressed_io
+import conversion_cache
+import convbin_nav_fix
+import convbin_obs_fix
+import frame_filter
+import incremental_convert
+import log_demux
+import nmea_track
+import obs_index
+import obs_qc
+import obs_store
+import rinex_writer
+import rtcm3_decoder
+import rtcm_scan
+import run_metrics
+import session_split
+import stage_profiler
+import stage_scheduler
+
+# directory containing this script and prebuilt 'convbin' binaries
+app_dir = os.path.dirname(os.path.abspath(__file__))
 
-op_sys = platform.system()
-if op_sys != "Windows" and op_sys != "Linux":
-    print('CONVBIN was not compiled for ' + op_sys + ' platform!')
-    print('Exiting!')
-    sys.exit()
 
-python_app = ""
-if sys.version_info[0] == 2:
+#%% Helper routines
+
+# get path of 'convbin' binary compiled for current platform
+def convbin_app():
+
+    op_sys = platform.system()
+
     if op_sys == "Windows":
-        python_app = "python"
+        return os.path.join(app_dir, 'convbin.exe')
+
     if op_sys == "Linux":
-        python_app = "python2"
-        
-elif sys.version_info[0] == 3:
-        python_app = "python3"
-
-else:
-    print("Unrecognized version of Python detected!")
-    print("Exiting!")
-    sys.exit()
-
-#%% Read input arguments
-
-parser = argparse.ArgumentParser()
-parser.add_argument("date", type=str,
-                    help="calendar date of beginning of RTCM messages as <YYYY/MM/DD>. " \
-                        "RTCM messages doesn't contain gnss week information. " \
-                        "Almost any date can be used, but only correct date ensures " \
-                        "real-life values in RINEX file.")
-parser.add_argument("input_file", type=str,
-                    help="RTCM binary <input_file> to process. " \
-                        "File path can be aboslute or relative.")
-parser.add_argument("-d", "--dest", type=str,
-                    help="destination <directory> to save RINEX files. " \
-                        "Directory path can be absolute or relative.")
-args = parser.parse_args()
-
-in_time = args.date
-in_file_path_name = args.input_file
-out_dir_path = args.dest
-   
-#%% Sanity check for input parameters
-
-# check if date string is valid date object
-is_valid_date = True
-try:
-    year, month, day = in_time.split('/')
-    datetime.datetime(int(year), int(month), int(day))
-except ValueError:
-    is_valid_date = False
-
-if is_valid_date == False:
-    print("Input date is invalid!")
-    print("Exiting!")
-    sys.exit()
-
-# check validity of input file
-in_file_path = ""
-in_file_name = ""
-in_file_ext = ""
-
-if os.path.exists(in_file_path_name) == True:
-    
+        return os.path.join(app_dir, 'convbin')
+
+    raise OSError('CONVBIN was not compiled for ' + op_sys + ' platform!')
+
+
+# return paths of files of conversion pipeline, which are part of cache keys
+def pipeline_files(decoder, demux, filters=None):
+
+    paths = [convbin_nav_fix.__file__, convbin_obs_fix.__file__, compressed_io.__file__]
+
+    if decoder == 'native':
+        paths += [rtcm3_decoder.__file__, rinex_writer.__file__]
+    else:
+        paths.append(convbin_app())
+
+    if demux == True:
+        paths.append(log_demux.__file__)
+
+    if filters != None:
+        paths.append(frame_filter.__file__)
+
+    return paths
+
+
+# check if date string is valid <YYYY/MM/DD> date
+def is_valid_date(date):
+
+    try:
+        year, month, day = date.split('/')
+        datetime.datetime(int(year), int(month), int(day))
+    except ValueError:
+        return False
+
+    return True
+
+
+# check validity of input file and return its name without extension
+def check_input_file(in_file_path_name):
+
+    if in_file_path_name == "":
+        raise IOError("Missing input file!")
+
+    if os.path.exists(in_file_path_name) == False:
+        raise IOError("Can't locate file: " + in_file_path_name)
+
     # return filename.ext
     file_name_ext = os.path.basename(in_file_path_name)
-    
-    if file_name_ext == '':
-        print("Directory specified instead of file!")
-        print("Exiting!")
-        sys.exit()
-    
+
+    if file_name_ext == '' or os.path.isdir(in_file_path_name):
+        raise IOError("Directory specified instead of file!")
+
     if os.access(in_file_path_name, os.R_OK) == False:
-        print("User don't have access rights to read specified file!")
-        print("Exiting!")
-        sys.exit()
-    
+        raise IOError("User don't have access rights to read specified file!")
+
     #split filename.ext into filename and ext
     in_file_name, in_file_ext = os.path.splitext(file_name_ext)
-    
-    # get input file directory path by cutting file name from path string 
-    in_file_path = in_file_path_name[0:-len(file_name_ext)]
-    # normalize path to remove slash from path
-    in_file_path = os.path.normpath(in_file_path)
-    
-elif in_file_name == "":
-     print("Missing input file!")
-     print("Exiting!")
-     sys.exit()
-
-else:
-    print("Can't locate file: " + in_file_path_name)
-    print("Exiting!")
-    sys.exit()
-
-# check output directory
-if out_dir_path == None:
-    out_dir_path = in_file_path
-
-out_dir_path = os.path.normpath(out_dir_path)
-
-if os.path.exists(out_dir_path) == False:
-    # try creating output directory
-    try:
+
+    return in_file_name
+
+
+# run 'convbin' to convert RTCM <in_file_path_name> into RINEX obs and nav
+# files stored in <out_dir_path>; returns paths of both files
+def run_convbin(date, in_file_path_name, out_dir_path):
+
+    arg_app = convbin_app()
+    arg_time = ['-tr', date, '00:00:00']
+    arg_format = ['-r', 'rtcm3']
+    arg_out_path = ['-d', out_dir_path]
+    arg_file = [in_file_path_name]
+
+    convbin_command = [arg_app] + arg_time + arg_format + arg_out_path + arg_file
+    output = subprocess.call(convbin_command)
+
+    if output != 0:
+        raise RuntimeError("Convbin returned invalid output!")
+
+    in_file_name = os.path.splitext(os.path.basename(in_file_path_name))[0]
+    obs_path = os.path.join(out_dir_path, in_file_name + '.obs')
+    nav_path = os.path.join(out_dir_path, in_file_name + '.nav')
+
+    for path in [obs_path, nav_path]:
+        if not os.path.exists(path):
+            raise IOError("Can't locate file: " + path)
+
+    return obs_path, nav_path
+
+
+# decode RTCM <in_file_path_name> by native decoder (see rtcm3_decoder)
+# into RINEX obs and nav files stored in <out_dir_path>; file names and
+# returned values are the same as of run_convbin; counters of frames are
+# stored in 'metrics' (run_metrics.RunMetrics) if it's given
+def run_native_decoder(date, in_file_path_name, out_dir_path, metrics=None):
+
+    in_file_name = os.path.splitext(os.path.basename(in_file_path_name))[0]
+    log_name = os.path.basename(in_file_path_name)
+    obs_path = os.path.join(out_dir_path, in_file_name + '.obs')
+    nav_path = os.path.join(out_dir_path, in_file_name + '.nav')
+
+    with open(in_file_path_name, 'rb') as in_file:
+
+        if os.fstat(in_file.fileno()).st_size == 0:
+            raise RuntimeError("Input file doesn't contain RTCM messages!")
+
+        data = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            # frames are found once; first pass collects data of RINEX obs
+            # header, second one decodes observations and ephemerides
+            stats = rtcm3_decoder.frame_stats()
+            offsets = rtcm_scan.find_frames(data, stats)
+
+            info = rtcm3_decoder.Rtcm3Decoder(date).scan(rtcm3_decoder.frames_at(data, offsets))
+
+            decoder = rtcm3_decoder.Rtcm3Decoder(date)
+            events = decoder.decode(rtcm3_decoder.frames_at(data, offsets))
+
+            nav_records = {}
+
+            with open(obs_path, 'w') as out_file:
+                out_file.writelines(rinex_writer.obs_lines(events, info, nav_records, log_name))
+
+            with open(nav_path, 'w') as out_file:
+                out_file.writelines(rinex_writer.nav_lines(nav_records, log_name))
+
+        finally:
+            data.close()
+
+    if stats["frames"] == 0:
+        raise RuntimeError("Input file doesn't contain RTCM messages!")
+
+    print("Number of RTCM messages: %d (CRC errors: %d)" % (stats["frames"], stats["crc_errors"]))
+
+    if metrics != None:
+        metrics.count_frames(stats, decoder.unknown_messages)
+
+    return obs_path, nav_path
+
+
+# add totals of obs quality statistics 'summary' (see obs_qc) to counters of
+# 'metrics'
+def count_qc(metrics, summary):
+
+    total = obs_qc.totals(summary)
+
+    metrics.count("data_gaps", total["gaps"])
+    metrics.count("phase_jumps", total["phase_jumps"])
+
+
+#%% Conversion pipeline
+
+# convert RTCM binary <in_file_path_name> recorded on <date> (<YYYY/MM/DD>)
+# into fixed RINEX obs and nav files saved in <out_dir_path> (input file
+# directory by default); all stages run in this process, nav and obs
+# fixers run concurrently (also with 'convbin' if its output is streamed,
+# see stage_scheduler) and fixed files replace destination files when all
+# stages succeed; 'window' > 0 enables merging of
+# duplicated obs epochs which are not consecutive (see convbin_obs_fix);
+# 'decoder' selects RTCM decoder: 'convbin' or 'native' (rtcm3_decoder);
+# 'demux' enables splitting of capture log into clean RTCM stream, which
+# is passed to decoder (see log_demux); 'resume' enables conversion of data
+# appended since previous run, which is saved in checkpoint file (native
+# decoder is used, see incremental_convert); if 'cache_dir' is given, files
+# converted before from the same content and arguments are copied from
+# cache (see conversion_cache); input file may be compressed by gzip or
+# zstd; 'crx' enables Compact RINEX obs file and 'compress' ('gz', 'zst')
+# compression of output files (see compressed_io); 'filters' is dictionary
+# of options of make_filter (time window, constellations, message types),
+# which select RTCM frames passed to decoder (see frame_filter); metrics of
+# stages and counters of data are stored in 'metrics' (RunMetrics, see
+# run_metrics) if it's given; 'profile' enables profiling of stages, which
+# reports are saved in destination directory, and 'sample' > 0 printing of
+# rate of lines processed by fixers every 'sample' seconds (see
+# stage_profiler); 'store' ('npz', 'parquet') enables saving observations
+# as NumPy arrays next to obs file (see obs_store); 'track' ('csv',
+# 'parquet') enables saving position track of NMEA GGA sentences of input
+# log as <input_file>_track.<track> (see nmea_track); 'session' > 0 [s]
+# enables splitting of obs and nav files into files of sessions of this
+# length named <input_file>_<YYYYMMDD>_<HHMM> (see session_split); 'qc'
+# enables saving quality statistics of satellites and signals collected
+# while obs file is fixed as <input_file>_qc.json and .csv (see obs_qc),
+# it's off by default as it raises fix time of obs file about 3 times;
+# 'nav_workers' > 1 is number of processes fixing nav file decoded to
+# scratch file (see convbin_nav_fix.fix_nav_parallel); returns paths of obs
+# and nav files (lists of paths of session files if 'session' is given)
+def convert(date, in_file_path_name, out_dir_path=None, window=0, decoder='convbin',
+            demux=False, resume=False, cache_dir=None, crx=False, compress=None,
+            filters=None, metrics=None, profile=False, sample=0, store=None, track=None,
+            session=None, qc=False, nav_workers=1):
+
+    #%% Sanity check for input parameters
+
+    if is_valid_date(date) == False:
+        raise ValueError("Input date is invalid!")
+
+    if decoder not in ('convbin', 'native'):
+        raise ValueError("Unknown decoder: " + decoder)
+
+    if compress not in (None, 'gz', 'zst'):
+        raise ValueError("Unknown compression: " + compress)
+
+    if compress == 'zst':
+        compressed_io.check_zstd()
+
+    if store not in (None, 'npz', 'parquet'):
+        raise ValueError("Unknown format of observation store: " + store)
+
+    if track not in (None,) + nmea_track.track_formats:
+        raise ValueError("Unknown format of track file: " + track)
+
+    if qc == True and obs_qc.numpy == None:
+        raise RuntimeError("Python package 'numpy' is required for obs quality check!")
+
+    # invalid filter options are reported before conversion
+    if filters != None:
+        selection = frame_filter.make_filter(date, **filters)
+
+    in_file_name = check_input_file(in_file_path_name)
+
+    # name of compressed file is used without compression extension
+    compression = compressed_io.file_compression(in_file_path_name)
+
+    if compressed_io.split_compression(in_file_path_name)[1] != "":
+        in_file_name = os.path.splitext(in_file_name)[0]
+
+    if resume == True and (compression != None or crx == True or compress != None):
+        raise ValueError("Resumed conversion supports only uncompressed files!")
+
+    if resume == True and filters != None:
+        raise ValueError("Resumed conversion doesn't support filters!")
+
+    if resume == True and session != None:
+        raise ValueError("Resumed conversion doesn't support sessions!")
+
+    # frames of input are counted by extra scan only if metrics are needed
+    # and native decoder doesn't see all frames of input
+    scan_frames = metrics != None and (decoder != 'native' or demux == True or filters != None)
+
+    if metrics == None:
+        metrics = run_metrics.RunMetrics(in_file_path_name)
+
+    # check output directory
+    if out_dir_path == None:
+        out_dir_path = os.path.dirname(in_file_path_name)
+
+    out_dir_path = os.path.normpath(out_dir_path)
+
+    if os.path.exists(out_dir_path) == False:
         os.makedirs(out_dir_path)
-    except IOError:
-        print(sys.exc_type)
-        sys.exit()
 
-#%% Convert RTCM to RINEX by 'convbin'
+    out_ext = '.' + compress if compress != None else ''
+    out_ro_path = os.path.join(out_dir_path, in_file_name + ('.crx' if crx else '.obs') + out_ext)
+    out_rn_path = os.path.join(out_dir_path, in_file_name + '.nav' + out_ext)
+
+    profiler = stage_profiler.StageProfiler(out_dir_path, in_file_name, profile)
 
-start = time.time()
+    # epoch index is saved next to uncompressed obs file (see obs_index),
+    # which isn't split into sessions
+    index_path = None
+    if crx == False and compress == None and session == None:
+        index_path = out_ro_path + obs_index.index_extension
+
+    store_path = None
+    if store != None:
+        store_path = os.path.join(out_dir_path, in_file_name + '.' + store)
+        obs_store.check_store(store_path)
+
+    qc_paths = (None, None)
+    if qc == True:
+        qc_paths = obs_qc.qc_paths(out_ro_path)
+
+    if track != None:
+        #%% Extract position track of NMEA sentences
+
+        # track doesn't depend on RINEX files, so it's written also when
+        # they're resumed or found in cache
+        track_path = os.path.join(out_dir_path, in_file_name + '_track.' + track)
+        nmea_track.check_track(track_path)
+
+        with metrics.stage("track", [in_file_path_name], [track_path]):
+            stats = nmea_track.extract_to_file(in_file_path_name, track_path, date)
+
+        nmea_track.print_stats(stats)
+        metrics.count("track_records", stats["records"])
+        print("")
+
+    if resume == True:
+        #%% Convert new data of RTCM log and append it to RINEX files
+
+        start = time.time()
+
+        print("Converting new data of RTCM log using native decoder...")
+
+        checkpoint_path = os.path.join(out_dir_path, in_file_name + '.checkpoint')
+
+        with metrics.stage("convert", outputs=[out_ro_path, out_rn_path]), \
+             profiler.stage("convert"):
+            counters = incremental_convert.convert_incremental(
+                date, in_file_path_name, out_ro_path, out_rn_path, checkpoint_path)
+
+        incremental_convert.print_counters(counters)
+
+        # store is built from whole obs file, as appended epochs may be
+        # merged with the last ones
+        if store_path != None:
+            with metrics.stage("store", [out_ro_path], [store_path]):
+                obs_store.build_store(out_ro_path, store_path)
+
+        if qc == True:
+            with metrics.stage("qc", [out_ro_path], list(qc_paths)):
+                count_qc(metrics, obs_qc.build_qc(out_ro_path, *qc_paths))
+
+        metrics.report["stages"]["convert"]["bytes_in"] = counters["bytes"]
+        metrics.count("epochs", counters["epochs"])
+        metrics.count("frames", counters["frames"])
+        metrics.count("crc_errors", counters["crc_errors"])
+
+        stop = time.time()
+        delta = stop - start
+        print("Processing time: %.2f s\n" % delta)
+
+        return out_ro_path, out_rn_path
+
+    # cache keeps whole files only, so files of sessions aren't cached; key
+    # is None if cache isn't used
+    key = None
+    if cache_dir != None and session == None:
+        params = {"date": date, "window": window, "decoder": decoder, "demux": demux,
+                  "crx": crx, "compress": compress, "filters": filters}
+        key = conversion_cache.cache_key(in_file_path_name, params,
+                                         pipeline_files(decoder, demux, filters))
+
+    # store can be built from cached obs file only if it's uncompressed,
+    # otherwise files are converted again (and stored in cache)
+    if key != None and (store_path == None or index_path != None):
+        #%% Look for converted files in cache
+
+        # log comment is written as by decoder
+        log_name = in_file_path_name
+        if decoder == 'native':
+            log_name = os.path.basename(in_file_path_name)
+
+        if conversion_cache.fetch(cache_dir, key, out_ro_path, out_rn_path, log_name):
+            print("Converted files found in cache: " + key + "\n")
+            metrics.report["cache"] = "hit"
+            if index_path != None:
+                obs_index.build_index(out_ro_path, index_path)
+            if store_path != None:
+                obs_store.build_store(out_ro_path, store_path)
+            # Compact RINEX can't be read without decompression
+            if qc == True and crx == False:
+                count_qc(metrics, obs_qc.build_qc(out_ro_path, *qc_paths))
+            return out_ro_path, out_rn_path
+
+        metrics.report["cache"] = "miss"
+
+    # raw decoder output and fixed files are kept in private scratch
+    # directory in destination file system; fixed files replace destination
+    # files atomically when all stages succeed
+    scratch_dir = tempfile.mkdtemp(prefix='.rtcm2rinex_', dir=out_dir_path)
+
+    fixed_dir = os.path.join(scratch_dir, 'fixed')
+    os.mkdir(fixed_dir)
+
+    fix_ro_path = os.path.join(fixed_dir, os.path.basename(out_ro_path))
+    fix_rn_path = os.path.join(fixed_dir, os.path.basename(out_rn_path))
+    fix_index_path = fix_ro_path + obs_index.index_extension if index_path != None else None
+    fix_store_path = os.path.join(fixed_dir, os.path.basename(store_path)) \
+        if store_path != None else None
+    fix_qc_paths = [os.path.join(fixed_dir, os.path.basename(path)) if path != None else None
+                    for path in qc_paths]
+
+    # 'convbin' output is streamed to fixers through named pipes, unless
+    # fixed files are compressed or split into sessions (their headers are
+    # patched in place, see stage_scheduler) or stages are profiled one by
+    # one
+    streaming = decoder == 'convbin' and crx == False and compress == None and \
+        session == None and profile == False and stage_scheduler.fifo_supported()
+
+    # fixed files of sessions: 'obs'/'nav' -> list of paths
+    session_paths = {"obs": [], "nav": []}
+
+    # nav records are written to sessions of obs file when both files are
+    # fixed (see session_split.NavSessions)
+    nav_sessions = obs_sessions = None
+    if session != None:
+        nav_sessions = session_split.NavSessions(fix_rn_path, session)
+        obs_sessions = session_split.ObsSessions(fix_ro_path, session)
+
+    # fix nav file 'source' (path or stream) like fix_nav_file
+    def fix_nav(source):
+
+        with metrics.stage("nav_fix", [in_rn_path],
+                           [fix_rn_path] if nav_sessions == None else []), \
+             profiler.stage("nav_fix"), \
+             stage_profiler.LineMeter("nav_fix", sample) as meter:
+            return convbin_nav_fix.fix_nav_file(
+                source, fix_rn_path if nav_sessions == None else None, meter, nav_sessions,
+                nav_workers)
+
+    # fix obs file 'source' (path or stream) like fix_obs_file and save its
+    # observation store and quality statistics; returns also stats of
+    # written epochs and summary of statistics as obs_stats["qc"]
+    def fix_obs(source):
+
+        obs_stats = {}
+
+        # observations and their statistics are collected while obs file is
+        # fixed
+        obs = obs_store.ObsStore() if store_path != None else None
+        obs_check = obs_qc.ObsQc() if qc == True else None
+
+        sessions = obs_sessions
+
+        with metrics.stage("obs_fix", [in_ro_path],
+                           [fix_ro_path, fix_index_path, fix_store_path] + fix_qc_paths) as stage, \
+             profiler.stage("obs_fix"), \
+             stage_profiler.LineMeter("obs_fix", sample) as meter:
+            try:
+                duplicated_lines, out_of_order_merges = convbin_obs_fix.fix_obs_file(
+                    source, fix_ro_path if sessions == None else None, window, fix_index_path,
+                    obs_stats, meter, obs, sessions, obs_check)
+            finally:
+                if sessions != None:
+                    session_paths["obs"] = sessions.paths()
+                    stage.outputs = session_paths["obs"] + [fix_store_path] + fix_qc_paths
+            if obs != None:
+                obs.save(fix_store_path)
+            if obs_check != None:
+                obs_stats["qc"] = obs_check.save(*fix_qc_paths)
+
+        return duplicated_lines, out_of_order_merges, obs_stats
 
-print("[1/4]: Converting RTCM to RINEX using 'convbin'...")
+    try:
+        #%% Convert RTCM to RINEX by 'convbin'
+
+        start = time.time()
+
+        # decoders need uncompressed file, which is written to scratch
+        # directory in one streaming pass
+        if compression != None:
+            print("Decompressing input file...")
 
-arg_time = '-tr ' + in_time + ' 00:00:00'
-arg_format = '-r rtcm3'
-arg_out_path = '-d ' + out_dir_path
-arg_file = in_file_path_name
+            rtcm_path = os.path.join(scratch_dir, in_file_name + '.rtcm3')
+            with metrics.stage("decompress", [in_file_path_name], [rtcm_path]), \
+                 profiler.stage("decompress"):
+                compressed_io.decompress_file(in_file_path_name, rtcm_path)
+            in_file_path_name = rtcm_path
 
-convbin_command = ''
-output = 0
+        if scan_frames == True:
+            with metrics.stage("scan", [in_file_path_name]):
+                metrics.count_frames(*run_metrics.scan_frames(in_file_path_name))
 
-if op_sys == "Windows":
-    arg_app = 'convbin.exe'
-    
-if op_sys == "Linux":
-    arg_app = '#!./convbin'
+        if demux == True:
+            print("Extracting RTCM frames from capture log...")
 
-convbin_command = ' '.join([arg_app, arg_time, arg_format, arg_out_path, arg_file])
-output = subprocess.call(convbin_command, shell = True)
+            rtcm_path = os.path.join(scratch_dir, in_file_name + '_demux.rtcm3')
+            with metrics.stage("demux", [in_file_path_name], [rtcm_path]), \
+                 profiler.stage("demux"):
+                stats = log_demux.demux_file(in_file_path_name, rtcm_path)
+            log_demux.print_stats(stats)
 
-if output != 0:
-    print("Convbin returned invalid output!")
-    sys.exit()
+            if stats["frames"] == 0:
+                raise RuntimeError("Input file doesn't contain RTCM messages!")
 
-stop = time.time()
-delta = stop - start
-print("Processing time: %.2f s\n" % delta)
+            in_file_path_name = rtcm_path
 
-#%% Fix content of RINEX nav file by re-formatting ephemeris data with 'convbin_nav_fix.py'
+        if filters != None:
+            print("Selecting RTCM frames by filters...")
 
-print("[2/4]: Fixing content of RINEX nav file by re-formatting ephemeris data...")
+            rtcm_path = os.path.join(scratch_dir, in_file_name + '_filtered.rtcm3')
+            with metrics.stage("filter", [in_file_path_name], [rtcm_path]), \
+                 profiler.stage("filter"):
+                stats = frame_filter.filter_file(in_file_path_name, rtcm_path, selection)
+            frame_filter.print_stats(stats)
 
-# create input and output files paths/names
-in_rn_name = in_file_name + '.nav'
-out_rn_name = in_file_name + '_fix.nav'
+            if stats["kept_frames"] == 0:
+                raise RuntimeError("No RTCM messages selected by filters!")
 
-in_rn_path = os.path.join(out_dir_path, in_rn_name)
-out_rn_path = os.path.join(out_dir_path, out_rn_name)
+            in_file_path_name = rtcm_path
 
-if not os.path.exists(in_rn_path):
-    print("Can't locate file: " + in_rn_path)
-    print("Exiting!")
-    sys.exit()
+        if streaming == True:
+            #%% Convert RTCM to RINEX by 'convbin' and fix files it writes
 
-arg_script = '!#./convbin_nav_fix.py ' + in_rn_path + ' -o ' + out_rn_path
-fix_command = ' '.join([python_app, arg_script])
-output = subprocess.call(fix_command, shell = True)
- 
-#%% Fix content of RINEX obs file by removing duplicated epochs by 'convbin_obs_fix.py'
+            print("[1/4]: Converting RTCM to RINEX using 'convbin'...")
+            print("[2/4]: Fixing content of RINEX nav file by re-formatting ephemeris data...")
+            print("[3/4]: Fixing content of RINEX obs file by removing duplicated entries...")
 
-print("[3/4]: Fixing content of RINEX obs file by removing duplicated entries...")
+            # pipes get names of files written by 'convbin'
+            rtcm_name = os.path.splitext(os.path.basename(in_file_path_name))[0]
+            in_ro_path = os.path.join(scratch_dir, rtcm_name + '.obs')
+            in_rn_path = os.path.join(scratch_dir, rtcm_name + '.nav')
 
-# create input and output files paths/names
-in_ro_name = in_file_name + '.obs'
-out_ro_name = in_file_name + '_fix.obs'
+            fifos = []
 
-in_ro_path = os.path.join(out_dir_path, in_ro_name)
-out_ro_path = os.path.join(out_dir_path, out_ro_name)
+            try:
+                fifos = [stage_scheduler.Fifo(in_ro_path), stage_scheduler.Fifo(in_rn_path)]
+                obs_stream, nav_stream = fifos[0].stream(), fifos[1].stream()
 
-if not os.path.exists(in_ro_path):
-    print("Can't locate file: " + in_ro_path)
-    print("Exiting!")
-    sys.exit()
+                # fixers get end of data when 'convbin' ends; 'convbin' is
+                # stopped by broken pipe if fixer fails, so errors of fixers
+                # are raised first
+                def decode():
+                    try:
+                        with metrics.stage("convert", [in_file_path_name]):
+                            run_convbin(date, in_file_path_name, scratch_dir)
+                    finally:
+                        for fifo in fifos:
+                            fifo.close_writer()
 
-arg_script = '!#./convbin_obs_fix.py ' + in_ro_path + ' -o ' + out_ro_path
-fix_command = ' '.join([python_app, arg_script])
-output = subprocess.call(fix_command, shell = True)
+                results = stage_scheduler.run_concurrent([(fix_nav, [nav_stream]),
+                                                          (fix_obs, [obs_stream]), (decode, [])])
 
-#%% Process temporary output files
+            finally:
+                for fifo in fifos:
+                    fifo.close()
 
-print("[4/4] Finishing files operations...")
+            val_updated = results[0]
+            duplicated_lines, out_of_order_merges, obs_stats = results[1]
 
-# replace original obs output from 'convbin' with fixed obs file
-file_to_change = os.path.join(out_dir_path, in_file_name)
+            # header rewritten by 'convbin' at the end replaces header of
+            # fixed files; index is built again if offsets of epochs moved
+            stage_scheduler.patch_header(fix_rn_path, nav_stream.trailer)
+            if stage_scheduler.patch_header(fix_ro_path, obs_stream.trailer) == True and \
+               fix_index_path != None:
+                obs_index.build_index(fix_ro_path, fix_index_path)
 
-# nav files
-if os.path.exists(file_to_change + '.nav') == True:
-    os.remove(file_to_change + '.nav')
-    #print("File deleted: " + file_to_change + '.nav')
+        else:
+            with metrics.stage("convert", [in_file_path_name]) as stage, \
+                 profiler.stage("convert"):
 
-if os.path.exists(file_to_change + '_fix.nav') == True:
-    os.rename(file_to_change + '_fix.nav', file_to_change + '.nav')
-    #print("File renamed: " + file_to_change + '_fix.nav ->', file_to_change + '.nav')
+                if decoder == 'native':
+                    print("[1/4]: Converting RTCM to RINEX using native decoder...")
 
-# obs files
-if os.path.exists(file_to_change + '.obs') == True:
-    os.remove(file_to_change + '.obs')
-    #print("File deleted: " + file_to_change + '.obs')
+                    in_ro_path, in_rn_path = run_native_decoder(
+                        date, in_file_path_name, scratch_dir, None if scan_frames else metrics)
 
-if os.path.exists(file_to_change + '_fix.obs') == True:
-    os.rename(file_to_change + '_fix.obs', file_to_change + '.obs')
-    #print("File renamed: " + file_to_change + '_fix.obs ->', file_to_change + '.obs')
+                else:
+                    print("[1/4]: Converting RTCM to RINEX using 'convbin'...")
+
+                    in_ro_path, in_rn_path = run_convbin(date, in_file_path_name, scratch_dir)
+
+                stage.outputs = [in_ro_path, in_rn_path]
+
+            stop = time.time()
+            delta = stop - start
+            print("Processing time: %.2f s\n" % delta)
+
+            #%% Fix content of RINEX nav and obs files
+
+            start = time.time()
+
+            print("[2/4]: Fixing content of RINEX nav file by re-formatting ephemeris data...")
+            print("[3/4]: Fixing content of RINEX obs file by removing duplicated entries...")
+
+            # profiled stages run one by one, as profilers trace the whole
+            # process
+            if profile == True:
+                val_updated = fix_nav(in_rn_path)
+                duplicated_lines, out_of_order_merges, obs_stats = fix_obs(in_ro_path)
+            else:
+                val_updated, (duplicated_lines, out_of_order_merges, obs_stats) = \
+                    stage_scheduler.run_concurrent([(fix_nav, [in_rn_path]),
+                                                    (fix_obs, [in_ro_path])])
+
+        if nav_sessions != None:
+            with metrics.stage("nav_sessions", [in_rn_path]) as stage:
+                session_paths["nav"] = stage.outputs = \
+                    nav_sessions.close(obs_sessions.starts())
+
+        print("Number of updated values: " + str(val_updated))
+        print("Number of duplicated lines removed: " + str(duplicated_lines))
+
+        if window > 0:
+            print("Number of out of order merges: " + str(out_of_order_merges))
+
+        if "qc" in obs_stats:
+            obs_qc.print_summary(obs_stats["qc"])
+            count_qc(metrics, obs_stats["qc"])
+
+        metrics.count("nav_values_rewritten", val_updated)
+        metrics.count("epochs", obs_stats["epochs"])
+        metrics.count("satellites", obs_stats["satellites"])
+        metrics.count("duplicated_rows", duplicated_lines)
+        metrics.count("out_of_order_merges", out_of_order_merges)
+
+        stop = time.time()
+        delta = stop - start
+        print("Processing time: %.2f s\n" % delta)
+
+        #%% Move fixed files to destination
+
+        print("[4/4] Finishing files operations...")
+
+        with metrics.stage("finish"), profiler.stage("finish"):
+            stage_scheduler.replace_files([(fix_rn_path, out_rn_path), (fix_ro_path, out_ro_path),
+                                           (fix_index_path, index_path),
+                                           (fix_store_path, store_path)] +
+                                          list(zip(fix_qc_paths, qc_paths)) +
+                                          [(path, os.path.join(out_dir_path, os.path.basename(path)))
+                                           for path in session_paths["obs"] + session_paths["nav"]])
+
+        # files of sessions are moved with their names
+        if session != None:
+            out_ro_path, out_rn_path = [
+                [os.path.join(out_dir_path, os.path.basename(path)) for path in session_paths[kind]]
+                for kind in ("obs", "nav")]
+
+        if key != None:
+            # failure of cache doesn't fail conversion
+            try:
+                conversion_cache.store(cache_dir, key, out_ro_path, out_rn_path)
+                conversion_cache.evict(cache_dir)
+            except EnvironmentError as e:
+                print("Can't store converted files in cache: " + str(e))
+
+    finally:
+        #%% Remove temporary files
+
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    return out_ro_path, out_rn_path
+
+
+if __name__ == "__main__":
+
+    #%% Read input arguments
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("date", type=str,
+                        help="calendar date of beginning of RTCM messages as <YYYY/MM/DD>. " \
+                            "RTCM messages doesn't contain gnss week information. " \
+                            "Almost any date can be used, but only correct date ensures " \
+                            "real-life values in RINEX file.")
+    parser.add_argument("input_file", type=str,
+                        help="RTCM binary <input_file> to process, optionally compressed " \
+                            "by gzip or zstd. File path can be aboslute or relative.")
+    parser.add_argument("-d", "--dest", type=str,
+                        help="destination <directory> to save RINEX files. " \
+                            "Directory path can be absolute or relative.")
+    parser.add_argument("-w", "--window", type=int, default=0,
+                        help="number of recent epochs kept in memory to merge " \
+                            "duplicated obs epochs which are not consecutive. " \
+                            "If not specified, only consecutive epochs are merged.")
+    parser.add_argument("--decoder", type=str, choices=['convbin', 'native'], default='convbin',
+                        help="RTCM decoder used to create RINEX files: prebuilt 'convbin' " \
+                            "binary or 'native' Python decoder. 'convbin' is used by default.")
+    parser.add_argument("--demux", action='store_true',
+                        help="extract valid RTCM frames from capture log (e.g. PuTTY log " \
+                            "with NMEA sentences) before conversion.")
+    parser.add_argument("--resume", action='store_true',
+                        help="convert only data appended since previous run and append it " \
+                            "to RINEX files; progress is saved in <input_file>.checkpoint " \
+                            "file in destination directory. Native decoder is used, " \
+                            "which skips non-RTCM data itself.")
+    parser.add_argument("-c", "--cache", type=str,
+                        help="cache <directory> with converted files, reused when the same " \
+                            "input content is converted again with the same arguments.")
+    parser.add_argument("--crx", action='store_true',
+                        help="write obs file in Compact RINEX (Hatanaka) format.")
+    parser.add_argument("-z", "--compress", type=str, choices=['gz', 'zst'],
+                        help="compress output files by gzip or zstd.")
+    frame_filter.add_arguments(parser)
+    parser.add_argument("--report", type=str,
+                        help="save metrics of conversion stages as JSON <file>.")
+    parser.add_argument("--prom", type=str,
+                        help="save metrics of conversion stages as Prometheus text <file> " \
+                            "(e.g. <name>.prom in directory of node exporter textfile " \
+                            "collector).")
+    parser.add_argument("--profile", action='store_true',
+                        help="profile stages by cProfile and tracemalloc; <stage>.prof files " \
+                            "and allocation reports are saved in destination directory.")
+    parser.add_argument("--sample", type=float, default=0,
+                        help="print rate of lines processed by fixers every <SAMPLE> seconds.")
+    parser.add_argument("--store", type=str, choices=['npz', 'parquet'],
+                        help="save observations also as NumPy arrays in <input_file>.npz " \
+                            "or <input_file>.parquet (see obs_store).")
+    parser.add_argument("--track", type=str, choices=nmea_track.track_formats,
+                        help="save position track of NMEA GGA sentences of input log as " \
+                            "<input_file>_track.csv or .parquet (see nmea_track).")
+    parser.add_argument("-s", "--session", type=str,
+                        help="split obs and nav files into files of sessions of <SESSION> " \
+                            "length (e.g. '1h', '15m', at most a day) named " \
+                            "<input_file>_<YYYYMMDD>_<HHMM>; nav records go to obs session " \
+                            "of their time of clock or the nearest one (see session_split).")
+    parser.add_argument("--qc", action='store_true',
+                        help="save quality statistics of satellites and signals as " \
+                            "<input_file>_qc.json and .csv (see obs_qc); " \
+                            "fixing of obs file takes about 3 times longer.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes fixing chunks of big nav file, " \
+                            "e.g. number of CPU cores. File is fixed by one process " \
+                            "by default. Nav data streamed from 'convbin' is always " \
+                            "fixed by one process.")
+    args = parser.parse_args()
+
+    metrics = None
+    if args.report != None or args.prom != None:
+        metrics = run_metrics.RunMetrics(args.input_file)
+
+    error = ""
 
+    try:
+        session = None
+        if args.session != None:
+            session = session_split.parse_length(args.session)
+
+        convert(args.date, args.input_file, out_dir_path=args.dest, window=args.window,
+                decoder=args.decoder, demux=args.demux, resume=args.resume,
+                cache_dir=args.cache, crx=args.crx, compress=args.compress,
+                filters=frame_filter.filter_options(args), metrics=metrics,
+                profile=args.profile, sample=args.sample, store=args.store, track=args.track,
+                session=session, qc=args.qc, nav_workers=args.jobs)
+    except (ValueError, RuntimeError, EnvironmentError) as e:
+        error = str(e) or type(e).__name__
+        print(e)
+
+    # report is saved also for failed conversion
+    if metrics != None:
+        metrics.finish(error)
+        try:
+            if args.report != None:
+                metrics.write_json(args.report)
+            if args.prom != None:
+                metrics.write_prometheus(args.prom)
+        except EnvironmentError as e:
+            print("Can't save metrics: " + str(e))
+
+    if error != "":
+        print("Exiting!")
+        sys.exit(1)
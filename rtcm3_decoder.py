@@ -0,0 +1,932 @@
+"""
+  @file rtcm3_decoder.py
+  @brief Routines to find RTCM 3 frames and decode GNSS observations and ephemerides
+
+  @author Michal Zygmunt
+
+  @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
+
+  @license See LICENSE file for license details.
+
+  @todo none
+  @bug none
+"""
+
+import datetime
+import struct
+
+#%% Constants
+
+# speed of light [m/s] and range of one millisecond of signal travel [m]
+speed_of_light = 299792458.0
+range_ms = speed_of_light * 0.001
+
+# pi used by GNSS interface control documents to convert semi-circles
+sc2rad = 3.1415926535898
+
+# lengths of week and day [ms]
+week_ms = 604800000
+day_ms = 86400000
+
+# GPS - UTC leap seconds, as (GPS time [ms] when it became valid, leap [s])
+leap_seconds = [
+    (1230768015000 - 315964800000, 15), # 2009/01/01
+    (1341100816000 - 315964800000, 16), # 2012/07/01
+    (1435708817000 - 315964800000, 17), # 2015/07/01
+    (1483228818000 - 315964800000, 18), # 2017/01/01
+]
+
+# BeiDou time - GPS time offset [ms]
+bdt_offset_ms = -14000
+
+# GLONASS time - UTC offset [ms]
+glot_offset_ms = 10800000
+
+# URA index -> nominal user range accuracy [m] (GPS, BeiDou), as written
+# to RINEX nav files by 'convbin'
+ura_values = [2.0, 2.8, 4.0, 5.7, 8.0, 11.3, 16.0, 32.0,
+              64.0, 128.0, 256.0, 512.0, 1024.0, 2048.0, 4096.0, 8192.0]
+
+
+#%% RTCM 3 frames
+#   Frame: 0xD3 preamble, 6 reserved bits (zero), 10 bits of payload length,
+#   payload and 24 bits of CRC-24Q computed over preamble, length and payload.
+
+preamble = b'\xd3'
+
+
+# build lookup table of CRC-24Q (polynomial 0x1864CFB) for every byte value
+def crc24q_make_table():
+
+    table = []
+
+    for byte in range(256):
+        crc = byte << 16
+        for bit in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= 0x1864CFB
+        table.append(crc & 0xFFFFFF)
+
+    return table
+
+crc24q_table = crc24q_make_table()
+
+
+# build lookup table of CRC-24Q for every pair of bytes, so frames are
+# checked 16 bits at a time
+def crc24q_make_table16(table):
+    return [((table[high] << 8) & 0xFFFFFF) ^ table[(table[high] >> 16) ^ low]
+            for high in range(256) for low in range(256)]
+
+crc24q_table16 = crc24q_make_table16(crc24q_table)
+
+
+# compute CRC-24Q of bytes-like object 'data', starting from value 'crc'
+def crc24q(data, crc=0):
+
+    table = crc24q_table
+
+    for byte in bytearray(data):
+        crc = ((crc << 8) & 0xFFFFFF) ^ table[(crc >> 16) ^ byte]
+
+    return crc
+
+
+# return new dictionary with counters updated by iter_frames
+def frame_stats():
+    return {"frames": 0, "frame_bytes": 0, "crc_errors": 0,
+            "junk_bytes": 0, "offset": 0}
+
+
+# find RTCM 3 frames in bytes-like object 'data' (bytes, mmap) between
+# 'start' and 'end' offsets; yields offset and payload of every frame with
+# valid CRC-24Q; bytes which are not part of any valid frame are counted as
+# junk in 'stats' (see frame_stats); if 'final' is False, search stops at
+# frame which may be completed by more data and its offset is stored in
+# stats["offset"], so search can be continued when more data is available
+def iter_frames(data, stats=None, start=0, end=None, final=True):
+
+    if stats == None:
+        stats = frame_stats()
+
+    if end == None:
+        end = len(data)
+
+    table = crc24q_table
+    table16 = crc24q_table16
+    pos = start
+
+    while True:
+        sync = data.find(preamble, pos, end)
+
+        if sync == -1:
+            stats["junk_bytes"] += end - pos
+            pos = end
+            break
+
+        stats["junk_bytes"] += sync - pos
+        pos = sync
+
+        # incomplete header or frame; wait for more data or drop it at the end
+        if sync + 6 > end:
+            break
+
+        length = ((data[sync + 1] & 0x03) << 8) | data[sync + 2]
+        frame_end = sync + length + 6
+
+        if frame_end > end:
+            if final == False:
+                break
+            stats["junk_bytes"] += 1
+            pos = sync + 1
+            continue
+
+        # reserved bits must be zero
+        if data[sync + 1] & 0xFC:
+            stats["junk_bytes"] += 1
+            pos = sync + 1
+            continue
+
+        frame = data[sync:frame_end]
+
+        # CRC of pairs of bytes, then of the last byte of odd length
+        crc = 0
+        words = (length + 3) // 2
+        for word in struct.unpack_from(">%dH" % words, frame):
+            crc = ((crc << 16) & 0xFFFFFF) ^ table16[(crc >> 8) ^ word]
+        if (length + 3) % 2:
+            crc = ((crc << 8) & 0xFFFFFF) ^ table[(crc >> 16) ^ frame[-4]]
+
+        if crc != (frame[-3] << 16) | (frame[-2] << 8) | frame[-1]:
+            stats["crc_errors"] += 1
+            stats["junk_bytes"] += 1
+            pos = sync + 1
+            continue
+
+        stats["frames"] += 1
+        stats["frame_bytes"] += length + 6
+        pos = frame_end
+
+        yield sync, frame[3:-3]
+
+    # tail which can't be continued is junk
+    if final == True and pos < end:
+        stats["junk_bytes"] += end - pos
+        pos = end
+
+    stats["offset"] = pos
+
+
+# find RTCM 3 frames in binary file 'in_file' read in blocks of 'block_size';
+# yields offset and payload of every frame with valid CRC-24Q; offsets are
+# relative to initial position of 'in_file'; if 'final' is False, frame
+# incomplete at the end of file is kept for next read (see iter_frames)
+def read_frames(in_file, stats=None, block_size=1024 * 1024, final=True):
+
+    if stats == None:
+        stats = frame_stats()
+
+    data = b''
+    data_offset = 0
+
+    while True:
+        block = in_file.read(block_size)
+        last = not block
+
+        data = data[stats["offset"] - data_offset:] + block
+        data_offset = stats["offset"]
+        stats["offset"] = 0
+
+        for offset, payload in iter_frames(data, stats, final=last and final):
+            yield data_offset + offset, payload
+
+        stats["offset"] += data_offset
+
+        if last:
+            break
+
+
+# yield offset and payload of frames of bytes-like object 'data' starting
+# at 'offsets', which were already found and checked (e.g. by
+# iter_frames), so later passes over the same data skip search and CRC
+def frames_at(data, offsets):
+
+    for sync in offsets:
+        length = ((data[sync + 1] & 0x03) << 8) | data[sync + 2]
+        yield sync, data[sync + 3:sync + 3 + length]
+
+
+# return message number of frame payload (0 for empty frames)
+def message_type(payload):
+
+    if len(payload) < 2:
+        return 0
+
+    return (payload[0] << 4) | (payload[1] >> 4)
+
+
+#%% Bit fields
+
+# masks for bit fields of width 0..64
+bit_masks = [(1 << width) - 1 for width in range(65)]
+
+
+# payload converted to one integer, from which bit fields are cut
+class BitFields(object):
+
+    def __init__(self, payload):
+        self.bits = int.from_bytes(bytes(payload), 'big')
+        self.length = len(payload) * 8
+
+    # unsigned field of 'width' bits at bit position 'pos'
+    def u(self, pos, width):
+        return (self.bits >> (self.length - pos - width)) & bit_masks[width]
+
+    # two's complement signed field
+    def s(self, pos, width):
+        value = (self.bits >> (self.length - pos - width)) & bit_masks[width]
+        if value >> (width - 1):
+            value -= 1 << width
+        return value
+
+    # sign-magnitude field (GLONASS)
+    def sm(self, pos, width):
+        value = (self.bits >> (self.length - pos - width)) & bit_masks[width]
+        if value >> (width - 1):
+            return -(value & bit_masks[width - 1])
+        return value
+
+    # list of 'count' consecutive unsigned fields of 'width' bits; fields
+    # are cut from the end of chunk, which gets shorter with each field
+    def u_array(self, pos, width, count):
+        chunk = self.bits >> (self.length - pos - width * count)
+        mask = bit_masks[width]
+        values = [0] * count
+        for item in range(count - 1, -1, -1):
+            values[item] = chunk & mask
+            chunk >>= width
+        return values
+
+    # list of 'count' consecutive signed fields of 'width' bits
+    def s_array(self, pos, width, count):
+        sign = 1 << (width - 1)
+        full = 1 << width
+        return [value - full if value & sign else value
+                for value in self.u_array(pos, width, count)]
+
+
+# decode fields listed in 'table' as (name, width, kind, scale) starting at
+# bit 'pos'; kind is 'u' (unsigned), 's' (signed) or 'm' (sign-magnitude)
+# and fields named '' are skipped; returns dictionary of values
+def decode_table(fields, pos, table):
+
+    values = {}
+
+    for name, width, kind, scale in table:
+        if name != '':
+            if kind == 'u':
+                value = fields.u(pos, width)
+            elif kind == 's':
+                value = fields.s(pos, width)
+            else:
+                value = fields.sm(pos, width)
+            values[name] = value * scale if scale != 1 else value
+        pos += width
+
+    return values
+
+
+#%% Message layouts
+
+# stationary antenna reference point (1005, 1006)
+table_1005 = [
+    ("station", 12, 'u', 1), ("", 6 + 4, 'u', 1),
+    ("x", 38, 's', 0.0001), ("", 2, 'u', 1),
+    ("y", 38, 's', 0.0001), ("", 2, 'u', 1),
+    ("z", 38, 's', 0.0001),
+]
+
+# GPS ephemeris (1019)
+table_1019 = [
+    ("prn", 6, 'u', 1), ("week", 10, 'u', 1), ("sva", 4, 'u', 1),
+    ("code", 2, 'u', 1), ("idot", 14, 's', 2.0**-43 * sc2rad),
+    ("iode", 8, 'u', 1), ("toc", 16, 'u', 16), ("af2", 8, 's', 2.0**-55),
+    ("af1", 16, 's', 2.0**-43), ("af0", 22, 's', 2.0**-31),
+    ("iodc", 10, 'u', 1), ("crs", 16, 's', 2.0**-5),
+    ("deln", 16, 's', 2.0**-43 * sc2rad), ("m0", 32, 's', 2.0**-31 * sc2rad),
+    ("cuc", 16, 's', 2.0**-29), ("e", 32, 'u', 2.0**-33),
+    ("cus", 16, 's', 2.0**-29), ("sqrta", 32, 'u', 2.0**-19),
+    ("toe", 16, 'u', 16), ("cic", 16, 's', 2.0**-29),
+    ("omg0", 32, 's', 2.0**-31 * sc2rad), ("cis", 16, 's', 2.0**-29),
+    ("i0", 32, 's', 2.0**-31 * sc2rad), ("crc", 16, 's', 2.0**-5),
+    ("omg", 32, 's', 2.0**-31 * sc2rad), ("omgd", 24, 's', 2.0**-43 * sc2rad),
+    ("tgd", 8, 's', 2.0**-31), ("svh", 6, 'u', 1), ("flag", 1, 'u', 1),
+    ("fit", 1, 'u', 1),
+]
+
+# GLONASS ephemeris (1020)
+table_1020 = [
+    ("prn", 6, 'u', 1), ("fcn", 5, 'u', 1), ("", 1 + 1 + 2, 'u', 1),
+    ("tk_h", 5, 'u', 1), ("tk_m", 6, 'u', 1), ("tk_s", 1, 'u', 30),
+    ("bn", 1, 'u', 1), ("", 1, 'u', 1), ("tb", 7, 'u', 900),
+    ("vx", 24, 'm', 2.0**-20), ("x", 27, 'm', 2.0**-11), ("ax", 5, 'm', 2.0**-30),
+    ("vy", 24, 'm', 2.0**-20), ("y", 27, 'm', 2.0**-11), ("ay", 5, 'm', 2.0**-30),
+    ("vz", 24, 'm', 2.0**-20), ("z", 27, 'm', 2.0**-11), ("az", 5, 'm', 2.0**-30),
+    ("", 1, 'u', 1), ("gamn", 11, 'm', 2.0**-40), ("", 2 + 1, 'u', 1),
+    ("taun", 22, 'm', 2.0**-30), ("", 5, 'u', 1), ("age", 5, 'u', 1),
+]
+
+# BeiDou ephemeris (1042)
+table_1042 = [
+    ("prn", 6, 'u', 1), ("week", 13, 'u', 1), ("sva", 4, 'u', 1),
+    ("idot", 14, 's', 2.0**-43 * sc2rad), ("iode", 5, 'u', 1),
+    ("toc", 17, 'u', 8), ("af2", 11, 's', 2.0**-66),
+    ("af1", 22, 's', 2.0**-50), ("af0", 24, 's', 2.0**-33),
+    ("iodc", 5, 'u', 1), ("crs", 18, 's', 2.0**-6),
+    ("deln", 16, 's', 2.0**-43 * sc2rad), ("m0", 32, 's', 2.0**-31 * sc2rad),
+    ("cuc", 18, 's', 2.0**-31), ("e", 32, 'u', 2.0**-33),
+    ("cus", 18, 's', 2.0**-31), ("sqrta", 32, 'u', 2.0**-19),
+    ("toe", 17, 'u', 8), ("cic", 18, 's', 2.0**-31),
+    ("omg0", 32, 's', 2.0**-31 * sc2rad), ("cis", 18, 's', 2.0**-31),
+    ("i0", 32, 's', 2.0**-31 * sc2rad), ("crc", 18, 's', 2.0**-6),
+    ("omg", 32, 's', 2.0**-31 * sc2rad), ("omgd", 24, 's', 2.0**-43 * sc2rad),
+    ("tgd", 10, 's', 1e-10), ("tgd2", 10, 's', 1e-10), ("svh", 1, 'u', 1),
+]
+
+# Galileo I/NAV ephemeris (1046)
+table_1046 = [
+    ("prn", 6, 'u', 1), ("week", 12, 'u', 1), ("iode", 10, 'u', 1),
+    ("sva", 8, 'u', 1), ("idot", 14, 's', 2.0**-43 * sc2rad),
+    ("toc", 14, 'u', 60), ("af2", 6, 's', 2.0**-59),
+    ("af1", 21, 's', 2.0**-46), ("af0", 31, 's', 2.0**-34),
+    ("crs", 16, 's', 2.0**-5), ("deln", 16, 's', 2.0**-43 * sc2rad),
+    ("m0", 32, 's', 2.0**-31 * sc2rad), ("cuc", 16, 's', 2.0**-29),
+    ("e", 32, 'u', 2.0**-33), ("cus", 16, 's', 2.0**-29),
+    ("sqrta", 32, 'u', 2.0**-19), ("toe", 14, 'u', 60),
+    ("cic", 16, 's', 2.0**-29), ("omg0", 32, 's', 2.0**-31 * sc2rad),
+    ("cis", 16, 's', 2.0**-29), ("i0", 32, 's', 2.0**-31 * sc2rad),
+    ("crc", 16, 's', 2.0**-5), ("omg", 32, 's', 2.0**-31 * sc2rad),
+    ("omgd", 24, 's', 2.0**-43 * sc2rad), ("tgd", 10, 's', 2.0**-32),
+    ("tgd2", 10, 's', 2.0**-32), ("e5b_hs", 2, 'u', 1), ("e5b_dvs", 1, 'u', 1),
+    ("e1_hs", 2, 'u', 1), ("e1_dvs", 1, 'u', 1),
+]
+
+# MSM message number -> (system, MSM type); system is RINEX system letter
+msm_systems = {107: 'G', 108: 'R', 109: 'E', 110: 'S', 111: 'J', 112: 'C'}
+
+# widths of MSM signal data fields: fine pseudorange, fine phase range,
+# lock time indicator, C/N0; scales of fine pseudorange, fine phase range
+# [ms] and C/N0 [dB-Hz]; True if satellite and signal range rates are sent
+msm_layouts = {
+    4: (15, 22, 4, 6, 2.0**-24, 2.0**-29, 1.0, False),
+    5: (15, 22, 4, 6, 2.0**-24, 2.0**-29, 1.0, True),
+    6: (20, 24, 10, 10, 2.0**-29, 2.0**-31, 2.0**-4, False),
+    7: (20, 24, 10, 10, 2.0**-29, 2.0**-31, 2.0**-4, True),
+}
+
+# MSM signal id (1..32) -> RINEX observation code, for each system
+msm_signals = {
+    'G': {2: "1C", 3: "1P", 4: "1W", 8: "2C", 9: "2P", 10: "2W", 15: "2S",
+          16: "2L", 17: "2X", 22: "5I", 23: "5Q", 24: "5X", 30: "1S",
+          31: "1L", 32: "1X"},
+    'R': {2: "1C", 3: "1P", 8: "2C", 9: "2P"},
+    'E': {2: "1C", 3: "1A", 4: "1B", 5: "1X", 6: "1Z", 8: "6C", 9: "6A",
+          10: "6B", 11: "6X", 12: "6Z", 14: "7I", 15: "7Q", 16: "7X",
+          18: "8I", 19: "8Q", 20: "8X", 22: "5I", 23: "5Q", 24: "5X"},
+    'S': {2: "1C", 22: "5I", 23: "5Q", 24: "5X"},
+    'J': {2: "1C", 9: "6S", 10: "6L", 11: "6X", 15: "2S", 16: "2L",
+          17: "2X", 22: "5I", 23: "5Q", 24: "5X", 30: "1S", 31: "1L",
+          32: "1X"},
+    'C': {2: "2I", 3: "2Q", 4: "2X", 8: "6I", 9: "6Q", 10: "6X", 14: "7I",
+          15: "7Q", 16: "7X"},
+}
+
+# carrier frequency [Hz] of frequency band, for each system
+carrier_frequencies = {
+    'G': {'1': 1.57542e9, '2': 1.22760e9, '5': 1.17645e9},
+    'E': {'1': 1.57542e9, '5': 1.17645e9, '6': 1.27875e9, '7': 1.20714e9,
+          '8': 1.191795e9},
+    'S': {'1': 1.57542e9, '5': 1.17645e9},
+    'J': {'1': 1.57542e9, '2': 1.22760e9, '5': 1.17645e9, '6': 1.27875e9},
+    'C': {'2': 1.561098e9, '6': 1.26852e9, '7': 1.20714e9},
+}
+
+# order of systems in RINEX files
+system_order = "GREJCS"
+
+# satellite number in MSM satellite mask -> RINEX satellite number
+msm_prn_offsets = {'G': 0, 'R': 0, 'E': 0, 'S': 19, 'J': 0, 'C': 0}
+
+
+# return carrier frequency [Hz] of signal 'code' of system 'sys' or None if
+# it's unknown (GLONASS without frequency channel number 'fcn')
+def carrier_frequency(sys, code, fcn=None):
+
+    if sys == 'R':
+        if fcn == None:
+            return None
+        if code[0] == '1':
+            return 1.602e9 + fcn * 0.5625e6
+        if code[0] == '2':
+            return 1.246e9 + fcn * 0.4375e6
+        return None
+
+    return carrier_frequencies.get(sys, {}).get(code[0])
+
+
+# MSM signal id -> (RINEX observation code, carrier frequency [Hz]), for
+# each system; GLONASS frequencies depend on satellite and are None
+msm_signal_info = dict((sys, dict((sig, (code, carrier_frequency(sys, code)))
+                                  for sig, code in signals.items()))
+                       for sys, signals in msm_signals.items())
+
+
+#%% Time conversions
+#   All times are kept as integer milliseconds of GPS time since GPS epoch
+#   (1980/01/06 00:00:00).
+
+# return GPS - UTC leap seconds valid at GPS time 'time' [ms]
+def leap_seconds_at(time):
+
+    leap = 0
+    for valid_from, value in leap_seconds:
+        if time >= valid_from:
+            leap = value
+
+    return leap
+
+
+# return GPS time [ms] of calendar date 'date' given as <YYYY/MM/DD>
+def date_to_gps_ms(date):
+
+    year, month, day = [int(item) for item in date.split('/')]
+
+    # days since 1980/01/06 computed from proleptic Gregorian ordinal
+    days = datetime.date(year, month, day).toordinal() - datetime.date(1980, 1, 6).toordinal()
+
+    return days * day_ms
+
+
+# return time nearest to 'time_ref' which is 'time_of_period' [ms] after
+# beginning of some period of length 'period' [ms]
+def adjust_period(time_of_period, time_ref, period):
+
+    time = time_ref - time_ref % period + time_of_period
+
+    if time < time_ref - period // 2:
+        time += period
+    elif time > time_ref + period // 2:
+        time -= period
+
+    return time
+
+
+# return full week number nearest to week of 'time_ref' for week number
+# 'week' broadcast modulo 'rollover'
+def adjust_week(week, time_ref, rollover):
+
+    week_ref = time_ref // week_ms
+    return week + (week_ref - week + rollover // 2) // rollover * rollover
+
+
+#%% Decoder
+
+# RTCM 3 decoder; stores reference time, GLONASS frequency channels, lock
+# times of signals and observations of current epoch
+class Rtcm3Decoder(object):
+
+    # 'date' <YYYY/MM/DD> is approximate date of data start, needed to
+    # resolve full time, as RTCM messages don't contain week number
+    def __init__(self, date):
+
+        self.time = date_to_gps_ms(date)
+
+        self.glonass_fcn = {}
+        self.lock = {}
+
+        self.epoch_time = None
+        self.epoch = {}
+
+        # True if last MSM message was the last one of its epoch
+        # (multiple message bit cleared)
+        self.epoch_complete = False
+
+        self.position = None
+
+        # counters of decoded messages and of unsupported message types
+        self.messages = {}
+        self.unknown_messages = 0
+
+    #%% MSM observations
+
+    # return GPS time [ms] of MSM epoch time field 'epoch' of system 'sys'
+    def msm_time(self, sys, epoch):
+
+        if sys == 'R':
+            # day of week and time of day in GLONASS time
+            tod = (epoch & 0x7FFFFFF) - glot_offset_ms
+            leap = leap_seconds_at(self.time) * 1000
+            time = adjust_period(tod % day_ms, self.time - leap, day_ms)
+            return time + leap
+
+        if sys == 'C':
+            return adjust_period((epoch - bdt_offset_ms) % week_ms, self.time, week_ms)
+
+        return adjust_period(epoch, self.time, week_ms)
+
+    # decode MSM header; returns system, MSM type, epoch time field,
+    # multiple message bit, satellites, signal codes, cell mask and position
+    # of satellite data
+    def msm_header(self, fields, msg):
+
+        sys = msm_systems[msg // 10]
+        msm = msg % 10
+
+        epoch = fields.u(24, 30)
+        multiple = fields.u(54, 1)
+
+        sat_mask = fields.u(73, 64)
+        sig_mask = fields.u(137, 32)
+
+        sats = [item + 1 for item in range(64) if sat_mask >> (63 - item) & 1]
+        sigs = [item + 1 for item in range(32) if sig_mask >> (31 - item) & 1]
+
+        ncell = len(sats) * len(sigs)
+        if ncell > 64:
+            return None
+
+        cells = fields.u_array(169, 1, ncell) if ncell > 0 else []
+
+        return sys, msm, epoch, multiple, sats, sigs, cells, 169 + ncell
+
+    # decode MSM4-7 message; observations are added to current epoch and
+    # previous epoch is returned when epoch time changes
+    def decode_msm(self, fields, msg):
+
+        header = self.msm_header(fields, msg)
+        if header == None or header[1] not in msm_layouts:
+            self.unknown_messages += 1
+            return None
+
+        sys, msm, epoch, multiple, sats, sigs, cells, pos = header
+        width_pr, width_cp, width_lock, width_cnr, scale_pr, scale_cp, scale_cnr, rates = \
+            msm_layouts[msm]
+
+        nsat = len(sats)
+        ncell = cells.count(1)
+
+        # satellite data
+        rough_ms = fields.u_array(pos, 8, nsat)
+        pos += 8 * nsat
+        if rates:
+            ext_info = fields.u_array(pos, 4, nsat)
+            pos += 4 * nsat
+        rough_mod = fields.u_array(pos, 10, nsat)
+        pos += 10 * nsat
+        if rates:
+            rough_rate = fields.s_array(pos, 14, nsat)
+            pos += 14 * nsat
+
+        # signal data
+        fine_pr = fields.s_array(pos, width_pr, ncell)
+        pos += width_pr * ncell
+        fine_cp = fields.s_array(pos, width_cp, ncell)
+        pos += width_cp * ncell
+        lock = fields.u_array(pos, width_lock, ncell)
+        pos += width_lock * ncell
+        half = fields.u_array(pos, 1, ncell)
+        pos += ncell
+        cnr = fields.u_array(pos, width_cnr, ncell)
+        pos += width_cnr * ncell
+        if rates:
+            fine_rate = fields.s_array(pos, 15, ncell)
+            pos += 15 * ncell
+
+        if pos > fields.length:
+            self.unknown_messages += 1
+            return None
+
+        # flush current epoch if this message starts new one
+        time = self.msm_time(sys, epoch)
+        completed = None
+
+        if time != self.epoch_time:
+            completed = self.flush()
+            self.epoch_time = time
+
+        self.time = time
+        self.epoch_complete = multiple == 0
+
+        invalid_pr = -(1 << (width_pr - 1))
+        invalid_cp = -(1 << (width_cp - 1))
+
+        # units of fine ranges [m]; scales are powers of 2, so values are
+        # the same as of scaling in ms first
+        unit_pr = scale_pr * range_ms
+        unit_cp = scale_cp * range_ms
+
+        # code and frequency of each signal of satellite cells
+        signals = msm_signal_info[sys]
+        cell_signals = [signals.get(sig) for sig in sigs]
+        nsig = len(sigs)
+
+        lock_prev = self.lock
+        index = 0
+
+        for item in range(nsat):
+
+            sat = "%s%02d" % (sys, sats[item] + msm_prn_offsets[sys])
+
+            if sys == 'R':
+                if rates and ext_info[item] <= 13:
+                    self.glonass_fcn[sat] = ext_info[item] - 7
+                fcn = self.glonass_fcn.get(sat)
+            else:
+                fcn = None
+
+            # parts of range are scaled and summed in the same order as by
+            # 'convbin', so values are rounded the same way
+            if rough_ms[item] == 255:
+                rough = None
+            else:
+                rough = rough_ms[item] * range_ms + rough_mod[item] * 2.0**-10 * range_ms
+
+            if rates and rough_rate[item] != -8192:
+                rate = float(rough_rate[item])
+            else:
+                rate = None
+
+            observations = None
+
+            for present, signal in zip(cells[item * nsig:(item + 1) * nsig], cell_signals):
+
+                if present == 0:
+                    continue
+
+                if signal == None or rough == None:
+                    index += 1
+                    continue
+
+                code, freq = signal
+                if sys == 'R':
+                    freq = carrier_frequency(sys, code, fcn)
+
+                pr = cp = dop = None
+
+                if fine_pr[index] != invalid_pr:
+                    pr = rough + fine_pr[index] * unit_pr
+
+                if fine_cp[index] != invalid_cp and freq != None:
+                    cp = (rough + fine_cp[index] * unit_cp) * freq / speed_of_light
+
+                if rates and rate != None and fine_rate[index] != -16384 and freq != None:
+                    dop = -(rate + fine_rate[index] * 0.0001) * freq / speed_of_light
+
+                # loss of lock: signal not locked or lock time indicator
+                # decreased; half cycle ambiguity adds 3, as 'convbin' does
+                key = (sat, code)
+                value = lock[index]
+                lli = 1 if value == 0 or value < lock_prev.get(key, 0) else 0
+                if half[index]:
+                    lli += 3
+                lock_prev[key] = value
+
+                if observations == None:
+                    observations = self.epoch.setdefault(sat, {})
+                observations[code] = (pr, cp, dop, cnr[index] * scale_cnr, lli)
+                index += 1
+
+        return completed
+
+    # return current epoch as (time, observations) or None if it's empty;
+    # observations are {satellite: {code: (pr, cp, dop, snr, lli)}}
+    def flush(self):
+
+        if self.epoch_time == None or len(self.epoch) == 0:
+            self.epoch = {}
+            return None
+
+        completed = (self.epoch_time, self.epoch)
+        self.epoch = {}
+        return completed
+
+    #%% Ephemerides
+
+    # decode ephemeris message; returns ephemeris as dictionary with
+    # satellite, system and time of clock [GPS ms] added
+    def decode_eph(self, fields, msg):
+
+        if msg == 1019:
+            eph = decode_table(fields, 12, table_1019)
+            eph["sys"] = 'G'
+            eph["week"] = adjust_week(eph["week"], self.time, 1024)
+            eph["sva"] = ura_values[eph["sva"]]
+            eph["fit"] = 0.0 if eph["fit"] else 4.0
+
+        elif msg == 1042:
+            eph = decode_table(fields, 12, table_1042)
+            eph["sys"] = 'C'
+            # BeiDou week is kept in BDT, which started at GPS week 1356
+            eph["week"] = adjust_week(eph["week"] + 1356, self.time, 8192) - 1356
+            eph["sva"] = ura_values[eph["sva"]]
+
+        elif msg == 1046:
+            eph = decode_table(fields, 12, table_1046)
+            eph["sys"] = 'E'
+            # Galileo week is aligned to GPS week in RINEX files
+            eph["week"] = adjust_week(eph["week"] + 1024, self.time, 4096)
+            eph["sva"] = sisa_value(eph["sva"])
+            eph["svh"] = ((eph["e5b_hs"] << 7) | (eph["e5b_dvs"] << 6) |
+                          (eph["e1_hs"] << 1) | eph["e1_dvs"])
+            # I/NAV E1-B and E5b, af0-af2 and toc for E5b,E1
+            eph["code"] = (1 << 0) | (1 << 2) | (1 << 9)
+
+        elif msg == 1020:
+            return self.decode_glonass_eph(fields)
+
+        if eph["prn"] == 0:
+            return None
+
+        eph["sat"] = "%s%02d" % (eph["sys"], eph["prn"])
+
+        # ephemeris broadcast near end of week may refer to next week
+        # (and vice versa), so time of ephemeris is kept within half of
+        # week from current time
+        if eph["sys"] == 'C':
+            toe = (eph["week"] + 1356) * week_ms + eph["toe"] * 1000 - bdt_offset_ms
+        else:
+            toe = eph["week"] * week_ms + eph["toe"] * 1000
+
+        if toe - self.time < -week_ms // 2:
+            eph["week"] += 1
+        elif toe - self.time >= week_ms // 2:
+            eph["week"] -= 1
+
+        # time of clock and transmission time [GPS ms], BeiDou week starts
+        # 14 s later than GPS week
+        if eph["sys"] == 'C':
+            eph["time"] = (eph["week"] + 1356) * week_ms + eph["toc"] * 1000 - bdt_offset_ms
+        else:
+            eph["time"] = eph["week"] * week_ms + eph["toc"] * 1000
+        eph["ttr"] = self.time
+
+        return eph
+
+    # decode GLONASS ephemeris; times are in UTC as broadcast
+    def decode_glonass_eph(self, fields):
+
+        eph = decode_table(fields, 12, table_1020)
+
+        if eph["prn"] == 0:
+            return None
+
+        eph["sys"] = 'R'
+        eph["sat"] = "R%02d" % eph["prn"]
+        eph["fcn"] -= 7
+        self.glonass_fcn[eph["sat"]] = eph["fcn"]
+
+        leap = leap_seconds_at(self.time) * 1000
+        time_utc = self.time - leap
+
+        # time of ephemeris and of frame are broadcast in GLONASS time of day
+        tk = (eph["tk_h"] * 3600 + eph["tk_m"] * 60 + eph["tk_s"]) * 1000
+        eph["tof"] = adjust_period((tk - glot_offset_ms) % day_ms, time_utc, day_ms)
+        eph["toe"] = adjust_period((eph["tb"] * 1000 - glot_offset_ms) % day_ms, time_utc, day_ms)
+
+        eph["time"] = eph["toe"] + leap
+        eph["iode"] = eph["tb"] // 900
+        eph["svh"] = eph["bn"]
+
+        return eph
+
+    # decode stationary antenna reference point (1005, 1006)
+    def decode_position(self, fields):
+        values = decode_table(fields, 12, table_1005)
+        self.position = (values["x"], values["y"], values["z"])
+
+    #%% Frames
+
+    # decode payload of one frame; returns ("obs", (time, observations))
+    # if epoch is completed by this message, ("nav", ephemeris) for
+    # ephemeris message or None
+    def decode_payload(self, payload):
+
+        msg = message_type(payload)
+        if msg == 0:
+            return None
+
+        self.messages[msg] = self.messages.get(msg, 0) + 1
+
+        try:
+            fields = BitFields(payload)
+
+            if msg // 10 in msm_systems:
+                epoch = self.decode_msm(fields, msg)
+                if epoch != None:
+                    return "obs", epoch
+
+            elif msg in (1019, 1020, 1042, 1046):
+                eph = self.decode_eph(fields, msg)
+                if eph != None:
+                    return "nav", eph
+
+            elif msg in (1005, 1006):
+                self.decode_position(fields)
+
+            else:
+                self.unknown_messages += 1
+
+        except (IndexError, KeyError, ValueError):
+            # message shorter than its layout
+            self.unknown_messages += 1
+
+        return None
+
+    # decode payloads of frames from 'frames' iterable (e.g. iter_frames
+    # output); yields ("obs", (time, observations)) for each epoch and
+    # ("nav", ephemeris) for each ephemeris message
+    def decode(self, frames):
+
+        for offset, payload in frames:
+            event = self.decode_payload(payload)
+            if event != None:
+                yield event
+
+        epoch = self.flush()
+        if epoch != None:
+            yield "obs", epoch
+
+    # scan frames for information needed by RINEX obs header, without
+    # decoding observations; returns dictionary with observation codes of
+    # each system ({sys: set of codes}), systems with Doppler data, first
+    # and last epoch time, GLONASS frequency channels and station position
+    def scan(self, frames):
+
+        info = {"codes": {}, "doppler": set(), "first": None, "last": None,
+                "glonass_fcn": self.glonass_fcn, "position": None}
+
+        for offset, payload in frames:
+
+            msg = message_type(payload)
+
+            try:
+                if msg // 10 in msm_systems:
+                    fields = BitFields(payload)
+                    header = self.msm_header(fields, msg)
+                    if header == None or header[1] not in msm_layouts:
+                        continue
+
+                    sys, msm, epoch, multiple, sats, sigs, cells, pos = header
+
+                    codes = info["codes"].setdefault(sys, set())
+                    for sig in sigs:
+                        if sig in msm_signals[sys]:
+                            codes.add(msm_signals[sys][sig])
+
+                    if msm_layouts[msm][7]:
+                        info["doppler"].add(sys)
+
+                        # GLONASS frequency channels from extended satellite info
+                        if sys == 'R':
+                            ext_info = fields.u_array(pos + 8 * len(sats), 4, len(sats))
+                            for item in range(len(sats)):
+                                if ext_info[item] <= 13:
+                                    self.glonass_fcn["R%02d" % sats[item]] = ext_info[item] - 7
+
+                    self.time = self.msm_time(sys, epoch)
+                    if info["first"] == None or self.time < info["first"]:
+                        info["first"] = self.time
+                    if info["last"] == None or self.time > info["last"]:
+                        info["last"] = self.time
+
+                elif msg == 1020:
+                    fields = BitFields(payload)
+                    prn = fields.u(12, 6)
+                    if prn > 0:
+                        self.glonass_fcn["R%02d" % prn] = fields.u(18, 5) - 7
+
+                elif msg in (1005, 1006):
+                    self.decode_position(BitFields(payload))
+                    info["position"] = self.position
+
+            except (IndexError, KeyError, ValueError):
+                continue
+
+        return info
+
+
+# Galileo SISA index -> signal in space accuracy [m]
+def sisa_value(sisa):
+
+    if sisa <= 49:
+        return sisa * 0.01
+    if sisa <= 74:
+        return 0.5 + (sisa - 50) * 0.02
+    if sisa <= 99:
+        return 1.0 + (sisa - 75) * 0.04
+    if sisa <= 125:
+        return 2.0 + (sisa - 100) * 0.16
+
+    # no accuracy prediction available
+    return -1.0
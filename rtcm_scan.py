@@ -0,0 +1,547 @@
+"""
+  @file rtcm_scan.py
+  @brief Routines to check integrity of RTCM 3 logs and report histogram of their messages
+
+  @author Michal Zygmunt
+
+  @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
+
+  @license See LICENSE file for license details.
+
+  @todo none
+  @bug none
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import mmap
+import os.path
+import sys
+import time
+
+import compressed_io
+import frame_filter
+import log_demux
+import rinex_writer
+import rtcm3_decoder
+
+# NumPy is used to check CRC of many frames at once
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#%% Scan of RTCM 3 log
+#   Log is swept once without decoding messages. Candidate frames are
+#   found by walking from one 0xD3 preamble to the end of frame given by
+#   its length field, assuming the frame is valid; CRC-24Q of a batch of
+#   candidates is then computed by NumPy for all of them at once, two bytes
+#   per step by 16-bit table (frames are left padded by zeros, which don't
+#   change CRC starting from 0). Walk restarts one byte after the first
+#   frame with invalid CRC, and batches are made smaller after each error,
+#   so noise doesn't waste work. Message types and epoch time fields of
+#   valid frames of batch are read from their first bytes by NumPy too.
+#   Without NumPy, frames are checked by table-driven CRC of rtcm3_decoder
+#   and counted one by one. Bytes between valid frames are reported as
+#   corrupted (from the first candidate frame which failed CRC, including
+#   bytes skipped to find next frame), NMEA sentences and other non-RTCM
+#   data (e.g. text of terminal logger); they are classified only for
+#   uncompressed logs. Frames without message (keep-alive) are reported as
+#   null messages.
+
+# number of candidate frames checked at once (maximum and minimum)
+batch_frames = 4096
+min_batch_frames = 16
+
+# time gap is reported if time between epochs is longer than 'gap_factor'
+# nominal intervals
+gap_factor = 2.0
+
+# number of the longest gaps listed in report
+max_gaps = 20
+
+# legacy observation messages
+legacy_obs_messages = (1001, 1002, 1003, 1004, 1009, 1010, 1011, 1012)
+
+
+# check if message 'msg' contains observations
+def is_obs_message(msg):
+    return msg in legacy_obs_messages or \
+        (msg // 10 in rtcm3_decoder.msm_systems and 1 <= msg % 10 <= 7)
+
+
+# return CRC-24Q table of 16-bit words as NumPy array; entry of word is CRC
+# of its two bytes
+def crc_table():
+    return numpy.array(rtcm3_decoder.crc24q_table16, dtype=numpy.uint32)
+
+
+# return array of flags of valid CRC-24Q of frames of NumPy uint8 array
+# 'buffer' given as arrays of 'starts' and 'ends' offsets; 'table' is
+# returned by crc_table
+def check_crc_batch(buffer, starts, ends, table):
+
+    # CRC covers header and payload, stored CRC is the last 3 bytes
+    lengths = ends - starts - 3
+    width = int(lengths.max() + 1) // 2 * 2
+
+    columns = numpy.arange(width, dtype=numpy.int64)
+    index = (ends - 3 - width)[:, None] + columns[None, :]
+    padding = columns[None, :] < (width - lengths)[:, None]
+
+    frames = buffer[numpy.where(padding, 0, index)]
+    frames[padding] = 0
+
+    words = (frames[:, 0::2].astype(numpy.uint32) << 8) | frames[:, 1::2]
+
+    crc = numpy.zeros(len(starts), dtype=numpy.uint32)
+    for column in range(width // 2):
+        crc = ((crc << 16) & 0xFFFFFF) ^ table[(crc >> 8) ^ words[:, column]]
+
+    stored = (buffer[ends - 3].astype(numpy.uint32) << 16) | \
+        (buffer[ends - 2].astype(numpy.uint32) << 8) | buffer[ends - 1]
+
+    return crc == stored
+
+
+# find RTCM 3 frames in bytes-like object 'data' (bytes, mmap) given also
+# as NumPy uint8 array 'buffer' like rtcm3_decoder.iter_frames, but check
+# CRC of frames in batches by NumPy; yields arrays of start and end offsets
+# of valid frames of each batch; 'stats' are updated as by iter_frames
+def iter_frames_batched(data, buffer, stats):
+
+    table = crc_table()
+
+    end = len(data)
+    pos = 0
+    batch = batch_frames
+
+    while pos < end:
+
+        # walk candidate frames assuming they are valid
+        starts = []
+        ends = []
+        walk = pos
+
+        while len(starts) < batch:
+            sync = data.find(rtcm3_decoder.preamble, walk, end)
+            if sync == -1 or sync + 6 > end:
+                walk = end
+                break
+
+            frame_end = sync + (((data[sync + 1] & 0x03) << 8) | data[sync + 2]) + 6
+
+            # reserved bits must be zero and frame must be complete
+            if data[sync + 1] & 0xFC or frame_end > end:
+                walk = sync + 1
+                continue
+
+            starts.append(sync)
+            ends.append(frame_end)
+            walk = frame_end
+
+        if len(starts) == 0:
+            break
+
+        frame_starts = numpy.array(starts, dtype=numpy.int64)
+        frame_ends = numpy.array(ends, dtype=numpy.int64)
+
+        valid = check_crc_batch(buffer, frame_starts, frame_ends, table)
+
+        # frames after the first invalid one were found by wrong length
+        invalid = numpy.flatnonzero(~valid)
+        count = int(invalid[0]) if len(invalid) > 0 else len(starts)
+
+        if count > 0:
+            stats["frames"] += count
+            stats["frame_bytes"] += int((frame_ends[:count] - frame_starts[:count]).sum())
+            yield frame_starts[:count], frame_ends[:count]
+
+        if count < len(starts):
+            stats["crc_errors"] += 1
+            pos = starts[count] + 1
+            batch = max(min_batch_frames, batch // 4)
+        else:
+            pos = walk
+            batch = min(batch_frames, batch * 2)
+
+    stats["junk_bytes"] = end - stats["frame_bytes"]
+    stats["offset"] = end
+
+
+# return numbers of bytes of 'data' (bytes, mmap) of 'size' bytes from
+# 'start' to 'end' between valid frames as (corrupted, NMEA, other) bytes;
+# corrupted bytes start by the first candidate frame (preamble, zero
+# reserved bits and complete length), which must have failed CRC
+def classify_gap(data, start, end, size):
+
+    first = end
+    sync = data.find(rtcm3_decoder.preamble, start, end)
+    while sync != -1:
+        if sync + 6 <= size and data[sync + 1] & 0xFC == 0 and \
+           sync + (((data[sync + 1] & 0x03) << 8) | data[sync + 2]) + 6 <= size:
+            first = sync
+            break
+        sync = data.find(rtcm3_decoder.preamble, sync + 1, end)
+
+    # NMEA bytes before and after the first candidate frame
+    nmea = [0, 0]
+    pos = data.find(b'$', start, end)
+    while pos != -1:
+        sentence_end = log_demux.check_sentence(data, pos, end)
+        if sentence_end > 0:
+            nmea[pos >= first] += sentence_end - pos
+            pos = data.find(b'$', sentence_end, end)
+        else:
+            pos = data.find(b'$', pos + 1, end)
+
+    return end - first - nmea[1], nmea[0] + nmea[1], first - start - nmea[0]
+
+
+# yield start and end offsets of valid frames of 'data' found by
+# rtcm3_decoder.iter_frames
+def iter_frames_table(data, stats):
+
+    for offset, payload in rtcm3_decoder.iter_frames(data, stats):
+        yield offset, offset + len(payload) + 6
+
+
+# return list of start offsets of valid frames of 'data' (bytes, mmap);
+# frames are checked in batches by NumPy if it's available, or one by one
+# by rtcm3_decoder.iter_frames; 'stats' are updated as by iter_frames
+def find_frames(data, stats):
+
+    if numpy == None or len(data) == 0:
+        return [offset for offset, payload in rtcm3_decoder.iter_frames(data, stats)]
+
+    buffer = numpy.frombuffer(data, dtype=numpy.uint8)
+    offsets = []
+
+    for starts, ends in iter_frames_batched(data, buffer, stats):
+        offsets += starts.tolist()
+
+    # array must be released before memory map is closed
+    del buffer
+
+    return offsets
+
+
+# yield start offset and payload of valid frames of compressed file 'path'
+# read by rtcm3_decoder.read_frames
+def iter_frames_stream(path, stats):
+
+    with compressed_io.open_input(path) as in_file:
+        for offset, payload in rtcm3_decoder.read_frames(in_file, stats):
+            yield offset, payload
+
+
+#%% Report
+
+# return new dictionary with counters of messages and epochs collected by
+# scan
+def scan_report(path):
+    return {"file": path, "size": 0, "frames": 0, "frame_bytes": 0, "crc_errors": 0,
+            "junk_bytes": 0, "corrupted_bytes": 0, "nmea_bytes": 0, "other_bytes": 0,
+            "corrupted_fraction": 0.0, "engine": "",
+            "messages": {}, "first_epoch": None, "last_epoch": None, "epochs": 0,
+            "interval": None, "duration": None, "gaps_count": 0, "gaps": [], "time_jumps": 0,
+            "observations": False}
+
+
+# scanner of frames of one log; 'date' (<YYYY/MM/DD>) is approximate date
+# of log start, which resolves full time of epochs
+class LogScanner(object):
+
+    def __init__(self, path, date):
+
+        self.report = scan_report(path)
+        self.messages = collections.defaultdict(lambda: [0, 0])
+
+        self.decoder = rtcm3_decoder.Rtcm3Decoder(date)
+        self.epochs = []
+
+        # end of the last valid frame
+        self.frames_end = 0
+
+    # add bytes of 'data' of 'size' bytes from end of the last frame to
+    # 'start' of next frame (or end of data) to counters of junk bytes
+    def add_gap(self, data, start, size):
+
+        if start > self.frames_end:
+            report = self.report
+            corrupted, nmea, other = classify_gap(data, self.frames_end, start, size)
+            report["corrupted_bytes"] += corrupted
+            report["nmea_bytes"] += nmea
+            report["other_bytes"] += other
+
+    # add frame of 'size' bytes with payload starting by bytes 'head'
+    def add(self, head, size):
+
+        msg = rtcm3_decoder.message_type(head)
+
+        counter = self.messages[msg]
+        counter[0] += 1
+        counter[1] += size
+
+        epoch = frame_filter.epoch_field(head, msg)
+        if epoch != None:
+            self.add_epoch(msg, epoch)
+
+    # add frames of 'data' (bytes, mmap) given also as NumPy uint8 array
+    # 'buffer' as arrays of 'starts' and 'ends' offsets
+    def add_batch(self, data, buffer, starts, ends):
+
+        # gaps between frames are rare, so they're classified one by one
+        self.add_gap(data, int(starts[0]), len(data))
+        for item in numpy.flatnonzero(starts[1:] != ends[:-1]).tolist():
+            self.frames_end = int(ends[item])
+            self.add_gap(data, int(starts[item + 1]), len(data))
+        self.frames_end = int(ends[-1])
+
+        sizes = ends - starts
+        lengths = sizes - 6
+
+        # message number is stored in the first 12 bits of payload
+        msgs = numpy.where(lengths >= 2, (buffer[starts + 3].astype(numpy.int64) << 4) |
+                           (buffer[numpy.minimum(starts + 4, ends - 1)] >> 4), 0)
+
+        counts = numpy.bincount(msgs, minlength=4096)
+        totals = numpy.bincount(msgs, weights=sizes, minlength=4096)
+
+        for msg in numpy.flatnonzero(counts):
+            counter = self.messages[int(msg)]
+            counter[0] += int(counts[msg])
+            counter[1] += int(totals[msg])
+
+        # epoch time fields of observation messages (see frame_filter)
+        glonass = (msgs >= 1009) & (msgs <= 1012)
+        obs = (lengths >= 7) & (numpy.isin(msgs // 10, list(rtcm3_decoder.msm_systems)) |
+                                ((msgs >= 1001) & (msgs <= 1004)) | glonass)
+
+        items = numpy.flatnonzero(obs)
+        if len(items) == 0:
+            return
+
+        offsets = starts[items] + 6
+        fields = (buffer[offsets].astype(numpy.int64) << 24) | \
+            (buffer[offsets + 1].astype(numpy.int64) << 16) | \
+            (buffer[offsets + 2].astype(numpy.int64) << 8) | buffer[offsets + 3]
+        epochs = numpy.where(glonass[items], (fields >> 5) & 0x7FFFFFF,
+                             (fields >> 2) & 0x3FFFFFFF)
+        msgs = msgs[items]
+
+        # only changes of epoch of message type are followed
+        changed = numpy.ones(len(items), dtype=bool)
+        changed[1:] = (epochs[1:] != epochs[:-1]) | (msgs[1:] != msgs[:-1])
+
+        for msg, epoch in zip(msgs[changed].tolist(), epochs[changed].tolist()):
+            self.add_epoch(msg, epoch)
+
+    # add epoch time field 'epoch' of observation message 'msg'
+    def add_epoch(self, msg, epoch):
+
+        # epoch time is followed as by frame filter
+        decoder = self.decoder
+        decoder.time = decoder.msm_time(frame_filter.message_system(msg), epoch)
+
+        epochs = self.epochs
+        if len(epochs) == 0 or epochs[-1] != decoder.time:
+            epochs.append(decoder.time)
+
+    # complete report with 'stats' of frames and file 'size'
+    def finish(self, stats, size):
+
+        report = self.report
+        report["size"] = size
+        for key in ("frames", "frame_bytes", "crc_errors", "junk_bytes"):
+            report[key] = stats[key]
+
+        # junk bytes of compressed logs aren't classified
+        if report["engine"] == "stream":
+            for key in ("corrupted_bytes", "nmea_bytes", "other_bytes", "corrupted_fraction"):
+                report[key] = None
+        else:
+            report["corrupted_fraction"] = report["corrupted_bytes"] / size if size > 0 else 0.0
+
+        times = sorted(set(self.epochs))
+        deltas = [b - a for a, b in zip(self.epochs, self.epochs[1:])]
+
+        report["epochs"] = len(times)
+        report["time_jumps"] = len([delta for delta in deltas if delta < 0])
+        report["observations"] = any([is_obs_message(msg) for msg in self.messages])
+
+        if len(times) > 0:
+            report["first_epoch"] = times[0]
+            report["last_epoch"] = times[-1]
+
+        duration = None
+
+        if len(times) > 1:
+            # nominal interval is the most common time between epochs
+            steps = [b - a for a, b in zip(times, times[1:])]
+            interval = collections.Counter(steps).most_common(1)[0][0]
+            duration = (times[-1] - times[0] + interval) * 0.001
+
+            gaps = [(a, b - a) for a, b in zip(times, times[1:]) if b - a > gap_factor * interval]
+            gaps.sort(key=lambda gap: -gap[1])
+
+            report["interval"] = interval * 0.001
+            report["duration"] = duration
+            report["gaps_count"] = len(gaps)
+            report["gaps"] = [{"after": start, "length": length * 0.001}
+                              for start, length in gaps[:max_gaps]]
+
+        # rates are given per second of epochs of log; frames without
+        # message type are null (keep-alive) frames
+        for msg in sorted(self.messages):
+            count, size = self.messages[msg]
+            report["messages"][str(msg) if msg != 0 else "null"] = {
+                "count": count, "bytes": size,
+                "rate": count / duration if duration else None,
+                "bytes_rate": size / duration if duration else None}
+
+        return report
+
+
+# scan RTCM 3 log 'path' recorded on 'date' (<YYYY/MM/DD>, date of file
+# modification if None); log may be compressed; returns report (see
+# scan_report)
+def scan_file(path, date=None):
+
+    if date == None:
+        date = datetime.datetime.utcfromtimestamp(os.path.getmtime(path)).strftime("%Y/%m/%d")
+
+    scanner = LogScanner(path, date)
+    stats = rtcm3_decoder.frame_stats()
+
+    if compressed_io.file_compression(path) != None:
+        scanner.report["engine"] = "stream"
+        for offset, payload in iter_frames_stream(path, stats):
+            scanner.add(payload[:7], len(payload) + 6)
+        return scanner.finish(stats, stats["frame_bytes"] + stats["junk_bytes"])
+
+    with open(path, 'rb') as in_file:
+
+        size = os.fstat(in_file.fileno()).st_size
+        if size == 0:
+            return scanner.finish(stats, 0)
+
+        data = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            if numpy != None:
+                scanner.report["engine"] = "numpy"
+                buffer = numpy.frombuffer(data, dtype=numpy.uint8)
+                for starts, ends in iter_frames_batched(data, buffer, stats):
+                    scanner.add_batch(data, buffer, starts, ends)
+                # array must be released before memory map is closed
+                del buffer
+
+            else:
+                scanner.report["engine"] = "table"
+                for start, end in iter_frames_table(data, stats):
+                    scanner.add_gap(data, start, size)
+                    scanner.frames_end = end
+                    scanner.add(data[start + 3:min(start + 10, end - 3)], end - start)
+
+            scanner.add_gap(data, size, size)
+
+        finally:
+            data.close()
+
+    return scanner.finish(stats, size)
+
+
+# check if log of 'report' contains observation messages
+def has_observations(report):
+    return report["observations"]
+
+
+# return GPS time [ms] 'time' as text
+def time_text(time):
+    return rinex_writer.gps_ms_to_datetime(time).strftime("%Y/%m/%d %H:%M:%S.%f")[:-3]
+
+
+# print report returned by scan_file
+def print_report(report):
+
+    print("File: %s (%d bytes, CRC checked by %s)" % (report["file"], report["size"],
+                                                      report["engine"]))
+    print("Number of valid frames: %d (%d bytes)" % (report["frames"], report["frame_bytes"]))
+    print("Number of CRC errors: " + str(report["crc_errors"]))
+
+    if report["corrupted_fraction"] != None:
+        print("Corrupted bytes (CRC errors and resync): %d (%.2f %%)" % (
+            report["corrupted_bytes"], report["corrupted_fraction"] * 100.0))
+        print("Non-RTCM bytes: %d NMEA, %d other" % (report["nmea_bytes"], report["other_bytes"]))
+    else:
+        print("Bytes out of frames: %d (not classified for compressed log)" %
+              report["junk_bytes"])
+
+    if report["first_epoch"] != None:
+        print("Epochs: %d from %s to %s (GPS time)" % (report["epochs"],
+                                                     time_text(report["first_epoch"]),
+                                                     time_text(report["last_epoch"])))
+    if report["interval"] != None:
+        print("Interval: %.3f s, duration: %.1f s" % (report["interval"], report["duration"]))
+        print("Number of time gaps: %d, time jumps back: %d" % (report["gaps_count"],
+                                                               report["time_jumps"]))
+        for gap in report["gaps"]:
+            print("  %.3f s gap after %s" % (gap["length"], time_text(gap["after"])))
+
+    print("\n%8s %10s %12s %10s %12s" % ("message", "count", "bytes", "msg/s", "bytes/s"))
+    for msg, counter in sorted(report["messages"].items(),
+                               key=lambda item: int(item[0]) if item[0] != "null" else 0):
+        rate = "%10.2f %12.1f" % (counter["rate"], counter["bytes_rate"]) \
+            if counter["rate"] != None else "%10s %12s" % ("-", "-")
+        print("%8s %10d %12d %s" % (msg, counter["count"], counter["bytes"], rate))
+
+    if has_observations(report) == False:
+        print("\nWARNING: log doesn't contain observation messages!")
+
+
+if __name__ == "__main__":
+
+    start = time.time()
+
+    #%% Read input arguments
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_file", type=str,
+                        help="input RTCM 3 log (may be compressed by gzip or zstd).")
+    parser.add_argument("-t", "--date", type=str,
+                        help="calendar date of beginning of log as <YYYY/MM/DD>. " \
+                            "If not specified, date of file modification is used.")
+    parser.add_argument("-j", "--json", type=str,
+                        help="save report as JSON <file>.")
+    parser.add_argument("--require-obs", action='store_true',
+                        help="exit with status 2 if log doesn't contain observation messages.")
+    args = parser.parse_args()
+
+    if os.path.isfile(args.input_file) == False:
+        print("Can't locate file: " + args.input_file)
+        print("Exiting!")
+        sys.exit(1)
+
+    #%% Scan log
+
+    try:
+        report = scan_file(args.input_file, args.date)
+        if args.json != None:
+            with open(args.json, 'w') as out_file:
+                json.dump(report, out_file, indent=2, sort_keys=True)
+    except (ValueError, RuntimeError, EnvironmentError) as e:
+        print(e)
+        print("Exiting!")
+        sys.exit(1)
+
+    print_report(report)
+
+    stop = time.time()
+    delta = stop - start
+    print("Processing time: %.2f s\n" % delta)
+
+    if args.require_obs == True and has_observations(report) == False:
+        sys.exit(2)
@@ -0,0 +1,468 @@
+"""
+  @file rtcm_stream.py
+  @brief Routines to convert live RTCM 3 streams into rolling RINEX obs and nav files
+
+  @author Michal Zygmunt
+
+  @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
+
+  @license See LICENSE file for license details.
+
+  @todo none
+  @bug none
+"""
+
+import argparse
+import asyncio
+import datetime
+import os
+import sys
+import time
+
+import rinex_writer
+import rtcm3_decoder
+
+#%% Streaming conversion
+#   RTCM 3 data is read from TCP socket, FIFO or growing file in chunks,
+#   framed incrementally and decoded by native decoder. Epoch is completed
+#   when MSM message with multiple message bit cleared arrives; completed
+#   epoch is kept until next epoch (or time limit), so repeated blocks of
+#   the same epoch are merged as by obs fixer. Values are written in 'E'
+#   format, so nav files don't need fixing. Output files are rotated at
+#   boundaries of GPS time periods; file is written with '.part' suffix,
+#   which is removed when file is completed.
+
+# size of chunk read from source and number of chunks buffered
+read_size = 64 * 1024
+queue_size = 16
+
+# interval of polling growing file for new data [s]
+poll_interval = 0.5
+
+# suffix of files being written
+part_suffix = ".part"
+
+
+class RinexStream(object):
+
+    # 'date' <YYYY/MM/DD> is approximate date of data start; files named
+    # <name>_<YYYYMMDD>_<HHMM>.obs/.nav are written to 'out_dir_path' and
+    # rotated every 'period' minutes; completed epoch is written at most
+    # 'latency' seconds after it was received
+    def __init__(self, date, out_dir_path, name, period=60, latency=1.0):
+
+        self.decoder = rtcm3_decoder.Rtcm3Decoder(date)
+        self.stats = rtcm3_decoder.frame_stats()
+        self.buffer = b''
+
+        self.out_dir_path = out_dir_path
+        self.name = name
+        self.period = period * 60 * 1000
+        self.latency = latency
+
+        # epoch waiting for repeated blocks: [time, observations, receive time]
+        self.pending = None
+        self.last_time = None
+
+        # observation codes seen so far, used by header of next file
+        self.codes = {}
+        self.doppler = set()
+
+        self.obs_file = None
+        self.nav_file = None
+        self.file_start = None
+        self.types = None
+        self.paths = []
+
+        # latest ephemeris of each satellite and ephemerides written to
+        # current nav file
+        self.nav_latest = {}
+        self.nav_keys = set()
+
+        # counters
+        self.epochs = 0
+        self.merged_epochs = 0
+        self.late_epochs = 0
+        self.files = 0
+
+    #%% Input data
+
+    # process chunk of stream data
+    def feed(self, chunk, now=None):
+
+        if now == None:
+            now = time.time()
+
+        data = self.buffer + chunk
+        self.stats["offset"] = 0
+
+        for offset, payload in rtcm3_decoder.iter_frames(data, self.stats, final=False):
+
+            event = self.decoder.decode_payload(payload)
+
+            if event != None:
+                if event[0] == "obs":
+                    self.add_epoch(event[1][0], event[1][1], now)
+                else:
+                    self.add_nav(event[1])
+
+            if self.decoder.epoch_complete:
+                self.decoder.epoch_complete = False
+                epoch = self.decoder.flush()
+                if epoch != None:
+                    self.add_epoch(epoch[0], epoch[1], now)
+
+        # only incomplete frame is kept
+        self.buffer = data[self.stats["offset"]:]
+
+    # write pending epoch if it waits longer than latency limit
+    def check_latency(self, now=None):
+
+        if now == None:
+            now = time.time()
+
+        if self.pending != None and now - self.pending[2] >= self.latency:
+            self.write_pending()
+
+    #%% Observations
+
+    # add epoch 'time' with 'observations' received at 'now'
+    def add_epoch(self, time, observations, now):
+
+        for sat, signals in observations.items():
+            codes = self.codes.setdefault(sat[0], set())
+            for code, signal in signals.items():
+                codes.add(code)
+                if signal[2] != None:
+                    self.doppler.add(sat[0])
+
+        # repeated block of pending epoch
+        if self.pending != None and self.pending[0] == time:
+            for sat, signals in observations.items():
+                self.pending[1].setdefault(sat, {}).update(signals)
+            self.merged_epochs += 1
+            return
+
+        if self.pending != None:
+            self.write_pending()
+
+        # block of epoch already written can't be merged anymore
+        if self.last_time != None and time == self.last_time:
+            self.late_epochs += 1
+            return
+
+        self.pending = [time, observations, now]
+
+    # write pending epoch to obs file of its period
+    def write_pending(self):
+
+        time, observations = self.pending[0], self.pending[1]
+        self.pending = None
+
+        file_start = time - time % self.period
+        if self.obs_file == None or file_start != self.file_start:
+            self.rotate(file_start, time)
+
+        self.obs_file.writelines(rinex_writer.epoch_lines(time, observations, self.types))
+        self.obs_file.flush()
+
+        self.last_time = time
+        self.epochs += 1
+
+    #%% Ephemerides
+
+    # add ephemeris 'eph'; new ephemeris is written to current nav file
+    def add_nav(self, eph):
+
+        key = (eph["sat"], eph["time"], eph["iode"])
+        if key in self.nav_keys:
+            return
+
+        latest = self.nav_latest.get(eph["sat"])
+        if latest == None or latest["time"] <= eph["time"]:
+            self.nav_latest[eph["sat"]] = eph
+
+        if self.nav_file != None:
+            self.nav_keys.add(key)
+            self.nav_file.writelines(rinex_writer.nav_record_lines(eph))
+            self.nav_file.flush()
+
+    #%% Output files
+
+    # close current files and open files of period starting at 'file_start';
+    # header of obs file is written for first epoch 'time' and observation
+    # codes seen so far; nav file starts with latest ephemerides
+    def rotate(self, file_start, time):
+
+        self.close_files()
+
+        date = rinex_writer.gps_ms_to_datetime(file_start)
+        file_name = "%s_%s" % (self.name, date.strftime("%Y%m%d_%H%M"))
+        obs_path = os.path.join(self.out_dir_path, file_name + ".obs")
+        nav_path = os.path.join(self.out_dir_path, file_name + ".nav")
+
+        info = {"codes": self.codes, "doppler": self.doppler, "first": time, "last": None,
+                "glonass_fcn": self.decoder.glonass_fcn, "position": self.decoder.position}
+        self.types = rinex_writer.obs_types(info)
+
+        self.obs_file = open(obs_path + part_suffix, "w")
+        self.obs_file.writelines(rinex_writer.obs_header(info, self.types, self.name))
+
+        self.nav_file = open(nav_path + part_suffix, "w")
+        self.nav_file.writelines(rinex_writer.nav_header(self.name))
+
+        self.nav_keys = set()
+        for sat in sorted(self.nav_latest, key=rinex_writer.sat_sort_key):
+            eph = self.nav_latest[sat]
+            self.nav_keys.add((eph["sat"], eph["time"], eph["iode"]))
+            self.nav_file.writelines(rinex_writer.nav_record_lines(eph))
+
+        self.file_start = file_start
+        self.paths = [obs_path, nav_path]
+        self.files += 1
+
+        print("Writing: " + obs_path)
+
+    # close current files and remove '.part' suffix
+    def close_files(self):
+
+        if self.obs_file == None:
+            return
+
+        self.obs_file.close()
+        self.nav_file.close()
+        self.obs_file = None
+        self.nav_file = None
+
+        for path in self.paths:
+            os.replace(path + part_suffix, path)
+
+    # write pending epoch and close files
+    def close(self):
+
+        if self.pending != None:
+            self.write_pending()
+
+        self.close_files()
+
+
+#%% Stream sources
+
+# yield chunks of data received from TCP server 'host':'port'
+async def read_tcp(host, port):
+
+    reader, writer = await asyncio.open_connection(host, port)
+
+    try:
+        while True:
+            chunk = await reader.read(read_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        writer.close()
+
+
+# yield chunks of data read from file or FIFO 'path'; if 'follow' is True,
+# file is polled for new data after its end is reached (like 'tail -f')
+async def read_file(path, follow):
+
+    loop = asyncio.get_event_loop()
+
+    # opening FIFO blocks until writer is connected
+    in_file = await loop.run_in_executor(None, lambda: open(path, 'rb', buffering=0))
+
+    try:
+        while True:
+            chunk = await loop.run_in_executor(None, in_file.read, read_size)
+
+            if chunk:
+                yield chunk
+            elif follow:
+                await asyncio.sleep(poll_interval)
+            else:
+                break
+    finally:
+        in_file.close()
+
+
+# return chunk generator for 'source' given as tcp://<host>:<port> or path
+def open_source(source, follow=False):
+
+    if source.startswith("tcp://"):
+        host, port = source[len("tcp://"):].rsplit(":", 1)
+        return read_tcp(host, int(port))
+
+    return read_file(source, follow)
+
+
+# put chunks of 'source' into 'queue'; None is put at the end of stream
+async def produce(source, follow, queue):
+
+    try:
+        async for chunk in open_source(source, follow):
+            await queue.put(chunk)
+    except EnvironmentError as e:
+        print(e)
+
+    await queue.put(None)
+
+
+# convert stream 'source' by 'stream' (RinexStream) until end of stream
+async def record(source, stream, follow=False):
+
+    queue = asyncio.Queue(maxsize=queue_size)
+    producer = asyncio.ensure_future(produce(source, follow, queue))
+
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(queue.get(), timeout=stream.latency)
+            except asyncio.TimeoutError:
+                stream.check_latency()
+                continue
+
+            if chunk == None:
+                break
+
+            stream.feed(chunk)
+            stream.check_latency()
+
+    finally:
+        producer.cancel()
+        stream.close()
+
+
+#%% Replay server
+
+# send log 'data' to connected client; data is paced by MSM epoch times,
+# 'speed' times faster than real time (as fast as possible if 'speed' is 0)
+async def replay(data, date, speed, reader, writer):
+
+    loop = asyncio.get_event_loop()
+    decoder = rtcm3_decoder.Rtcm3Decoder(date)
+
+    start_wall = loop.time()
+    start_time = None
+    pos = 0
+
+    try:
+        for offset, payload in rtcm3_decoder.iter_frames(data):
+
+            msg = rtcm3_decoder.message_type(payload)
+            if speed <= 0 or msg // 10 not in rtcm3_decoder.msm_systems or len(payload) < 7:
+                continue
+
+            fields = rtcm3_decoder.BitFields(payload)
+            decoder.time = decoder.msm_time(rtcm3_decoder.msm_systems[msg // 10], fields.u(24, 30))
+
+            if start_time == None:
+                start_time = decoder.time
+
+            delay = (decoder.time - start_time) * 0.001 / speed - (loop.time() - start_wall)
+
+            if delay > 0:
+                writer.write(data[pos:offset])
+                pos = offset
+                await writer.drain()
+                await asyncio.sleep(delay)
+
+        writer.write(data[pos:])
+        await writer.drain()
+
+    except ConnectionError:
+        pass
+
+    finally:
+        writer.close()
+
+
+# serve log file 'in_file_path_name' on 'host':'port' to every client
+async def serve(in_file_path_name, date, host, port, speed):
+
+    with open(in_file_path_name, 'rb') as in_file:
+        data = in_file.read()
+
+    server = await asyncio.start_server(
+        lambda reader, writer: replay(data, date, speed, reader, writer), host, port)
+
+    print("Serving %s on %s:%d" % (in_file_path_name, host, port))
+
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+
+    #%% Read input arguments
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+
+    parser_record = subparsers.add_parser("record",
+                                          help="convert RTCM 3 stream into rolling RINEX files.")
+    parser_record.add_argument("date", type=str,
+                               help="calendar date of beginning of RTCM messages as <YYYY/MM/DD>.")
+    parser_record.add_argument("source", type=str,
+                               help="stream source: tcp://<host>:<port>, FIFO or file path.")
+    parser_record.add_argument("-d", "--dest", type=str, default=".",
+                               help="destination <directory> to save RINEX files.")
+    parser_record.add_argument("-n", "--name", type=str, default="rtcm",
+                               help="prefix of names of RINEX files.")
+    parser_record.add_argument("-p", "--period", type=int, choices=[15, 60], default=60,
+                               help="period of file rotation in minutes.")
+    parser_record.add_argument("-l", "--latency", type=float, default=1.0,
+                               help="maximum time in seconds an epoch waits for repeated blocks.")
+    parser_record.add_argument("-f", "--follow", action='store_true',
+                               help="wait for new data at end of file, like 'tail -f'.")
+
+    parser_serve = subparsers.add_parser("serve",
+                                         help="replay RTCM log to TCP clients.")
+    parser_serve.add_argument("input_file", type=str,
+                              help="RTCM log to replay.")
+    parser_serve.add_argument("--host", type=str, default="127.0.0.1",
+                              help="address to listen on.")
+    parser_serve.add_argument("--port", type=int, default=2101,
+                              help="port to listen on.")
+    parser_serve.add_argument("-s", "--speed", type=float, default=1.0,
+                              help="replay speed relative to real time, 0 for no pacing.")
+    parser_serve.add_argument("-t", "--date", type=str,
+                              default=datetime.date.today().strftime("%Y/%m/%d"),
+                              help="approximate date of data as <YYYY/MM/DD>, used for pacing.")
+
+    args = parser.parse_args()
+
+    if args.command == None:
+        parser.print_help()
+        sys.exit(1)
+
+    try:
+        if args.command == "serve":
+            asyncio.run(serve(args.input_file, args.date, args.host, args.port, args.speed))
+
+        else:
+            start = time.time()
+
+            if os.path.exists(args.dest) == False:
+                os.makedirs(args.dest)
+
+            stream = RinexStream(args.date, args.dest, args.name, args.period, args.latency)
+            asyncio.run(record(args.source, stream, args.follow))
+
+            print("Number of RTCM messages: %d (CRC errors: %d)" %
+                  (stream.stats["frames"], stream.stats["crc_errors"]))
+            print("Number of epochs: " + str(stream.epochs))
+            print("Number of merged epochs: " + str(stream.merged_epochs))
+            print("Number of late epochs dropped: " + str(stream.late_epochs))
+            print("Number of files: " + str(stream.files))
+
+            stop = time.time()
+            delta = stop - start
+            print("Processing time: %.2f s\n" % delta)
+
+    except KeyboardInterrupt:
+        pass
+    except (ValueError, EnvironmentError) as e:
+        print(e)
+        print("Exiting!")
+        sys.exit(1)
@@ -0,0 +1,241 @@
+"""
+  @file run_metrics.py
+  @brief Routines to collect metrics of conversion stages and export them as JSON or Prometheus text
+
+  @author Michal Zygmunt
+
+  @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
+
+  @license See LICENSE file for license details.
+
+  @todo none
+  @bug none
+"""
+
+import json
+import os
+import socket
+import time
+
+import rtcm3_decoder
+
+# resource usage is available only on Unix systems
+try:
+    import resource
+except ImportError:
+    resource = None
+
+#%% Run metrics
+#   Each stage of conversion records its wall and CPU time (including child
+#   processes, e.g. 'convbin'), peak resident set size and sizes of its
+#   input and output files. Peak RSS is maximum of this process and its
+#   children since their start, so it never decreases between stages of one
+#   run. Counters of data (epochs, duplicated rows, frames, ...) are stored
+#   by stages; counters which weren't measured stay None and are not
+#   exported to Prometheus.
+
+report_version = 1
+
+# prefix of Prometheus metric names
+metric_prefix = "rtcm2rinex_"
+
+# counters of run with their descriptions
+counter_names = [
+    ("epochs", "Number of epochs written to RINEX obs file."),
+    ("satellites", "Number of satellite rows written to RINEX obs file."),
+    ("duplicated_rows", "Number of duplicated obs rows and epoch rows removed."),
+    ("out_of_order_merges", "Number of merges of duplicated epochs which were not consecutive."),
+    ("nav_values_rewritten", "Number of RINEX nav values re-formatted."),
+    ("frames", "Number of valid RTCM frames."),
+    ("crc_errors", "Number of RTCM frames with invalid CRC."),
+    ("unknown_messages", "Number of RTCM messages of types which are not converted."),
+    ("track_records", "Number of NMEA GGA records written to track file."),
+    ("data_gaps", "Number of data gaps of satellites found by obs quality check."),
+    ("phase_jumps", "Number of phase jumps of signals found by obs quality check."),
+]
+
+# values of stages exported to Prometheus as (key, metric name, description)
+stage_metrics = [
+    ("wall_time", "stage_wall_seconds", "Wall time of stage."),
+    ("cpu_time", "stage_cpu_seconds", "CPU time of stage and its child processes."),
+    ("peak_rss", "stage_peak_rss_bytes", "Peak resident set size at end of stage."),
+    ("bytes_in", "stage_input_bytes", "Size of input files of stage."),
+    ("bytes_out", "stage_output_bytes", "Size of output files of stage."),
+]
+
+# RTCM messages converted to RINEX files
+known_messages = set([sys * 10 + msm for sys in rtcm3_decoder.msm_systems for msm in range(4, 8)] +
+                     [1005, 1006, 1019, 1020, 1042, 1046])
+
+
+# return peak resident set size [bytes] of this process and its children or
+# None if it's unknown
+def peak_rss():
+
+    if resource == None:
+        return None
+
+    # Linux reports kB, macOS bytes
+    scale = 1 if os.uname()[0] == "Darwin" else 1024
+
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+
+
+# return CPU time [s] of this process and its terminated children
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+# return total size of existing files 'paths'
+def files_size(paths):
+    return sum([os.path.getsize(path) for path in paths if path != None and os.path.isfile(path)])
+
+
+# metrics of one stage; files read and written by stage are listed in
+# 'inputs' and 'outputs', which may be set while stage runs, as their sizes
+# are taken when it ends; result is stored in 'stages' dictionary if it's
+# given
+class Stage(object):
+
+    def __init__(self, name, inputs=None, outputs=None, stages=None):
+
+        self.name = name
+        self.inputs = list(inputs or [])
+        self.outputs = list(outputs or [])
+        self.stages = stages
+        self.result = {}
+
+    def __enter__(self):
+
+        self.wall_start = time.time()
+        self.cpu_start = cpu_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.result = {"wall_time": time.time() - self.wall_start,
+                       "cpu_time": cpu_time() - self.cpu_start,
+                       "peak_rss": peak_rss(),
+                       "bytes_in": files_size(self.inputs),
+                       "bytes_out": files_size(self.outputs),
+                       "ok": exc_type == None}
+
+        if self.stages != None:
+            self.stages[self.name] = self.result
+
+
+# metrics of one conversion of 'input_path'
+class RunMetrics(object):
+
+    def __init__(self, input_path):
+
+        self.report = {"version": report_version, "input": input_path,
+                       "host": socket.gethostname(), "started": time.time(),
+                       "finished": None, "status": "running", "error": "", "cache": None,
+                       "stages": {}, "counters": dict((name, None) for name, _ in counter_names)}
+
+    # return Stage 'name', which is stored in report when it ends
+    def stage(self, name, inputs=None, outputs=None):
+        return Stage(name, inputs, outputs, self.report["stages"])
+
+    # add 'value' to counter 'name'
+    def count(self, name, value):
+
+        counters = self.report["counters"]
+        counters[name] = (counters[name] or 0) + value
+
+    # store counters of RTCM frames given as stats of iter_frames and number
+    # of unknown messages
+    def count_frames(self, stats, unknown_messages=None):
+
+        self.count("frames", stats["frames"])
+        self.count("crc_errors", stats["crc_errors"])
+        if unknown_messages != None:
+            self.count("unknown_messages", unknown_messages)
+
+    # end run with 'error' message (empty if run succeeded)
+    def finish(self, error=""):
+
+        self.report["finished"] = time.time()
+        self.report["status"] = "failed" if error != "" else "ok"
+        self.report["error"] = error
+
+    #%% Export
+
+    # save report as JSON file 'path'
+    def write_json(self, path):
+        write_atomic(path, json.dumps(self.report, indent=2, sort_keys=True) + "\n")
+
+    # return report as lines of Prometheus text format
+    def prometheus_lines(self):
+
+        report = self.report
+        labels = 'input="%s"' % escape_label(os.path.basename(report["input"]))
+
+        lines = []
+
+        def add(name, kind, text, values):
+            lines.append("# HELP %s%s %s\n" % (metric_prefix, name, text))
+            lines.append("# TYPE %s%s %s\n" % (metric_prefix, name, kind))
+            for extra, value in values:
+                lines.append("%s%s{%s%s} %s\n" % (metric_prefix, name, labels, extra, value))
+
+        add("run_success", "gauge", "1 if conversion succeeded.",
+            [("", 1 if report["status"] == "ok" else 0)])
+        add("run_finished_timestamp_seconds", "gauge", "Time of end of conversion.",
+            [("", "%.3f" % (report["finished"] or time.time()))])
+
+        stages = sorted(report["stages"].items())
+
+        for key, name, text in stage_metrics:
+            values = [(',stage="%s"' % stage, result[key]) for stage, result in stages
+                      if result.get(key) != None]
+            if values:
+                add(name, "gauge", text, values)
+
+        for name, text in counter_names:
+            if report["counters"][name] != None:
+                add(name, "gauge", text, [("", report["counters"][name])])
+
+        return lines
+
+    # save report as Prometheus text file 'path' (e.g. in directory of node
+    # exporter textfile collector)
+    def write_prometheus(self, path):
+        write_atomic(path, "".join(self.prometheus_lines()))
+
+
+# escape 'text' used as Prometheus label value
+def escape_label(text):
+    return text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# write 'text' to file 'path'; file is replaced by rename, so readers (e.g.
+# node exporter) never see partial file
+def write_atomic(path, text):
+
+    temp_path = path + ".tmp"
+
+    with open(temp_path, 'w') as out_file:
+        out_file.write(text)
+
+    os.replace(temp_path, path)
+
+
+# return counters of RTCM frames of file 'path' (see count_frames) as stats
+# of iter_frames and number of messages which are not converted
+def scan_frames(path):
+
+    stats = rtcm3_decoder.frame_stats()
+    unknown_messages = 0
+
+    with open(path, 'rb') as in_file:
+        for offset, payload in rtcm3_decoder.read_frames(in_file, stats):
+            # empty frames are not counted, as by native decoder
+            msg = rtcm3_decoder.message_type(payload)
+            if msg != 0 and msg not in known_messages:
+                unknown_messages += 1
+
+    return stats, unknown_messages
@@ -0,0 +1,371 @@
+"""
+  @file session_split.py
+  @brief Routines to split RINEX obs and nav data written by fixers into fixed-length sessions
+
+  @author Michal Zygmunt
+
+  @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
+
+  @license See LICENSE file for license details.
+
+  @todo none
+  @bug none
+"""
+
+import bisect
+import collections
+import datetime
+import os.path
+
+import compressed_io
+import rinex_writer
+
+#%% Sessions
+#   Day is divided into sessions of fixed length starting at midnight (the
+#   last session of day is shorter if length doesn't divide day, sessions
+#   can't be longer than day). Fixers pass every written epoch (nav record)
+#   to ObsSessions (NavSessions), which write it to file of session of its
+#   time, so the whole input is split in the same pass. Nav file doesn't
+#   keep epoch in which record was received, so nav records are kept in
+#   memory and written when splitter is closed, sorted by time of clock:
+#   each record goes to obs session of its time of clock if obs file is
+#   split too, otherwise to the nearest obs session (stale ephemerides
+#   don't make sessions of their own); without obs sessions, records are
+#   split by time of clock. Event epochs without time go to session of
+#   previous epoch (or of the next epoch at start of file). Each session file gets copy of
+#   input header; TIME OF FIRST OBS of obs file is set to its first epoch
+#   and TIME OF LAST OBS is patched in place when file is closed (it's left
+#   out of compressed files, which can't be patched). Only 'max_open' files
+#   are kept open; the least recently used one is closed and opened for
+#   appending if session gets more data later.
+
+# default number of open session files
+default_max_open = 8
+
+# units of session length given as text
+length_units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+seconds_of_day = 86400
+
+
+# return session length [s] of 'text' given as number of seconds or number
+# with unit (e.g. '15m', '1h')
+def parse_length(text):
+
+    text = text.strip().lower()
+    scale = 1
+
+    if text[-1:] in length_units:
+        scale = length_units[text[-1]]
+        text = text[:-1]
+
+    try:
+        length = int(float(text) * scale)
+    except ValueError:
+        raise ValueError("Invalid session length: " + text)
+
+    if length <= 0:
+        raise ValueError("Session length must be positive!")
+
+    if length > seconds_of_day:
+        raise ValueError("Session length can't be longer than a day!")
+
+    return length
+
+
+# return start (datetime) of session of 'length' [s] containing time given
+# as text 'yyyy mm dd hh mm ss' (seconds may have fraction)
+def session_start(text, length):
+
+    year, month, day, hour, minute, second = text.split()
+
+    seconds = int(hour) * 3600 + int(minute) * 60 + int(float(second))
+    seconds = min(seconds, seconds_of_day - 1)
+
+    return datetime.datetime(int(year), int(month), int(day)) + \
+        datetime.timedelta(seconds=seconds - seconds % length)
+
+
+# return path of file of session starting at 'start' for output file 'path';
+# start date and time is added to file name before its extensions (e.g.
+# 'log.obs.gz' -> 'log_20210304_0900.obs.gz')
+def session_path(path, start):
+
+    base, compression = compressed_io.split_compression(path)
+    base, ext = os.path.splitext(base)
+
+    return base + start.strftime("_%Y%m%d_%H%M") + ext + compression
+
+
+# open files of sessions of output file 'path' (text files if 'text' is
+# True); file of new session starts by header returned by 'header' function
+# called with the first lines written to session
+class SessionWriters(object):
+
+    def __init__(self, path, header, text=False, max_open=default_max_open):
+
+        self.path = path
+        self.header = header
+        self.text = text
+        self.max_open = max(max_open, 1)
+        self.empty = "" if text == True else b""
+
+        # session start -> path of all created files and open files in
+        # order of use
+        self.paths = {}
+        self.files = collections.OrderedDict()
+
+    # write 'lines' to file of session starting at 'start'
+    def write(self, start, lines):
+
+        out_file = self.files.get(start)
+
+        if out_file != None:
+            self.files.move_to_end(start)
+
+        else:
+            if len(self.files) >= self.max_open:
+                self.files.popitem(last=False)[1].close()
+
+            if start in self.paths:
+                out_file = compressed_io.open_output(self.paths[start], self.text, append=True)
+            else:
+                path = session_path(self.path, start)
+                out_file = compressed_io.open_output(path, self.text)
+                self.paths[start] = path
+                lines = self.header(lines) + lines
+
+            self.files[start] = out_file
+
+        out_file.write(self.empty.join(lines))
+
+    # return paths of files of sessions sorted by time
+    def session_paths(self):
+        return [self.paths[start] for start in sorted(self.paths)]
+
+    # close all files; returns paths of files of sessions
+    def close(self):
+
+        while len(self.files) > 0:
+            self.files.popitem(last=False)[1].close()
+
+        return self.session_paths()
+
+
+# return header line (bytes) of 'label' with time of epoch row 'epoch' in
+# 'system' time
+def time_line(epoch, system, label):
+
+    year, month, day, hour, minute, second = epoch[2:29].decode().split()
+
+    return rinex_writer.header_line(
+        "  %4s    %2s    %2s    %2s    %2s%13.7f     %-3s" % (
+            year, month, day, hour, minute, float(second), system), label).encode()
+
+
+# replace line of 'label' (bytes) of header of uncompressed RINEX file
+# 'path' by 'line' of the same length
+def patch_header_line(path, label, line):
+
+    with open(path, 'r+b') as rinex_file:
+
+        offset = 0
+        for header_line in rinex_file:
+            if header_line[60:60 + len(label)] == label:
+                rinex_file.seek(offset)
+                rinex_file.write(line[:len(header_line.rstrip(b'\r\n'))])
+                return
+            if header_line[60:73] == b"END OF HEADER":
+                return
+            offset += len(header_line)
+
+
+# splitter of obs file into files of sessions of 'length' [s] named by
+# output file 'path'; header and epochs are added by obs fixer as to
+# obs_store.ObsStore
+class ObsSessions(object):
+
+    def __init__(self, path, length, max_open=default_max_open):
+
+        self.length = length
+        self.writers = SessionWriters(path, self.header_lines, max_open=max_open)
+
+        # last epoch of each session, written to header of uncompressed
+        # files when they're closed
+        self.patched = compressed_io.split_compression(path)[1] == "" and \
+            os.path.splitext(path)[1] != '.crx'
+        self.last = {}
+        self.start = None
+
+        # event epochs without time before the first epoch with time
+        self.pending = []
+
+        self.header = []
+        self.system = "GPS"
+
+    # store header lines 'lines' (bytes) copied to files of sessions
+    def add_header(self, lines):
+
+        self.header = list(lines)
+
+        for line in lines:
+            if line[60:77] == b"TIME OF FIRST OBS" and line[48:51].strip() != b"":
+                self.system = line[48:51].strip().decode()
+
+    # return header of session file starting by 'lines' (the first epoch row
+    # with time may follow event epochs without time)
+    def header_lines(self, lines):
+
+        epoch = next(line for line in lines if line[:1] == b'>' and line[2:29].strip() != b"")
+        first = time_line(epoch, self.system, "TIME OF FIRST OBS")
+        header = []
+
+        for line in self.header:
+            label = line[60:].strip()
+
+            if label == b"TIME OF FIRST OBS":
+                line = first
+                first = None
+            elif label == b"TIME OF LAST OBS":
+                # placeholder is patched when file is closed
+                if self.patched == False:
+                    continue
+                line = time_line(epoch, self.system, "TIME OF LAST OBS")
+            elif label == b"END OF HEADER" and first != None:
+                header.append(first)
+
+            header.append(line)
+
+        return header
+
+    # write epoch of epoch row 'epoch' (bytes) with observation rows 'lines'
+    def add(self, epoch, lines):
+
+        # event epochs may be given without time
+        if epoch[2:29].strip() == b"":
+            if self.start == None:
+                self.pending += [epoch] + lines
+            else:
+                self.writers.write(self.start, [epoch] + lines)
+            return
+
+        self.start = session_start(epoch[2:29].decode(), self.length)
+        self.last[self.start] = epoch
+
+        self.writers.write(self.start, self.pending + [epoch] + lines)
+        self.pending = []
+
+    # return paths of files of sessions sorted by time
+    def paths(self):
+        return self.writers.session_paths()
+
+    # return starts of sessions (datetime) sorted by time
+    def starts(self):
+        return sorted(self.writers.paths)
+
+    # close files of sessions; returns their paths
+    def close(self):
+
+        if len(self.pending) > 0:
+            print("WARNING: obs file has only event epochs without time, they're not written!")
+            self.pending = []
+
+        paths = self.writers.close()
+
+        if self.patched == True:
+            for start, path in self.writers.paths.items():
+                patch_header_line(path, b"TIME OF LAST OBS",
+                                  time_line(self.last[start], self.system, "TIME OF LAST OBS"))
+            self.last = {}
+
+        return paths
+
+
+# return the nearest of session starts 'starts' (sorted datetime list) to
+# session start 'start'
+def nearest_start(starts, start):
+
+    item = bisect.bisect_left(starts, start)
+
+    if item == len(starts):
+        return starts[-1]
+    if item == 0 or starts[item] == start:
+        return starts[item]
+
+    if start - starts[item - 1] <= starts[item] - start:
+        return starts[item - 1]
+    return starts[item]
+
+
+# splitter of nav file into files of sessions of 'length' [s] named by
+# output file 'path'; header and blocks of fixed records are added by nav
+# fixer and files are written when it's closed
+class NavSessions(object):
+
+    def __init__(self, path, length, max_open=default_max_open):
+
+        self.length = length
+        self.writers = SessionWriters(path, self.header_lines, text=True, max_open=max_open)
+
+        self.header = []
+
+        # time of clock -> session start; many records share time of clock
+        self.starts = {}
+
+        # records as [session start, time of clock, lines]; the last one may
+        # continue in next block
+        self.records = []
+
+    # store header lines 'lines' copied to files of sessions
+    def add_header(self, lines):
+        self.header = list(lines)
+
+    def header_lines(self, lines):
+        return list(self.header)
+
+    # add block of complete nav records 'block' (text)
+    def add(self, block):
+
+        records = self.records
+
+        for line in block.splitlines(True):
+
+            # each record starts with satellite id and time of clock
+            if line[0] != ' ' or len(records) == 0:
+                toc = line[4:23]
+                start = self.starts.get(toc)
+                if start == None:
+                    start = session_start(toc, self.length)
+                    self.starts[toc] = start
+                records.append([start, toc, []])
+
+            records[-1][2].append(line)
+
+    # return paths of files of sessions sorted by time
+    def paths(self):
+        return self.writers.session_paths()
+
+    # write records sorted by time of clock to files of sessions of obs
+    # file starting at 'obs_starts' (datetime list; sessions of time of
+    # clock are used if it's empty or None) and close them; returns their
+    # paths
+    def close(self, obs_starts=None):
+
+        obs_starts = sorted(obs_starts or [])
+        sessions = collections.OrderedDict()
+
+        # time of clock is written by fixed width fields, so its text sorts
+        # as time
+        self.records.sort(key=lambda record: (record[0], record[1]))
+
+        for start, toc, lines in self.records:
+            if len(obs_starts) > 0:
+                start = nearest_start(obs_starts, start)
+            sessions.setdefault(start, []).extend(lines)
+
+        self.records = []
+
+        for start, lines in sessions.items():
+            self.writers.write(start, lines)
+
+        return self.writers.close()
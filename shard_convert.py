@@ -0,0 +1,662 @@
+"""
+  @file shard_convert.py
+  @brief Routines to convert one big RTCM file by time shards processed in parallel
+
+  @author Michal Zygmunt
+
+  @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
+
+  @license See LICENSE file for license details.
+
+  @todo none
+  @bug none
+"""
+
+import argparse
+import concurrent.futures
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import convbin_nav_fix
+import convbin_obs_fix
+import log_demux
+import rinex_writer
+import rtcm2rinex
+import rtcm3_decoder
+
+#%% Splitting of RTCM file
+#   File is cut into shards of similar size at RTCM 3 frame boundaries.
+#   Split point is placed before first MSM message of new epoch: previous
+#   MSM message has multiple message bit cleared (last message of epoch)
+#   and epoch time of the message is different from the last epoch time
+#   of its system. Each shard gets GLONASS ephemerides found shortly before
+#   split point, so frequency channels of GLONASS satellites are known.
+
+# number of bytes before split point scanned for GLONASS ephemerides
+prelude_size = 4 * 1024 * 1024
+
+# number of bytes after target offset scanned for split point; if no
+# epoch change is found, shard is merged with the next one
+split_search_size = 16 * 1024 * 1024
+
+
+# return offset of first frame of new epoch found in 'data' from offset
+# 'start' or None if there is no such frame before 'end'
+def find_epoch_start(data, start, end):
+
+    epoch_end = False
+    epochs = {}
+
+    for offset, payload in rtcm3_decoder.iter_frames(data, start=start, end=end):
+
+        msg = rtcm3_decoder.message_type(payload)
+        if msg // 10 not in rtcm3_decoder.msm_systems or len(payload) < 7:
+            continue
+
+        fields = rtcm3_decoder.BitFields(payload)
+        sys = rtcm3_decoder.msm_systems[msg // 10]
+        epoch = fields.u(24, 30)
+
+        if epoch_end and epochs.get(sys) != None and epochs[sys] != epoch:
+            return offset
+
+        epochs[sys] = epoch
+        epoch_end = fields.u(54, 1) == 0
+
+    return None
+
+
+# return list of (start, end) offsets of at most 'shards' parts of 'data'
+def find_shards(data, shards):
+
+    size = len(data)
+    points = [0]
+
+    for item in range(1, shards):
+
+        target = max(size * item // shards, points[-1])
+        point = find_epoch_start(data, target, min(target + split_search_size, size))
+
+        if point != None and point > points[-1]:
+            points.append(point)
+
+    points.append(size)
+
+    return [(points[item], points[item + 1]) for item in range(len(points) - 1)]
+
+
+# return GLONASS ephemeris frames found in 'data' just before offset 'start'
+def prelude_frames(data, start):
+
+    frames = []
+
+    if start == 0:
+        return frames
+
+    for offset, payload in rtcm3_decoder.iter_frames(data, start=max(start - prelude_size, 0),
+                                                    end=start):
+        if rtcm3_decoder.message_type(payload) == 1020:
+            frames.append(data[offset:offset + len(payload) + 6])
+
+    return frames
+
+
+# write shard of 'data' between 'start' and 'end' to file 'shard_path'
+def write_shard(data, start, end, shard_path):
+
+    with open(shard_path, 'wb') as shard_file:
+
+        for frame in prelude_frames(data, start):
+            shard_file.write(frame)
+
+        view = memoryview(data)
+        try:
+            for pos in range(start, end, convbin_obs_fix.block_size):
+                shard_file.write(view[pos:min(pos + convbin_obs_fix.block_size, end)])
+        finally:
+            view.release()
+
+
+#%% Conversion of shards
+
+# convert shard stored in 'job' dictionary into fixed RINEX files; runs
+# in worker process, all messages of 'convbin' and fixers are captured;
+# returns dictionary with paths of fixed files and statistics
+def convert_shard(job):
+
+    result = {"obs": "", "nav": "", "val_updated": 0, "duplicated_lines": 0,
+              "out_of_order_merges": 0, "error": ""}
+
+    shard_dir = os.path.dirname(job["shard"])
+
+    with tempfile.TemporaryFile(mode='w+', errors='replace') as log_file:
+
+        # redirect output of this process and 'convbin' to log file
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved_fds = os.dup(1), os.dup(2)
+        os.dup2(log_file.fileno(), 1)
+        os.dup2(log_file.fileno(), 2)
+
+        try:
+            if job["decoder"] == 'native':
+                in_ro_path, in_rn_path = rtcm2rinex.run_native_decoder(
+                    job["date"], job["shard"], shard_dir)
+            else:
+                in_ro_path, in_rn_path = rtcm2rinex.run_convbin(
+                    job["date"], job["shard"], shard_dir)
+
+            result["nav"] = os.path.join(shard_dir, "fix.nav")
+            result["val_updated"] = convbin_nav_fix.fix_nav_file(in_rn_path, result["nav"])
+
+            result["obs"] = os.path.join(shard_dir, "fix.obs")
+            result["duplicated_lines"], result["out_of_order_merges"] = \
+                convbin_obs_fix.fix_obs_file(in_ro_path, result["obs"], job["window"])
+
+            # raw files are not needed anymore
+            os.remove(in_ro_path)
+            os.remove(in_rn_path)
+            os.remove(job["shard"])
+
+        except (ValueError, RuntimeError, EnvironmentError) as e:
+            result["error"] = str(e)
+
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            os.close(saved_fds[0])
+            os.close(saved_fds[1])
+
+    return result
+
+
+#%% Stitching of RINEX files
+
+# return lines of header and offset of data in mapped RINEX file 'data'
+def read_header(data):
+
+    header_end = data.find(b"END OF HEADER")
+    if header_end == -1:
+        raise RuntimeError("RINEX header is incomplete!")
+
+    header_end = data.find(b"\n", header_end) + 1
+    if header_end == 0:
+        header_end = len(data)
+
+    header = data[:header_end].replace(b"\r\n", b"\n").splitlines(True)
+
+    return header, header_end
+
+
+# return label of RINEX header line
+def header_label(line):
+    return line[60:].strip().decode()
+
+
+# return observation types ({sys: [types]}) and order of systems listed in
+# obs header lines 'header'
+def header_obs_types(header):
+
+    types = {}
+    systems = []
+    sys = None
+
+    for line in header:
+        if header_label(line) == "SYS / # / OBS TYPES":
+            if line[:1] != b" ":
+                sys = line[:1].decode()
+                systems.append(sys)
+                types[sys] = []
+            types[sys] += line[7:60].decode().split()
+
+    return types, systems
+
+
+# return GLONASS frequency channels ({sat: channel}) listed in obs header
+def header_glonass_fcn(header):
+
+    fcn = {}
+
+    for line in header:
+        if header_label(line) == "GLONASS SLOT / FRQ #":
+            for item in range(4, 60 - 6, 7):
+                sat = line[item:item + 3].decode().strip()
+                if sat != "":
+                    fcn[sat] = int(line[item + 4:item + 6])
+
+    return fcn
+
+
+# return header of stitched obs file: header of first shard with observation
+# types, phase shifts and GLONASS channels of all shards, with time of last
+# observation of last shard and with name of original log 'log_name'
+def stitch_obs_header(headers, types, systems, log_name):
+
+    fcn = {}
+    phase_shifts = []
+    time_last = None
+
+    for header in headers:
+        fcn.update(header_glonass_fcn(header))
+        for line in header:
+            label = header_label(line)
+            if label == "SYS / PHASE SHIFT" and line not in phase_shifts:
+                phase_shifts.append(line)
+            elif label == "TIME OF LAST OBS":
+                time_last = line
+
+    lines = []
+
+    for line in headers[0]:
+
+        label = header_label(line)
+
+        if label == "SYS / # / OBS TYPES":
+            if len(lines) == 0 or header_label(lines[-1]) != label:
+                lines += [item.encode() for item in rinex_writer.obs_types_lines(types, systems)]
+
+        elif label == "SYS / PHASE SHIFT":
+            if len(lines) == 0 or header_label(lines[-1]) != label:
+                lines += phase_shifts
+
+        elif label == "GLONASS SLOT / FRQ #":
+            if len(lines) == 0 or header_label(lines[-1]) != label:
+                lines += [item.encode() for item in rinex_writer.glonass_slot_lines(fcn)]
+
+        elif label == "TIME OF LAST OBS" and time_last != None:
+            lines.append(time_last)
+
+        elif label == "COMMENT" and line[:5] == b"log: ":
+            lines.append(rinex_writer.header_line("log: " + log_name, label).encode())
+
+        else:
+            lines.append(line)
+
+    return lines
+
+
+# return indexes of values in rows of shard with observation types
+# 'shard_types' for each of 'types' ({sys: [indexes or None]}); None if
+# rows of the shard have the same layout
+def types_mapping(shard_types, types):
+
+    if all([types[sys] == shard_types[sys] for sys in shard_types]):
+        return None
+
+    mapping = {}
+    for sys, sys_types in types.items():
+        old_types = shard_types.get(sys, [])
+        mapping[sys.encode()] = [old_types.index(obs_type) if obs_type in old_types else None
+                                 for obs_type in sys_types]
+
+    return mapping
+
+
+# return observation rows in 'block' with values moved as in 'mapping'
+def remap_rows(block, mapping):
+
+    lines = []
+
+    for line in block.splitlines(True):
+
+        if line[:1] == b">" or line[:1] not in mapping:
+            lines.append(line)
+            continue
+
+        row = line.rstrip(b"\r\n")
+        values = [row[3 + 16 * item:19 + 16 * item].ljust(16) if item != None else b" " * 16
+                  for item in mapping[line[:1]]]
+        lines.append(row[:3] + b"".join(values) + b"\n")
+
+    return b"".join(lines)
+
+
+# split epoch block 'block' into epoch row and observation rows
+def split_epoch(block):
+    lines = block.replace(b"\r\n", b"\n").splitlines(True)
+    return lines[0], lines[1:]
+
+
+# write epoch 'epoch' given as (epoch row, observation rows) with fixed
+# satellite counter to 'out_file'
+def write_epoch(epoch, out_file):
+    out_file.write(convbin_obs_fix.epoch_row(epoch[0], len(epoch[1])))
+    out_file.write(b"".join(epoch[1]))
+
+
+# merge epoch block 'block' into epoch 'held_epoch' (see write_epoch) if
+# date and time of both are equal; otherwise 'held_epoch' is written to
+# 'out_file' and replaced; returns current epoch and number of duplicated
+# lines
+def merge_epoch(held_epoch, block, out_file):
+
+    epoch, rows = split_epoch(block)
+
+    if held_epoch == None:
+        return (epoch, rows), 0
+
+    # 2:29 means 'yyyy mm dd hh mm ss.sssssss' of epoch date/time id
+    if held_epoch[0][2:29] != epoch[2:29]:
+        write_epoch(held_epoch, out_file)
+        return (epoch, rows), 0
+
+    rows_set = set(held_epoch[1])
+    new_rows = [row for row in rows if row not in rows_set]
+    held_epoch[1].extend(new_rows)
+
+    return held_epoch, len(rows) - len(new_rows) + 1
+
+
+# stitch fixed obs files 'paths' of consecutive shards into 'out_file';
+# epoch at the end of each shard is merged with equal epoch at the start of
+# the next shard; 'log_name' is name of original log written to header;
+# returns number of duplicated lines removed at seams
+def stitch_obs(paths, out_file, log_name):
+
+    files = [open(path, 'rb') for path in paths]
+    maps = []
+
+    try:
+        for in_file in files:
+            if os.fstat(in_file.fileno()).st_size == 0:
+                maps.append(b"")
+            else:
+                maps.append(mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+        headers = [read_header(data) for data in maps]
+
+        # union of observation types, in order of first appearance
+        types = {}
+        systems = []
+        for header, header_end in headers:
+            shard_types, shard_systems = header_obs_types(header)
+            for sys in shard_systems:
+                if sys not in types:
+                    types[sys] = []
+                    systems.append(sys)
+                types[sys] += [obs_type for obs_type in shard_types[sys]
+                               if obs_type not in types[sys]]
+
+        out_file.write(b"".join(stitch_obs_header([header for header, header_end in headers],
+                                                  types, systems, log_name)))
+
+        # last epoch of previous shard, kept until first epoch of next
+        # shard is known
+        held_epoch = None
+        duplicated_lines = 0
+
+        for data, (header, header_end) in zip(maps, headers):
+
+            start = header_end
+            if start >= len(data):
+                continue
+
+            first_end = data.find(b"\n>", start) + 1
+            last_start = data.rfind(b"\n>", start) + 1
+
+            # shard with one epoch: first and last epoch are the same
+            if first_end == 0 or last_start == 0:
+                blocks = [b"", b"", data[start:]]
+            else:
+                blocks = [data[start:first_end], data[first_end:last_start], data[last_start:]]
+
+            mapping = types_mapping(header_obs_types(header)[0], types)
+            if mapping != None:
+                blocks = [remap_rows(block, mapping) for block in blocks]
+
+            first_epoch, middle, last_epoch = blocks
+
+            if first_epoch != b"":
+                held_epoch, duplicates = merge_epoch(held_epoch, first_epoch, out_file)
+                duplicated_lines += duplicates
+
+                write_epoch(held_epoch, out_file)
+                held_epoch = None
+
+                out_file.write(middle)
+
+            held_epoch, duplicates = merge_epoch(held_epoch, last_epoch, out_file)
+            duplicated_lines += duplicates
+
+        # last epoch of file is written as by obs fixer, with original
+        # epoch row
+        if held_epoch != None:
+            out_file.write(held_epoch[0])
+            out_file.write(b"".join(held_epoch[1]))
+
+    finally:
+        for data in maps:
+            if isinstance(data, mmap.mmap):
+                data.close()
+        for in_file in files:
+            in_file.close()
+
+    return duplicated_lines
+
+
+# stitch fixed nav files 'paths' of consecutive shards into 'out_file';
+# header of first shard is kept and records repeated in next shards are
+# removed; records are compared by first line (satellite, time of clock and
+# clock parameters), as transmission time differs between shards;
+# returns number of removed records
+def stitch_nav(paths, out_file, log_name):
+
+    records_set = set()
+    duplicated_records = 0
+
+    for index, path in enumerate(paths):
+
+        with open(path, 'rb') as in_file:
+            data = in_file.read().replace(b"\r\n", b"\n")
+
+        header, header_end = read_header(data)
+        if index == 0:
+            for line in header:
+                if header_label(line) == "COMMENT" and line[:5] == b"log: ":
+                    line = rinex_writer.header_line("log: " + log_name, "COMMENT").encode()
+                out_file.write(line)
+
+        records = []
+        record = []
+
+        for line in data[header_end:].splitlines(True):
+            if line[:1] != b" " and len(record) > 0:
+                records.append(b"".join(record))
+                record = []
+            record.append(line)
+
+        if len(record) > 0:
+            records.append(b"".join(record))
+
+        for record in records:
+            key = record[:record.find(b"\n")]
+            if key in records_set:
+                duplicated_records += 1
+                continue
+            records_set.add(key)
+            out_file.write(record)
+
+    return duplicated_records
+
+
+#%% Conversion pipeline
+
+# convert RTCM binary <in_file_path_name> like rtcm2rinex.convert, but file
+# is split into (at most) 'shards' time shards converted and fixed by
+# 'workers' processes; results are stitched into single obs and nav file;
+# returns paths of obs and nav files
+def convert_sharded(date, in_file_path_name, out_dir_path=None, shards=None, workers=None,
+                    window=0, decoder='convbin', demux=False):
+
+    #%% Sanity check for input parameters
+
+    if rtcm2rinex.is_valid_date(date) == False:
+        raise ValueError("Input date is invalid!")
+
+    if decoder not in ('convbin', 'native'):
+        raise ValueError("Unknown decoder: " + decoder)
+
+    in_file_name = rtcm2rinex.check_input_file(in_file_path_name)
+    log_name = os.path.basename(in_file_path_name)
+
+    if workers == None:
+        workers = os.cpu_count()
+    if shards == None:
+        shards = workers
+
+    if out_dir_path == None:
+        out_dir_path = os.path.dirname(in_file_path_name)
+
+    out_dir_path = os.path.normpath(out_dir_path)
+
+    if os.path.exists(out_dir_path) == False:
+        os.makedirs(out_dir_path)
+
+    out_ro_path = os.path.join(out_dir_path, in_file_name + '.obs')
+    out_rn_path = os.path.join(out_dir_path, in_file_name + '.nav')
+
+    scratch_dir = tempfile.mkdtemp(prefix='.rtcm2rinex_', dir=out_dir_path)
+
+    try:
+        #%% Split RTCM file into shards
+
+        start = time.time()
+
+        print("[1/4]: Splitting RTCM file into time shards...")
+
+        if demux == True:
+            rtcm_path = os.path.join(scratch_dir, in_file_name + '.rtcm3')
+            stats = log_demux.demux_file(in_file_path_name, rtcm_path)
+            log_demux.print_stats(stats)
+            in_file_path_name = rtcm_path
+
+        jobs = []
+
+        with open(in_file_path_name, 'rb') as in_file:
+
+            if os.fstat(in_file.fileno()).st_size == 0:
+                raise RuntimeError("Input file doesn't contain RTCM messages!")
+
+            data = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+            try:
+                for index, (shard_start, shard_end) in enumerate(find_shards(data, shards)):
+
+                    shard_dir = os.path.join(scratch_dir, "shard_%03d" % index)
+                    os.makedirs(shard_dir)
+                    shard_path = os.path.join(shard_dir, in_file_name + '.rtcm3')
+
+                    write_shard(data, shard_start, shard_end, shard_path)
+
+                    jobs.append({"date": date, "shard": shard_path, "window": window,
+                                 "decoder": decoder})
+            finally:
+                data.close()
+
+        print("Number of shards: " + str(len(jobs)))
+
+        stop = time.time()
+        delta = stop - start
+        print("Processing time: %.2f s\n" % delta)
+
+        #%% Convert and fix shards in parallel
+
+        start = time.time()
+
+        print("[2/4]: Converting and fixing shards by %d workers..." % min(workers, len(jobs)))
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+            results = list(pool.map(convert_shard, jobs))
+
+        for index, result in enumerate(results):
+            if result["error"] != "":
+                raise RuntimeError("Shard %d: %s" % (index, result["error"]))
+
+        print("Number of updated values: " +
+              str(sum([result["val_updated"] for result in results])))
+        print("Number of duplicated lines removed: " +
+              str(sum([result["duplicated_lines"] for result in results])))
+
+        if window > 0:
+            print("Number of out of order merges: " +
+                  str(sum([result["out_of_order_merges"] for result in results])))
+
+        stop = time.time()
+        delta = stop - start
+        print("Processing time: %.2f s\n" % delta)
+
+        #%% Stitch shards
+
+        start = time.time()
+
+        print("[3/4]: Stitching RINEX files of shards...")
+
+        with open(out_ro_path, 'wb') as out_file:
+            duplicated_lines = stitch_obs([result["obs"] for result in results], out_file,
+                                          log_name)
+
+        with open(out_rn_path, 'wb') as out_file:
+            duplicated_records = stitch_nav([result["nav"] for result in results], out_file,
+                                            log_name)
+
+        print("Number of duplicated lines removed at seams: " + str(duplicated_lines))
+        print("Number of duplicated nav records removed: " + str(duplicated_records))
+
+        stop = time.time()
+        delta = stop - start
+        print("Processing time: %.2f s\n" % delta)
+
+    finally:
+        #%% Process temporary output files
+
+        print("[4/4] Finishing files operations...")
+
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    return out_ro_path, out_rn_path
+
+
+if __name__ == "__main__":
+
+    #%% Read input arguments
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("date", type=str,
+                        help="calendar date of beginning of RTCM messages as <YYYY/MM/DD>.")
+    parser.add_argument("input_file", type=str,
+                        help="RTCM binary <input_file> to process. " \
+                            "File path can be aboslute or relative.")
+    parser.add_argument("-d", "--dest", type=str,
+                        help="destination <directory> to save RINEX files. " \
+                            "Directory path can be absolute or relative.")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of worker processes. Number of CPUs is used by default.")
+    parser.add_argument("-n", "--shards", type=int,
+                        help="number of time shards. Number of workers is used by default.")
+    parser.add_argument("-w", "--window", type=int, default=0,
+                        help="number of recent epochs kept in memory to merge " \
+                            "duplicated obs epochs which are not consecutive.")
+    parser.add_argument("--decoder", type=str, choices=['convbin', 'native'], default='convbin',
+                        help="RTCM decoder used to create RINEX files.")
+    parser.add_argument("--demux", action='store_true',
+                        help="extract valid RTCM frames from capture log before conversion.")
+    args = parser.parse_args()
+
+    if args.jobs < 1 or (args.shards != None and args.shards < 1):
+        print("Number of jobs and shards must be positive!")
+        print("Exiting!")
+        sys.exit(1)
+
+    try:
+        convert_sharded(args.date, args.input_file, args.dest, args.shards, args.jobs,
+                        args.window, args.decoder, args.demux)
+    except (ValueError, RuntimeError, EnvironmentError) as e:
+        print(e)
+        print("Exiting!")
+        sys.exit(1)
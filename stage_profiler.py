@@ -0,0 +1,191 @@
+"""
+  @file stage_profiler.py
+  @brief Routines to profile conversion stages and to sample throughput of fixer loops
+
+  @author Michal Zygmunt
+
+  @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
+
+  @license See LICENSE file for license details.
+
+  @todo none
+  @bug none
+"""
+
+import cProfile
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+#%% Profiling of stages
+#   Profiled stage runs under cProfile and tracemalloc. Profile is saved as
+#   '<prefix>_<stage>.prof' (to be read by pstats, snakeviz, ...) and the
+#   biggest allocations alive at the end of stage with peak of traced memory
+#   as '<prefix>_<stage>_alloc.txt'. Both tools slow stage down a lot, so
+#   they are used only on demand.
+
+# number of allocation sites written to reports
+top_allocations = 20
+
+# number of frames of allocation traceback stored by tracemalloc
+traceback_frames = 1
+
+
+# profiler of stages writing reports to 'out_dir' with names starting with
+# 'prefix'; stages are not profiled if 'enabled' is False
+class StageProfiler(object):
+
+    def __init__(self, out_dir, prefix, enabled=True, top=top_allocations):
+
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.enabled = enabled
+        self.top = top
+
+    # return context manager profiling stage 'name'
+    def stage(self, name):
+        return ProfiledStage(self, name)
+
+    # return path of report of stage 'name' with 'suffix'
+    def report_path(self, name, suffix):
+        return os.path.join(self.out_dir, "%s_%s%s" % (self.prefix, name, suffix))
+
+
+# stage profiled by StageProfiler
+class ProfiledStage(object):
+
+    def __init__(self, profiler, name):
+
+        self.profiler = profiler
+        self.name = name
+        self.profile = None
+
+    def __enter__(self):
+
+        if self.profiler.enabled == False:
+            return self
+
+        # allocations are traced only if tracing isn't done by caller
+        self.tracing = tracemalloc.is_tracing() == False
+        if self.tracing == True:
+            tracemalloc.start(traceback_frames)
+        tracemalloc.reset_peak()
+
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if self.profile == None:
+            return
+
+        self.profile.disable()
+
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+
+        if self.tracing == True:
+            tracemalloc.stop()
+
+        profiler = self.profiler
+        prof_path = profiler.report_path(self.name, ".prof")
+        alloc_path = profiler.report_path(self.name, "_alloc.txt")
+
+        self.profile.dump_stats(prof_path)
+
+        with open(alloc_path, 'w') as out_file:
+            write_allocations(out_file, snapshot, current, peak, profiler.top)
+
+            # the most expensive functions are listed under allocations
+            out_file.write("\nTop %d functions by cumulative time:\n" % profiler.top)
+            stats = pstats.Stats(self.profile, stream=out_file)
+            stats.sort_stats("cumulative").print_stats(profiler.top)
+
+        print("Profile of stage '%s' saved as: %s" % (self.name, prof_path))
+
+
+# write report of allocations from tracemalloc 'snapshot' with 'current' and
+# 'peak' size of traced memory to text file 'out_file'
+def write_allocations(out_file, snapshot, current, peak, top):
+
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ])
+
+    statistics = snapshot.statistics('lineno')
+
+    out_file.write("Traced memory: %.1f kB (peak %.1f kB)\n" % (current / 1024.0, peak / 1024.0))
+    out_file.write("Top %d allocation sites alive at end of stage:\n" % top)
+
+    for item, stat in enumerate(statistics[:top]):
+        frame = stat.traceback[0]
+        out_file.write("%3d. %s:%d: %.1f kB in %d blocks\n" % (
+            item + 1, frame.filename, frame.lineno, stat.size / 1024.0, stat.count))
+
+
+#%% Sampling of loops
+#   Hot loops of fixers add number of processed lines to LineMeter once per
+#   block of lines, so its cost doesn't depend on number of lines. Thread of
+#   meter prints rate of lines at fixed interval.
+
+# meter of lines processed by stage 'name', which prints rate of lines
+# every 'interval' seconds while it's active (used as context manager);
+# nothing is printed if 'interval' is None or 0
+class LineMeter(object):
+
+    def __init__(self, name, interval=1.0):
+
+        self.name = name
+        self.interval = interval
+        self.active = interval != None and interval > 0
+        self.lines = 0
+
+        self.thread = None
+        self.stopped = threading.Event()
+
+    # add 'count' processed lines
+    def add(self, count):
+        self.lines += count
+
+    def __enter__(self):
+
+        if self.active == False:
+            return self
+
+        self.start = time.time()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if self.active == False:
+            return
+
+        self.stopped.set()
+        self.thread.join()
+
+        delta = max(time.time() - self.start, 1e-9)
+        print("%s: %d lines in %.2f s (%.0f lines/s)" % (self.name, self.lines, delta,
+                                                         self.lines / delta))
+
+    # print rate of lines until meter is stopped
+    def run(self):
+
+        last_time = self.start
+        last_lines = 0
+
+        while self.stopped.wait(self.interval) == False:
+            now = time.time()
+            lines = self.lines
+            print("%s: %.0f lines/s (%d lines)" % (self.name, (lines - last_lines) /
+                                                   max(now - last_time, 1e-9), lines))
+            last_time = now
+            last_lines = lines
+
@@ -0,0 +1,240 @@
+"""
+  @file stage_scheduler.py
+  @brief Routines to run conversion stages concurrently and stream 'convbin' output to fixers
+
+  @author Michal Zygmunt
+
+  @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
+
+  @license See LICENSE file for license details.
+
+  @todo none
+  @bug none
+"""
+
+import concurrent.futures
+import io
+import os
+
+#%% Concurrent stages
+#   Nav and obs fixers read and write different files, so they run in two
+#   threads. Fixers spend much of their time in I/O and in bytes/regex
+#   operations on big blocks, so they overlap even though both are Python
+#   code. Metrics of stages running concurrently measure wall time of each
+#   of them, but CPU time of the whole process.
+
+
+# run 'tasks' given as list of (function, args) concurrently in threads;
+# returns list of their results; error of any task is raised after all
+# tasks end
+def run_concurrent(tasks):
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(tasks)) as pool:
+        futures = [pool.submit(function, *args) for function, args in tasks]
+        concurrent.futures.wait(futures)
+
+    return [future.result() for future in futures]
+
+
+#%% Streaming of 'convbin' output
+#   On systems with named pipes, 'convbin' writes RINEX files into FIFOs
+#   read by fixers while conversion runs. 'convbin' writes header first,
+#   without times of the first and last epoch, and rewrites it when it
+#   closes its files; as pipe can't be rewound, the final header is
+#   appended after the last record. RinexStream passes header and records
+#   to fixer and keeps the final header, which replaces header of fixed
+#   file by patch_header. Both ends of each FIFO are opened by this process
+#   before 'convbin' starts, so neither side blocks in open(), and the
+#   write end is kept open until 'convbin' ends, so fixer doesn't see end
+#   of data when 'convbin' reopens its files.
+
+# size of data read from pipe at once
+pipe_read_size = 1024 * 1024
+
+version_label = b"RINEX VERSION / TYPE"
+header_end_label = b"END OF HEADER"
+
+
+# return True if RINEX output can be streamed through named pipes
+def fifo_supported():
+    return hasattr(os, 'mkfifo')
+
+
+# named pipe 'path' created with both ends open; 'convbin' opens it for
+# writing by its name and fixer reads it by stream()
+class Fifo(object):
+
+    def __init__(self, path):
+
+        self.path = path
+        os.mkfifo(path)
+
+        # read end must be opened first, as open() of write end without
+        # reader fails in non-blocking mode
+        self.read_fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        self.write_fd = os.open(path, os.O_WRONLY)
+        os.set_blocking(self.read_fd, True)
+
+    # return RinexStream reading the pipe; stream owns read end of pipe
+    def stream(self):
+
+        read_fd = self.read_fd
+        self.read_fd = None
+
+        return RinexStream(read_fd)
+
+    # close write end kept by this process; reader gets end of data when
+    # writer ends too
+    def close_writer(self):
+
+        if self.write_fd != None:
+            os.close(self.write_fd)
+            self.write_fd = None
+
+    # close both ends of pipe and remove it
+    def close(self):
+
+        self.close_writer()
+
+        if self.read_fd != None:
+            os.close(self.read_fd)
+            self.read_fd = None
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# raw binary stream of RINEX file written by 'convbin' into pipe 'read_fd';
+# header and records are returned by read, header appended after the last
+# record is stored in 'trailer'; file descriptor is closed with stream, so
+# 'convbin' fails instead of blocking if fixer ends before reading all data
+class RinexStream(io.RawIOBase):
+
+    def __init__(self, read_fd):
+
+        self.read_fd = read_fd
+
+        self.pending = bytearray()
+        self.rest = b''
+        self.in_header = True
+        self.trailer = None
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+
+        while len(self.pending) == 0 and self.eof == False:
+            self.fill()
+
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        del self.pending[:size]
+
+        return size
+
+    # read next data from pipe and split it into data returned by read and
+    # trailer
+    def fill(self):
+
+        data = os.read(self.read_fd, pipe_read_size)
+
+        if data == b'':
+            self.eof = True
+            self.add(self.rest)
+            self.rest = b''
+            return
+
+        # labels are searched only in complete lines
+        data = self.rest + data
+        cut = data.rfind(b'\n') + 1
+        self.rest = data[cut:]
+        self.add(data[:cut])
+
+    # add complete lines 'data' to returned data or trailer
+    def add(self, data):
+
+        if self.trailer != None:
+            self.trailer += data
+            return
+
+        if self.in_header == True:
+            pos = data.find(header_end_label)
+            if pos < 0:
+                self.pending += data
+                return
+            self.in_header = False
+            cut = data.find(b'\n', pos) + 1
+            self.pending += data[:cut]
+            data = data[cut:]
+
+        # the first header line starts header appended at the end
+        pos = data.find(version_label)
+        if pos < 0:
+            self.pending += data
+            return
+
+        cut = data.rfind(b'\n', 0, pos) + 1
+        self.pending += data[:cut]
+        self.trailer = data[cut:]
+
+    def close(self):
+
+        if self.read_fd != None:
+            os.close(self.read_fd)
+            self.read_fd = None
+
+        super(RinexStream, self).close()
+
+
+# replace header of RINEX file 'path' by 'header' (bytes) appended by
+# 'convbin' after its records; returns True if size of header changed, so
+# offsets of records (e.g. in epoch index) are no longer valid
+def patch_header(path, header):
+
+    if header == None or header_end_label not in header:
+        return False
+
+    with open(path, 'r+b') as rinex_file:
+
+        header_size = 0
+        for line in rinex_file:
+            header_size += len(line)
+            if header_end_label in line:
+                break
+
+        # headers of the same size are overwritten in place
+        if header_size == len(header):
+            rinex_file.seek(0)
+            rinex_file.write(header)
+            return False
+
+    temp_path = path + ".tmp"
+
+    with open(path, 'rb') as in_file:
+        with open(temp_path, 'wb') as out_file:
+            in_file.seek(header_size)
+            out_file.write(header)
+            while True:
+                block = in_file.read(pipe_read_size)
+                if block == b'':
+                    break
+                out_file.write(block)
+
+    os.replace(temp_path, path)
+
+    return True
+
+
+#%% Atomic replace of output files
+
+# move files given as list of (temporary path, final path) pairs, which are
+# in the same file system, to their final paths; each file is replaced
+# atomically, so readers never see partially written files; pairs with
+# missing temporary file are skipped
+def replace_files(pairs):
+
+    for temp_path, path in pairs:
+        if temp_path != None and os.path.exists(temp_path):
+            os.replace(temp_path, path)
@@ -0,0 +1,96 @@
+"""
+  @file test_conversion_cache.py
+  @brief Tests of conversion cache used by rtcm2rinex
+
+  @author Michal Zygmunt
+
+  @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
+
+  @license See LICENSE file for license details.
+
+  @todo none
+  @bug none
+"""
+
+import os.path
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import conversion_cache
+import obs_store
+import rtcm2rinex
+import run_metrics
+
+log_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        "DATACOM10.log")
+
+log_date = "2021/11/25"
+
+
+# convert test log into 'out_dir' with cache 'cache_dir'; returns metrics report
+def convert(out_dir, cache_dir, **options):
+
+    metrics = run_metrics.RunMetrics(log_path)
+    rtcm2rinex.convert(log_date, log_path, out_dir_path=str(out_dir), decoder='native',
+                       cache_dir=str(cache_dir), metrics=metrics, **options)
+
+    return metrics.report
+
+
+#%% Cache with observation store
+
+# compressed obs file can't be used to build store, so cache isn't looked
+# up, but converted files are still stored in cache
+@pytest.mark.skipif(obs_store.numpy == None, reason="requires numpy")
+def test_cache_with_store_and_compression(tmp_path):
+
+    cache_dir = tmp_path / "cache"
+
+    for run in range(2):
+        out_dir = tmp_path / ("out%d" % run)
+        out_dir.mkdir()
+
+        report = convert(out_dir, cache_dir, store='npz', compress='gz')
+
+        assert report["cache"] == None
+        assert sorted(os.listdir(str(out_dir))) == \
+            ["DATACOM10.nav.gz", "DATACOM10.npz", "DATACOM10.obs.gz"]
+
+    assert len(conversion_cache.list_entries(str(cache_dir))) == 1
+
+
+# uncompressed obs file of cache is used to build store
+@pytest.mark.skipif(obs_store.numpy == None, reason="requires numpy")
+def test_cache_hit_with_store(tmp_path):
+
+    cache_dir = tmp_path / "cache"
+    reports = []
+
+    for run in range(2):
+        out_dir = tmp_path / ("out%d" % run)
+        out_dir.mkdir()
+        reports.append(convert(out_dir, cache_dir, store='npz'))
+        assert os.path.isfile(str(out_dir / "DATACOM10.npz"))
+
+    assert [report["cache"] for report in reports] == ["miss", "hit"]
+
+
+#%% Fetch
+
+# entry without nav file (e.g. evicted during copy) leaves no obs file
+def test_fetch_of_partial_entry(tmp_path):
+
+    cache_dir = str(tmp_path / "cache")
+    key = "0" * 64
+    os.makedirs(conversion_cache.entry_path(cache_dir, key))
+
+    with open(os.path.join(conversion_cache.entry_path(cache_dir, key), "obs"), 'w') as obs_file:
+        obs_file.write("obs\n")
+
+    obs_path, nav_path = str(tmp_path / "log.obs"), str(tmp_path / "log.nav")
+
+    assert conversion_cache.fetch(cache_dir, key, obs_path, nav_path, "log") == False
+    assert os.listdir(str(tmp_path)) == ["cache"]
@@ -0,0 +1,630 @@
+"""
+  @file watch_convert.py
+  @brief Daemon converting RTCM logs dropped into watched directory by pool of worker processes
+
+  @author Michal Zygmunt
+
+  @copyright Copyright (c) 2021 ChipCraft Sp. z o.o. All rights reserved.
+
+  @license See LICENSE file for license details.
+
+  @todo none
+  @bug none
+"""
+
+import argparse
+import concurrent.futures
+import concurrent.futures.process
+import datetime
+import fnmatch
+import os
+import signal
+import sqlite3
+import sys
+import time
+
+import batch_convert
+import session_split
+
+# watchdog gives events of file system (inotify, FSEvents, ...); directory
+# is polled without it
+try:
+    import watchdog.events
+    import watchdog.observers
+except ImportError:
+    watchdog = None
+
+#%% Job queue
+#   Each input file is one row of SQLite database kept in destination
+#   directory, with size and modification time of converted content, so
+#   restarted daemon knows converted files without opening them and
+#   converts again only files which were changed. Failed jobs are retried
+#   after delay doubled by each attempt; jobs running when daemon was
+#   stopped are queued again. File changed while its job is running is
+#   queued again after the job ends.
+
+queue_file = "watch_queue.db"
+
+job_states = ('queued', 'running', 'done', 'skipped', 'failed')
+
+
+# persistent queue of conversion jobs stored in SQLite file 'path'
+class JobQueue(object):
+
+    def __init__(self, path):
+
+        self.db = sqlite3.connect(path)
+
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS jobs (path TEXT PRIMARY KEY, "
+                            "size INTEGER, mtime INTEGER, state TEXT, attempts INTEGER, "
+                            "next_try REAL, updated REAL, error TEXT, obs TEXT, nav TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, next_try)")
+
+            # jobs interrupted by end of previous run are run again
+            self.db.execute("UPDATE jobs SET state = 'queued' WHERE state = 'running'")
+
+    # return dictionary of files of all jobs: path -> (size, mtime)
+    def known(self):
+        return dict((path, (size, mtime)) for path, size, mtime in
+                    self.db.execute("SELECT path, size, mtime FROM jobs"))
+
+    # queue conversion of file 'path' with 'size' and 'mtime' [ns]; job of
+    # previous content of file is replaced
+    def add(self, path, size, mtime, now):
+
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, 'queued', 0, ?, ?, "
+                            "'', '', '')", (path, size, mtime, now, now))
+
+    # remove job of file 'path'
+    def remove(self, path):
+
+        with self.db:
+            self.db.execute("DELETE FROM jobs WHERE path = ?", (path,))
+
+    # return paths of at most 'count' queued jobs which may run at 'now'
+    def next_jobs(self, count, now):
+
+        if count <= 0:
+            return []
+
+        return [path for path, in self.db.execute(
+            "SELECT path FROM jobs WHERE state = 'queued' AND next_try <= ? "
+            "ORDER BY next_try LIMIT ?", (now, count))]
+
+    # mark job of file 'path' as running
+    def start(self, path, now):
+
+        with self.db:
+            self.db.execute("UPDATE jobs SET state = 'running', updated = ? WHERE path = ?",
+                            (now, path))
+
+    # store 'result' of job of file 'path' (see batch_convert.run_job); failed
+    # job is queued again after 'retry_delay' seconds doubled by each attempt
+    # until it fails 'retries' times more; returns new state of job (None if
+    # job was replaced by job of new content of file)
+    def finish(self, path, result, now, retries, retry_delay):
+
+        row = self.db.execute("SELECT attempts FROM jobs WHERE path = ? AND state = 'running'",
+                              (path,)).fetchone()
+        if row == None:
+            return None
+
+        attempts = row[0] + 1
+        next_try = now
+
+        # files of sessions are stored as one text
+        paths = [";".join(value) if isinstance(value, list) else value
+                 for value in (result["obs"], result["nav"])]
+
+        if result["status"] == "OK":
+            state = 'done'
+        elif result["status"] == "SKIPPED":
+            state = 'skipped'
+        elif attempts <= retries:
+            state = 'queued'
+            next_try = now + retry_delay * 2 ** (attempts - 1)
+        else:
+            state = 'failed'
+
+        with self.db:
+            self.db.execute("UPDATE jobs SET state = ?, attempts = ?, next_try = ?, updated = ?, "
+                            "error = ?, obs = ?, nav = ? WHERE path = ?",
+                            (state, attempts, next_try, now, result["error"], paths[0], paths[1],
+                             path))
+
+        return state
+
+    # return number of jobs in each state as dictionary
+    def counts(self):
+
+        counts = dict((state, 0) for state in job_states)
+        counts.update(self.db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"))
+
+        return counts
+
+    def close(self):
+        self.db.close()
+
+
+#%% Watching of directory
+#   Files of watched directory (not of its subdirectories) matching name
+#   pattern are reported with their size and modification time. Directory
+#   is scanned once at start; then only files given by events of watchdog
+#   are checked, or the whole directory is polled if watchdog isn't
+#   available. File is converted when its size and modification time
+#   haven't changed for 'settle' seconds, as loggers may still write it.
+
+
+# return True if file 'name' of watched directory is input file
+def is_input_name(name, pattern):
+    return name[0] != '.' and fnmatch.fnmatch(name, pattern)
+
+
+# return (path, size, mtime [ns]) of input file 'path' or None if it isn't
+# regular file
+def file_state(path):
+
+    try:
+        stat = os.stat(path)
+    except EnvironmentError:
+        return None
+
+    if os.path.isfile(path) == False:
+        return None
+
+    return (path, stat.st_size, stat.st_mtime_ns)
+
+
+# return list of (path, size, mtime [ns]) of input files of 'watch_dir'
+# matching 'pattern'
+def scan_dir(watch_dir, pattern):
+
+    files = []
+
+    for entry in os.scandir(watch_dir):
+        if is_input_name(entry.name, pattern) == False or entry.is_file() == False:
+            continue
+        try:
+            stat = entry.stat()
+        except EnvironmentError:
+            continue
+        files.append((entry.path, stat.st_size, stat.st_mtime_ns))
+
+    return files
+
+
+# watcher polling the whole directory
+class PollWatcher(object):
+
+    def __init__(self, watch_dir, pattern):
+
+        self.watch_dir = watch_dir
+        self.pattern = pattern
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    # return list of (path, size, mtime) of files which may have changed
+    def changes(self):
+        return scan_dir(self.watch_dir, self.pattern)
+
+
+# watcher checking only files given by file system events
+class EventWatcher(object):
+
+    def __init__(self, watch_dir, pattern):
+
+        self.watch_dir = watch_dir
+        self.pattern = pattern
+        self.paths = set()
+
+        # handler is called by thread of observer
+        watcher = self
+
+        class Handler(watchdog.events.FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.is_directory == False:
+                    watcher.paths.add(getattr(event, 'dest_path', None) or event.src_path)
+
+        self.observer = watchdog.observers.Observer()
+        self.observer.schedule(Handler(), watch_dir, recursive=False)
+
+    def start(self):
+        self.observer.start()
+
+    def stop(self):
+        self.observer.stop()
+        self.observer.join()
+
+    # return list of (path, size, mtime) of files given by events since
+    # previous call
+    def changes(self):
+
+        paths = []
+        while len(self.paths) > 0:
+            paths.append(self.paths.pop())
+
+        files = []
+        for path in paths:
+            if os.path.dirname(path) != self.watch_dir or \
+               is_input_name(os.path.basename(path), self.pattern) == False:
+                continue
+            state = file_state(path)
+            if state != None:
+                files.append(state)
+
+        return files
+
+
+# tracker of files which are written; file is ready when its size and
+# modification time haven't changed for 'settle' seconds
+class StabilityTracker(object):
+
+    def __init__(self, settle):
+
+        self.settle = settle
+
+        # path -> (size, mtime, time since which file is unchanged)
+        self.candidates = {}
+
+    # add file 'path' with 'size' and 'mtime' [ns] seen at 'now'
+    def add(self, path, size, mtime, now):
+
+        candidate = self.candidates.get(path)
+
+        if candidate == None or candidate[:2] != (size, mtime):
+            # file which wasn't modified recently is unchanged since then
+            self.candidates[path] = (size, mtime, min(now, mtime / 1e9))
+
+    # return list of (path, size, mtime) of files which are ready at 'now';
+    # files are checked again, as events don't come when writing stops
+    def ready(self, now):
+
+        files = []
+
+        for path, (size, mtime, since) in list(self.candidates.items()):
+
+            state = file_state(path)
+
+            if state == None:
+                del self.candidates[path]
+            elif state[1:] != (size, mtime):
+                self.candidates[path] = (state[1], state[2], now)
+            elif now - since >= self.settle:
+                del self.candidates[path]
+                files.append(state)
+
+        return files
+
+
+#%% Daemon
+#   Ready files are added to job queue and jobs are run by pool of worker
+#   processes by batch_convert.run_job, so each worker imports conversion
+#   pipeline once and runs it in its own process. Only as many jobs as
+#   there are workers are given to pool, the rest waits in job queue.
+#   SIGINT and SIGTERM stop watching; running jobs are finished before
+#   daemon ends.
+
+
+# ignore SIGINT in worker processes, so jobs are finished when daemon is
+# stopped from terminal
+def init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+# return date <YYYY/MM/DD> of modification of file 'path' (UTC), which is
+# the end of log dropped by logger
+def file_date(path):
+    return datetime.datetime.utcfromtimestamp(os.path.getmtime(path)).strftime("%Y/%m/%d")
+
+
+# print line of daemon log
+def log(status, path, text=""):
+    print("%s %-8s %s%s" % (time.strftime("%Y/%m/%d %H:%M:%S"), status, path, text))
+    sys.stdout.flush()
+
+
+# daemon converting files of 'watch_dir' matching 'pattern' by 'workers'
+# processes; 'options' is dictionary of job options of batch_convert (date
+# None means date of file modification); 'queue_path' is file of job queue
+class WatchDaemon(object):
+
+    def __init__(self, watch_dir, options, queue_path, workers=None, pattern='*', settle=10.0,
+                 interval=2.0, retries=3, retry_delay=60.0, poll=False, once=False):
+
+        self.watch_dir = os.path.abspath(watch_dir)
+        self.options = options
+        self.queue_path = queue_path
+        self.workers = workers or os.cpu_count()
+        self.pattern = pattern
+        self.interval = interval
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.once = once
+
+        if poll == True or watchdog == None:
+            self.watcher = PollWatcher(self.watch_dir, pattern)
+        else:
+            self.watcher = EventWatcher(self.watch_dir, pattern)
+
+        self.tracker = StabilityTracker(settle)
+        self.stopping = False
+
+    # stop daemon after running jobs end
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    # return job of batch_convert for file 'path'
+    def job(self, path):
+
+        job = dict(self.options)
+        job["input"] = path
+        if job["date"] == None:
+            job["date"] = file_date(path)
+
+        return job
+
+    # add files 'files' given as (path, size, mtime) to tracker, unless they
+    # were converted with the same content
+    def offer(self, files, now):
+
+        for path, size, mtime in files:
+            if self.known.get(path) != (size, mtime):
+                self.tracker.add(path, size, mtime, now)
+
+    # run daemon until it's stopped (or until all files are converted in
+    # 'once' mode)
+    def run(self):
+
+        queue = JobQueue(self.queue_path)
+        self.known = queue.known()
+
+        self.watcher.start()
+        pool = concurrent.futures.ProcessPoolExecutor(self.workers, initializer=init_worker)
+        running = {}
+
+        # new content of files of running jobs, queued after the jobs end
+        deferred = {}
+
+        # running jobs of pool replaced after its worker died
+        stale = set()
+
+        try:
+            self.offer(scan_dir(self.watch_dir, self.pattern), time.time())
+
+            while self.stopping == False or len(running) > 0:
+
+                now = time.time()
+
+                if self.stopping == False:
+
+                    self.offer(self.watcher.changes(), now)
+
+                    for path, size, mtime in self.tracker.ready(now):
+                        self.known[path] = (size, mtime)
+                        if path in running.values():
+                            deferred[path] = (size, mtime)
+                            continue
+                        queue.add(path, size, mtime, now)
+                        log("QUEUED", path)
+
+                    for path in queue.next_jobs(self.workers - len(running), now):
+
+                        if path in running.values():
+                            continue
+
+                        if os.path.isfile(path) == False:
+                            queue.remove(path)
+                            self.known.pop(path, None)
+                            log("REMOVED", path)
+                            continue
+
+                        queue.start(path, now)
+                        running[pool.submit(batch_convert.run_job, self.job(path))] = path
+
+                    if self.once == True and len(running) == 0 and len(deferred) == 0 and \
+                       len(self.tracker.candidates) == 0 and len(queue.next_jobs(1, now)) == 0:
+                        break
+
+                if len(running) == 0:
+                    time.sleep(self.interval)
+                    continue
+
+                done, _ = concurrent.futures.wait(
+                    running, timeout=self.interval,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+
+                broken = False
+
+                for future in done:
+                    path = running.pop(future)
+
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        # worker process died
+                        result = {"status": "FAILED", "time": 0.0, "obs": "", "nav": "",
+                                  "error": str(e) or type(e).__name__}
+
+                    state = queue.finish(path, result, time.time(), self.retries,
+                                         self.retry_delay)
+                    if state != None:
+                        log("RETRY" if state == 'queued' else state.upper(), path,
+                            " (%.2f s) %s" % (result["time"], result["error"]))
+
+                    # file changed while it was converted is converted again
+                    if path in deferred:
+                        size, mtime = deferred.pop(path)
+                        queue.add(path, size, mtime, time.time())
+                        log("QUEUED", path)
+
+                    if isinstance(future.exception(),
+                                  concurrent.futures.process.BrokenProcessPool) and \
+                       future not in stale:
+                        broken = True
+                    stale.discard(future)
+
+                # pool can't run jobs after its worker died; all its running
+                # jobs fail, so pool is created again only once
+                if broken == True:
+                    pool.shutdown(wait=False)
+                    pool = concurrent.futures.ProcessPoolExecutor(self.workers,
+                                                                  initializer=init_worker)
+                    stale = set(running)
+
+        finally:
+            self.watcher.stop()
+            pool.shutdown()
+            counts = queue.counts()
+            queue.close()
+
+        return counts
+
+
+# print numbers of jobs returned by WatchDaemon.run
+def print_counts(counts):
+    print("Number of jobs: " + ", ".join("%s %d" % (state, counts[state])
+                                         for state in job_states))
+
+
+if __name__ == "__main__":
+
+    start = time.time()
+
+    #%% Read input arguments
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("watch_dir", type=str,
+                        help="directory to which RTCM logs are dropped.")
+    parser.add_argument("-d", "--dest", type=str,
+                        help="destination <directory> to save RINEX files. " \
+                            "If not specified, <watch_dir>/rinex is used.")
+    parser.add_argument("-q", "--queue", type=str,
+                        help="job queue file. If not specified, " + queue_file + \
+                            " in destination directory is used.")
+    parser.add_argument("-p", "--pattern", type=str, default='*',
+                        help="glob pattern of names of input files (e.g. '*.log').")
+    parser.add_argument("-t", "--date", type=str,
+                        help="calendar date of beginning of RTCM messages as <YYYY/MM/DD>, " \
+                            "used for all files. If not specified, date of file " \
+                            "modification is used.")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of worker processes. Number of CPUs is used by default.")
+    parser.add_argument("--nav-jobs", type=int, default=1,
+                        help="number of processes fixing chunks of big nav file in each " \
+                            "job (see convbin_nav_fix). Nav file is fixed by one process " \
+                            "by default.")
+    parser.add_argument("--settle", type=float, default=10.0,
+                        help="seconds for which size and modification time of file must not " \
+                            "change before it's converted.")
+    parser.add_argument("-i", "--interval", type=float, default=2.0,
+                        help="seconds between checks of directory and jobs.")
+    parser.add_argument("--retries", type=int, default=3,
+                        help="number of retries of failed conversion.")
+    parser.add_argument("--retry-delay", type=float, default=60.0,
+                        help="seconds before the first retry, doubled by each retry.")
+    parser.add_argument("--poll", action='store_true',
+                        help="poll directory even if watchdog package is available.")
+    parser.add_argument("--once", action='store_true',
+                        help="convert files which are in directory and exit.")
+    parser.add_argument("-w", "--window", type=int, default=0,
+                        help="number of recent epochs kept in memory to merge " \
+                            "duplicated obs epochs which are not consecutive.")
+    parser.add_argument("--decoder", type=str, choices=['convbin', 'native'], default='convbin',
+                        help="RTCM decoder used to create RINEX files.")
+    parser.add_argument("--demux", action='store_true',
+                        help="extract valid RTCM frames from capture logs before conversion.")
+    parser.add_argument("--crx", action='store_true',
+                        help="write obs files in Compact RINEX (Hatanaka) format.")
+    parser.add_argument("-z", "--compress", type=str, choices=['gz', 'zst'],
+                        help="compress output files by gzip or zstd.")
+    parser.add_argument("--session", type=str,
+                        help="split obs and nav files into files of sessions of <SESSION> " \
+                            "length (e.g. '1h', '15m', at most a day); nav records go to obs " \
+                            "session of their time of clock or the nearest one " \
+                            "(see session_split).")
+    parser.add_argument("--qc", action='store_true',
+                        help="save quality statistics of obs files (see obs_qc); " \
+                            "fixing of obs files takes about 3 times longer.")
+    parser.add_argument("-c", "--cache", type=str,
+                        help="cache <directory> with converted files, shared by workers.")
+    parser.add_argument("--prescan", action='store_true',
+                        help="skip files without observation messages (see rtcm_scan).")
+    parser.add_argument("--track", type=str, choices=['csv', 'parquet'],
+                        help="save position track of NMEA GGA sentences of each input " \
+                            "(see nmea_track).")
+    args = parser.parse_args()
+
+    #%% Sanity check for input parameters
+
+    if os.path.isdir(args.watch_dir) == False:
+        print("Can't locate directory: " + args.watch_dir)
+        print("Exiting!")
+        sys.exit(1)
+
+    if args.jobs < 1:
+        print("Number of jobs must be positive!")
+        print("Exiting!")
+        sys.exit(1)
+
+    dest = args.dest
+    if dest == None:
+        dest = os.path.join(args.watch_dir, "rinex")
+
+    # RINEX files written to watched directory would be converted again
+    if os.path.abspath(dest) == os.path.abspath(args.watch_dir):
+        print("Destination directory must differ from watched directory!")
+        print("Exiting!")
+        sys.exit(1)
+
+    session = None
+    if args.session != None:
+        try:
+            session = session_split.parse_length(args.session)
+        except ValueError as e:
+            print(e)
+            print("Exiting!")
+            sys.exit(1)
+
+    os.makedirs(dest, exist_ok=True)
+
+    queue_path = args.queue
+    if queue_path == None:
+        queue_path = os.path.join(dest, queue_file)
+
+    options = {"date": args.date, "dest": dest, "window": args.window,
+               "decoder": args.decoder, "demux": args.demux, "cache": args.cache,
+               "crx": args.crx, "compress": args.compress, "prescan": args.prescan,
+               "track": args.track, "session": session, "qc": args.qc,
+               "nav_workers": args.nav_jobs}
+
+    #%% Watch directory
+
+    daemon = WatchDaemon(args.watch_dir, options, queue_path, args.jobs, args.pattern,
+                         args.settle, args.interval, args.retries, args.retry_delay, args.poll,
+                         args.once)
+
+    signal.signal(signal.SIGINT, daemon.stop)
+    signal.signal(signal.SIGTERM, daemon.stop)
+
+    print("Watching %s by %s with %d workers...\n" % (
+        args.watch_dir, type(daemon.watcher).__name__, daemon.workers))
+
+    try:
+        counts = daemon.run()
+    except (ValueError, RuntimeError, EnvironmentError, sqlite3.Error) as e:
+        print(e)
+        print("Exiting!")
+        sys.exit(1)
+
+    print("")
+    print_counts(counts)
+
+    stop = time.time()
+    delta = stop - start
+    print("Processing time: %.2f s\n" % delta)